@@ -12,6 +12,15 @@ import os
 import datetime
 import sys
 import multiprocessing
+import tempfile
+
+import grade_history
+import progress
+import repo_health
+import roster
+import run_tests
+import score_matrix
+import similarity_clusters
 
 TEST_SCRIPT_NAME = "run_tests.py"
 IN_TESTED_DIR_NEEDS = ["Test_Suite", TEST_SCRIPT_NAME,
@@ -21,40 +30,98 @@ BASE_REPO_NAME = "instructor-database"
 GITHUB_ORG = "CSE480-MSU"
 LATE_DAY_PENALTY = 1.0
 NUM_POOL_WORKERS = 20
+# Quarantined repos (see scan) are graded last on this many workers
+NUM_QUARANTINE_WORKERS = 2
 MULTI_ALLOWED = True
 INSTRUCTOR_EMAIL = "nahumjos@cse.msu.edu"
 PULL_CHANGES_FOR_BASE_REPO = False
+NUM_MOST_EXPENSIVE_TESTS_SHOWN = 20
+D2L_EXPORT_FILE = "D2L_export.csv"
+
+# Reports the progress of every stage run on the repos (see main for
+# where its metrics file is set)
+PROGRESS = progress.ProgressReporter()
+
+# Pools start their workers from a fork server rather than forking this
+# process, whose progress refresh thread may be holding stdout's lock
+POOL_CONTEXT = multiprocessing.get_context("forkserver")
 
 Student = collections.namedtuple('Student',
                                  ['github_username',
                                   'msu_net_id',
                                   'full_name'])
 
+# Struc that holds a grades file (autograder or HackerRank csv) to export
+# to D2L and how its grades are adjusted
+D2LSource = collections.namedtuple('D2LSource',
+                                   ['csv_file', 'grade_item_name',
+                                    'scale_factor', 'late_penalty_factor'])
+
 
 class AutograderError(Exception):
     pass
 
 
 def get_students_from_file(csv_handle):
+    """
+    Returns the students (with a GitHub username) from a students_info csv,
+    read through the roster so each student appears once.
+    Every student left out for not having a GitHub username is printed.
+    """
     with contextlib.closing(csv_handle):
-        reader = csv.reader(csv_handle, strict=True)
-        header = next(reader)
-        assert tuple(header) == Student._fields
-        return list(map(Student._make, reader))
+        class_roster = roster.load_roster(students_info_csv=csv_handle.name)
+    missing_usernames = [student for student in class_roster
+                         if student.github_username is None]
+    if missing_usernames:
+        print("{} students have no GitHub username and are left out of "
+              "this command:".format(len(missing_usernames)))
+        for student in missing_usernames:
+            print("  {} ({})".format(student.msu_net_id, student.full_name))
+    return [Student(student.github_username, student.msu_net_id,
+                    student.full_name)
+            for student in class_roster if student.github_username]
+
+
+def run_tasks(stage_name, function, args, parallel=True,
+              workers=NUM_POOL_WORKERS):
+    """
+    Runs the function on every arg (on a pool of workers if parallel)
+    while reporting the stage's progress.
+    Returns the results in the order the tasks finished. The first task
+    to raise stops the stage (the pool's other tasks are terminated).
+    """
+    if not parallel:
+        return list(PROGRESS.run(stage_name, function, args))
+    with POOL_CONTEXT.Pool(workers) as pool:
+        return list(PROGRESS.run(stage_name, function, args, pool, workers))
 
 
 def clone_repos_from_github(students, repo_dir):
     print("Cloning Student Repos into: {}".format(repo_dir))
     if not os.path.exists(repo_dir):
         os.makedirs(repo_dir)
-    for student in students:
-        clone_url = convert_student_to_clone_url(student)
-        stu_repo_path = get_repo_dir(student, repo_dir)
-        if not os.path.exists(stu_repo_path):
-            print("Cloning: {}".format(stu_repo_path))
-            subprocess.check_call(['git', 'clone', clone_url], cwd=repo_dir)
-        else:
-            print("Skipping {} already exists".format(stu_repo_path))
+    to_clone = [student for student in students
+                if not os.path.exists(get_repo_dir(student, repo_dir))]
+    if len(to_clone) < len(students):
+        print("Skipping {} repos that already exist".format(
+            len(students) - len(to_clone)))
+    run_tasks("clone", clone_repo,
+              [(student, repo_dir) for student in to_clone])
+
+
+def clone_repo(arg):
+    student, repo_dir = arg
+    clone_url = convert_student_to_clone_url(student)
+    # Clones run side by side, so git fails instead of prompting for
+    # credentials
+    env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+    try:
+        subprocess.check_output(['git', 'clone', clone_url], cwd=repo_dir,
+                                stderr=subprocess.STDOUT, env=env)
+    except subprocess.CalledProcessError as cpe:
+        print("Problem cloning: {}\n{}".format(
+            clone_url, cpe.output.decode(errors="replace")))
+        raise cpe
 
 
 def get_repo_dir(student, repo_dir):
@@ -62,11 +129,11 @@ def get_repo_dir(student, repo_dir):
     return os.path.join(repo_dir, repo_name)
 
 
-def run_command_on_repos(command, students, repo_dir):
+def run_command_on_repos(command, students, repo_dir,
+                         workers=NUM_POOL_WORKERS):
     print("Running command on repos: {}".format(" ".join(command)))
-    pool = multiprocessing.Pool(NUM_POOL_WORKERS)
     args = [(command, student, repo_dir) for student in students]
-    pool.map(run_command_on_repo, args)
+    run_tasks(" ".join(command), run_command_on_repo, args, workers=workers)
 
 
 def run_command_on_repo(arg):
@@ -103,16 +170,32 @@ def pull_repos(students, repo_dir):
                          students, repo_dir)
 
 
-def checkout_repos(students, repo_dir, tag_name):
-    clean_repos(students, repo_dir)
-    run_command_on_repos(['git', 'checkout', tag_name], students, repo_dir)
+def checkout_repos(students, repo_dir, tag_name, workers=NUM_POOL_WORKERS):
+    clean_repos(students, repo_dir, workers)
+    run_command_on_repos(['git', 'checkout', tag_name], students, repo_dir,
+                         workers)
 
 
-def clean_repos(students, repos_dir):
+def clean_repos(students, repos_dir, workers=NUM_POOL_WORKERS):
     commands = [['git', 'clean', '-f', '-d', '-x'],
                 ['git', 'reset', '--hard']]
     for command in commands:
-        run_command_on_repos(command, students, repos_dir)
+        run_command_on_repos(command, students, repos_dir, workers)
+
+
+def scan_repos(students, repos_dir, thresholds, scan_csv):
+    """
+    Collects the size of every repo, writing it to the scan csv,
+    and quarantines the repos over the thresholds.
+    """
+    args = [(student.msu_net_id, get_repo_dir(student, repos_dir))
+            for student in students]
+    name_to_health = dict(run_tasks("scan", repo_health.scan_repo, args))
+    quarantined = repo_health.write_scan(name_to_health, thresholds,
+                                         scan_csv)
+    print("Scanned {} repos, quarantined {} (see {}): {}".format(
+        len(name_to_health), len(quarantined), scan_csv,
+        ", ".join(quarantined)))
 
 
 def tag_repos(students, repo_dir, tag_name):
@@ -152,7 +235,7 @@ def send_email(subject_line, csv_file):
                               universal_newlines=True) as proc:
             proc.communicate(body)
 
-    def send_email_to_student(student_test_to_score, subject_line):
+    def send_email_to_student(student, subject_line):
         msu_id = get_value_from_data_list("MSU_Net_ID", student)
         commit_id = get_value_from_data_list("Commit", student)
         late_penalty = get_value_from_data_list("Late_Penalty", student)
@@ -180,8 +263,9 @@ Raw Data (consult run_tests.py for details)
         send_single_email(address, subject_line, body)
 
     students_data_list = get_students_data_list(csv_file)
-    for student in students_data_list:
-        send_email_to_student(student, subject_line)
+    run_tasks("send-email",
+              lambda student: send_email_to_student(student, subject_line),
+              students_data_list, parallel=False)
     send_single_email(INSTRUCTOR_EMAIL,
                       "Grades Sent: " + subject_line,
                       "Number Sent: {}".format(
@@ -226,7 +310,11 @@ def get_repo_name(student):
 
 StudentRepoResults = collections.namedtuple(
     "StudentRepoResults",
-    ['student', 'test_to_scores', 'git_commit_id'])
+    ['student', 'test_to_scores', 'git_commit_id', 'test_to_usage'])
+
+# Resources used by a single test (as reported by run_tests.py)
+TestUsage = collections.namedtuple('TestUsage',
+                                   ['wall', 'user', 'sys', 'maxrss'])
 
 
 def copy_test_files(student_repo, grade_directory, base_repo_path):
@@ -234,6 +322,8 @@ def copy_test_files(student_repo, grade_directory, base_repo_path):
     Copies the files needed for testing into the repo.
     The files are copied from base repo.
     This is to ensure that the students can't modify the tests.
+    Timestamps are preserved so run_tests.py can reuse the base repo's
+    cached Test_Suite manifest.
     """
     stu_tested_dir = os.path.join(student_repo, grade_directory)
     base_tested_dir = os.path.join(base_repo_path, grade_directory)
@@ -251,7 +341,7 @@ def copy_test_files(student_repo, grade_directory, base_repo_path):
                                     stderr=subprocess.STDOUT)
         except subprocess.CalledProcessError as cpe:
             pass
-        subprocess.check_output(['cp', '-rf', source, dest])
+        subprocess.check_output(['cp', '-rfp', source, dest])
 
 
 def get_test_results(arg):
@@ -264,12 +354,19 @@ def get_test_results(arg):
     stu_repo_path = get_repo_dir(student, repos_dir)
     test_dir = os.path.join(stu_repo_path, grade_directory)
 
-    print("Grading Dir: {}".format(test_dir))
-    sys.stdout.flush()
     copy_test_files(stu_repo_path, grade_directory, base_repo_path)
 
     git_commit_id = get_commit_id(test_dir)
+    test_to_scores, test_to_usage = run_machine_mode(test_dir)
+    return StudentRepoResults(student, test_to_scores, git_commit_id,
+                              test_to_usage)
 
+
+def run_machine_mode(test_dir):
+    """
+    Runs the tests in the directory and returns the (test, score) pairs
+    and the usage of every test.
+    """
     output_str = subprocess.check_output(
         ["./run_tests.py", "--run-machine-mode"],
         cwd=test_dir,
@@ -277,15 +374,72 @@ def get_test_results(arg):
     lines = output_str.split("\n")
     if not lines[-1]:
         del lines[-1]
-    elements = map(lambda line: line.split(','), lines)
-    test_to_scores = list(map(
-        lambda pair: (pair[0], float(pair[1])),
-        elements))
-    return StudentRepoResults(student, test_to_scores, git_commit_id)
+    test_to_scores = []
+    test_to_usage = {}
+    for line in lines:
+        elements = line.split(',')
+        test_to_scores.append((elements[0], float(elements[1])))
+        if len(elements) > 2:
+            test_to_usage[elements[0]] = TestUsage._make(
+                map(float, elements[2:]))
+    return test_to_scores, test_to_usage
+
+
+def write_usage_report(list_of_student_repo_results, usage_file):
+    """
+    Writes the resources used by every (student, test) pair to a csv,
+    most CPU time first, and prints the most expensive pairs and students.
+    """
+    rows = []
+    student_to_wall = collections.Counter()
+    for student_repo_results in list_of_student_repo_results:
+        net_id = student_repo_results.student.msu_net_id
+        for test, usage in student_repo_results.test_to_usage.items():
+            rows.append([usage.user + usage.sys, net_id, test] + list(usage))
+            student_to_wall[net_id] += usage.wall
+    rows.sort(reverse=True)
+    with open(usage_file, 'w') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(["CPU", "MSU_Net_ID", "Test"] +
+                        list(TestUsage._fields))
+        writer.writerows(rows)
+
+    print("Most expensive tests (CPU seconds, student, test):")
+    for row in rows[:NUM_MOST_EXPENSIVE_TESTS_SHOWN]:
+        print("{:8.3f}  {:<12} {}".format(*row[:3]))
+    print("Most expensive students (wall seconds, student):")
+    for net_id, wall in student_to_wall.most_common(
+            NUM_MOST_EXPENSIVE_TESTS_SHOWN):
+        print("{:8.3f}  {}".format(wall, net_id))
+
+
+def calibrate_performance_tests(base_repo_path, grade_directory):
+    """
+    Measures the reference solution on this machine
+    so performance tests have budgets. Suites without performance
+    categories (which may come with a run_tests.py that can't calibrate)
+    are left alone.
+    """
+    base_tested_dir = os.path.join(base_repo_path, grade_directory)
+    test_suite_folder = os.path.join(base_tested_dir,
+                                     run_tests.TEST_SUITE_FOLDER)
+    if all(budget_multiplier is None for _, _, budget_multiplier
+           in run_tests.read_points(test_suite_folder)):
+        return
+    print("Calibrating performance tests in: {}".format(base_tested_dir))
+    subprocess.check_call(["./" + TEST_SCRIPT_NAME, "--calibrate"],
+                          cwd=base_tested_dir)
 
 
 def grade_repos(students, repos_dir, base_repo_dir,
-                grade_directory, tag_name, late_penalty):
+                grade_directory, tag_name, late_penalty,
+                quarantined=frozenset(),
+                quarantine_workers=NUM_QUARANTINE_WORKERS):
+    """
+    Grades every repo at the tag. Quarantined repos (MSU NetIDs) are
+    checked out and graded after all the others, on quarantine_workers,
+    so they can't hold up the main pass.
+    """
     all_readme_file = "all_readmes.txt"
     base_repo_path = os.path.join(base_repo_dir, BASE_REPO_NAME)
     if PULL_CHANGES_FOR_BASE_REPO:
@@ -305,19 +459,11 @@ def grade_repos(students, repos_dir, base_repo_dir,
                 raise AutograderError(
                     "Discovered tests don't match other students")
 
-    def get_student_scores():
-        pool = multiprocessing.Pool(NUM_POOL_WORKERS)
-
+    def get_student_scores(students_to_grade, stage_name, workers):
         args = [(student, repos_dir, grade_directory, base_repo_path)
-                for student in students]
-        if MULTI_ALLOWED:
-            list_of_student_repo_results = list(
-                pool.map(get_test_results, args))
-        else:
-            list_of_student_repo_results = [get_test_results(arg)
-                                            for arg in args]
-        check_all_tests_run(list_of_student_repo_results)
-        return list_of_student_repo_results
+                for student in students_to_grade]
+        return run_tasks(stage_name, get_test_results, args,
+                         parallel=MULTI_ALLOWED, workers=workers)
 
     def split_tests_scores(student_repo_results):
         tests, scores = list(zip(*student_repo_results.test_to_scores))
@@ -364,59 +510,83 @@ def grade_repos(students, repos_dir, base_repo_dir,
             for content in contents:
                 all_readme_handle.write("\n".join(content))
 
-    checkout_repos(students, repos_dir, tag_name)
-
-    list_of_student_repo_results = get_student_scores()
+    main_students = [student for student in students
+                     if student.msu_net_id not in quarantined]
+    quarantined_students = [student for student in students
+                            if student.msu_net_id in quarantined]
+
+    checkout_repos(main_students, repos_dir, tag_name)
+    calibrate_performance_tests(base_repo_path, grade_directory)
+
+    list_of_student_repo_results = get_student_scores(
+        main_students, "grade", NUM_POOL_WORKERS)
+    if quarantined_students:
+        print("Grading {} quarantined repos ({} at a time)".format(
+            len(quarantined_students), quarantine_workers))
+        checkout_repos(quarantined_students, repos_dir, tag_name,
+                       quarantine_workers)
+        list_of_student_repo_results += get_student_scores(
+            quarantined_students, "grade quarantined", quarantine_workers)
+    check_all_tests_run(list_of_student_repo_results)
     grades_file = "grades_for_{}.csv".format(tag_name)
     write_to_csv(list_of_student_repo_results, grades_file, late_penalty)
+    usage_file = "usage_for_{}.csv".format(tag_name)
+    write_usage_report(list_of_student_repo_results, usage_file)
     all_readme_file = "all_README_for_{}.txt".format(tag_name)
     collect_readmes(all_readme_file)
 
 
-def merge_grades(old_master_csv, revisions_csv):
-    def convert_to_names_to_scores(records):
-        result = {}
-        for student_scores in records:
-            name = get_value_from_data_list("MSU_Net_ID", student_scores)
-            result[name] = student_scores
-        return result
+def merge_grades(old_master_csv, revisions_csvs):
+    """
+    Streams the master csv and then each revision csv (round 1, 2, ...),
+    keeping every master student's best late-adjusted grade (a later round
+    wins ties). Writes the kept rows, with the round each came from, to
+    "grades_master.csv" and the ones from a revision to
+    "grades_improved.csv".
+    """
+    def read_rows(csv_file):
+        with open(csv_file, 'r') as csv_handle:
+            reader = csv.DictReader(csv_handle)
+            for column in reader.fieldnames:
+                if column not in header and column != "Round":
+                    header.append(column)
+            for row in reader:
+                yield row
 
-    def write_to_file(records, file_name, header):
-        records.sort()
+    def write_to_file(records, file_name):
         with open(file_name, 'w') as file_handle:
-            writer = csv.writer(file_handle)
-            writer.writerow(header)
-            for record in records:
-                data = [val for col, val in record]
-                writer.writerow(data)
-
-    def get_header(records):
-        if not records:
-            raise AutograderError("Can't write csv file with no grades. "
-                                  "Bad csv files")
-        row = records[0]
-        return [col for col, val in row]
-
-    old_master_grades = get_students_data_list(old_master_csv)
-    revisions_grades = get_students_data_list(revisions_csv)
-    old_master_name_to_scores = convert_to_names_to_scores(old_master_grades)
-    revisions_name_to_scores = convert_to_names_to_scores(revisions_grades)
-
-    new_master_grades = []
-    improved_grades = []
-    for name, scores in old_master_name_to_scores.items():
-        new_scores = scores
-        old_grade = get_late_grade(scores)
-        if name in revisions_name_to_scores:
-            new_grade = get_late_grade(revisions_name_to_scores[name])
-            if new_grade >= old_grade:
-                new_scores = revisions_name_to_scores[name]
-                improved_grades.append(new_scores)
-        new_master_grades.append(new_scores)
-
-    header = get_header(new_master_grades)
-    write_to_file(new_master_grades, "grades_master.csv", header)
-    write_to_file(improved_grades, "grades_improved.csv", header)
+            writer = csv.DictWriter(file_handle, header + ["Round"],
+                                    restval="")
+            writer.writeheader()
+            for name in sorted(records):
+                grade, round_number, row = records[name]
+                writer.writerow(dict(row, Round=round_number))
+
+    header = []
+    best = {}
+    for row in read_rows(old_master_csv):
+        best[row["MSU_Net_ID"]] = (get_late_grade(list(row.items())), 0, row)
+    if not best:
+        raise AutograderError("Can't write csv file with no grades. "
+                              "Bad csv files")
+
+    not_in_master = set()
+    for round_number, revisions_csv in enumerate(revisions_csvs, 1):
+        for row in read_rows(revisions_csv):
+            name = row["MSU_Net_ID"]
+            if name not in best:
+                not_in_master.add(name)
+                continue
+            new_grade = get_late_grade(list(row.items()))
+            if new_grade >= best[name][0]:
+                best[name] = (new_grade, round_number, row)
+    if not_in_master:
+        print("Students in revisions but not in master (ignored): {}".format(
+            ", ".join(sorted(not_in_master))))
+
+    improved = {name: record for name, record in best.items() if record[1]}
+    write_to_file(best, "grades_master.csv")
+    write_to_file(improved, "grades_improved.csv")
 
 
 def convert_to_D2L(csv_file, assignment_name):
@@ -439,6 +609,251 @@ def convert_to_D2L(csv_file, assignment_name):
         writer.writerows(rows)
 
 
+def parse_d2l_source(spec):
+    """
+    Parses "CSV[,name=ITEM][,scale=FACTOR][,late=FACTOR]" into a D2LSource
+    (the grade item name defaults to the file's name).
+    """
+    csv_file, *options = spec.split(",")
+    name = os.path.splitext(os.path.basename(csv_file))[0]
+    scale_factor = 1.0
+    late_penalty_factor = 1.0
+    for option in options:
+        key, _, value = option.partition("=")
+        if key == "name":
+            name = value
+        elif key == "scale":
+            scale_factor = float(value)
+        elif key == "late":
+            late_penalty_factor = float(value)
+        else:
+            raise AutograderError("Unknown option in {}: {}".format(spec,
+                                                                     option))
+    return D2LSource(csv_file, name, scale_factor, late_penalty_factor)
+
+
+def read_source_grades(source, class_roster):
+    """
+    Streams (username, adjusted grade) pairs from an autograder grades csv
+    (MSU_Net_ID, grade and Late_Penalty columns) or a HackerRank csv
+    (Login ID and Total score columns), reporting the rows that don't
+    match a student.
+    """
+    unmatched = []
+    with open(source.csv_file, 'r') as csv_handle:
+        reader = csv.DictReader(csv_handle)
+        if "MSU_Net_ID" in reader.fieldnames:
+            id_column, grade_column = "MSU_Net_ID", "grade"
+        elif "Login ID" in reader.fieldnames:
+            id_column, grade_column = "Login ID", "Total score"
+        else:
+            raise AutograderError("Don't know the format of {}".format(
+                source.csv_file))
+        for row in reader:
+            student = class_roster.find(row[id_column])
+            if student is None:
+                unmatched.append(row[id_column])
+                continue
+            late_penalty = float(row.get("Late_Penalty") or 0)
+            grade = float(row[grade_column]) - \
+                late_penalty * source.late_penalty_factor
+            yield student.msu_net_id, grade / source.scale_factor
+    roster.report_unmatched(source.csv_file, unmatched)
+
+
+def export_to_D2L(sources, class_roster, output_csv=D2L_EXPORT_FILE):
+    """
+    Joins the grades of every source by username into one csv that
+    Desire2Learn can import, with a column for each source.
+    Only each student's adjusted grades are kept while the sources
+    are streamed.
+    """
+    username_to_grades = collections.defaultdict(dict)
+    for index, source in enumerate(sources):
+        for username, grade in read_source_grades(source, class_roster):
+            username_to_grades[username][index] = grade
+    header = (["Username"] +
+              [source.grade_item_name + " Points Grade"
+               for source in sources] +
+              ["End-of-Line Indicator"])
+    with open(output_csv, 'w') as csv_handle:
+        writer = csv.writer(csv_handle)
+        writer.writerow(header)
+        for username in sorted(username_to_grades):
+            grades = username_to_grades[username]
+            writer.writerow([username] +
+                            [grades.get(index, "")
+                             for index in range(len(sources))] +
+                            ['#'])
+    print("Exported {} grade items for {} students to {}".format(
+        len(sources), len(username_to_grades), output_csv))
+
+
+def find_similar_repos(students, repos_dir, base_repo_dir, tag_name,
+                       threshold):
+    """
+    Sketches every repo at the tag (ignoring code from the base repo)
+    and writes the pairs of repos that look similar to
+    "similarity_for_<tag>.csv".
+    """
+    base_repo_path = os.path.join(base_repo_dir, BASE_REPO_NAME)
+    base_shingles = similarity_clusters.get_shingles(
+        similarity_clusters.read_sources_at(base_repo_path, "HEAD"))
+
+    args = [(student.msu_net_id, get_repo_dir(student, repos_dir), tag_name,
+             base_shingles) for student in students]
+    name_to_signature = {
+        name: signature
+        for name, signature in run_tasks(
+            "similarity", similarity_clusters.sketch_repo, args)
+        if signature is not None}
+
+    pairs = similarity_clusters.find_similar_pairs(name_to_signature,
+                                                   threshold)
+    similarity_file = "similarity_for_{}.csv".format(tag_name)
+    with open(similarity_file, 'w') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(["Similarity", "MSU_Net_ID", "Other_MSU_Net_ID"])
+        writer.writerows(pairs)
+    clusters = similarity_clusters.get_clusters(pairs)
+    print("Sketched {} repos, found {} similar pairs in {} clusters".format(
+        len(name_to_signature), len(pairs), len(clusters)))
+    for cluster in clusters:
+        print("Cluster: {}".format(", ".join(cluster)))
+
+
+def grade_student_history(arg):
+    """
+    Grades the student's commits between the refs in a separate worktree
+    (so the repo's checkout isn't touched). Returns the student, their
+    timeline and first passes (None, None if the history can't be read).
+    """
+    (student, repos_dir, grade_directory, base_repo_path, from_ref, to_ref,
+     suite_key, category_targets, every_commit) = arg
+    stu_repo_path = get_repo_dir(student, repos_dir)
+    try:
+        commits = grade_history.list_commits(stu_repo_path, from_ref, to_ref,
+                                             grade_directory)
+    except subprocess.CalledProcessError:
+        print("Problem reading history of repo: " + stu_repo_path)
+        return student, None, None
+    cache = grade_history.ResultCache(suite_key)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        worktree = os.path.join(temp_dir, get_repo_name(student))
+        try:
+            subprocess.check_output(['git', 'worktree', 'add', '--detach',
+                                     worktree, commits[-1].commit_id],
+                                    cwd=stu_repo_path,
+                                    stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as cpe:
+            print("Problem adding worktree to repo: " + stu_repo_path)
+            print(cpe.output.decode(errors="replace"))
+            return student, None, None
+
+        def run_suite(commit):
+            try:
+                for command in (['git', 'checkout', '-f', '--detach',
+                                 commit.commit_id],
+                                ['git', 'clean', '-f', '-d', '-x']):
+                    subprocess.check_output(command, cwd=worktree,
+                                            stderr=subprocess.STDOUT)
+                copy_test_files(worktree, grade_directory, base_repo_path)
+                test_to_scores, _ = run_machine_mode(
+                    os.path.join(worktree, grade_directory))
+            except subprocess.CalledProcessError:
+                print("Problem grading commit {} of repo: {}".format(
+                    commit.commit_id[:7], stu_repo_path))
+                return None
+            return test_to_scores
+
+        try:
+            timeline, first_passes, runs = grade_history.grade_history(
+                commits, run_suite, cache, category_targets, every_commit)
+        finally:
+            subprocess.call(['git', 'worktree', 'remove', '--force',
+                             worktree],
+                            cwd=stu_repo_path, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    print("Graded history of {}: {} commits, {} suite runs".format(
+        stu_repo_path, len(commits), runs))
+    sys.stdout.flush()
+    return student, timeline, first_passes
+
+
+def grade_histories(students, repos_dir, base_repo_dir, grade_directory,
+                    from_ref, to_ref, every_commit=False):
+    """
+    Writes every student's grade at each graded commit between the refs to
+    "history_for_<from>_to_<to>.csv" and the first commit each test and
+    category passes at to "first_passes_for_<from>_to_<to>.csv".
+    """
+    base_repo_path = os.path.join(base_repo_dir, BASE_REPO_NAME)
+    base_tested_dir = os.path.join(base_repo_path, grade_directory)
+    calibrate_performance_tests(base_repo_path, grade_directory)
+    suite_key = grade_history.get_suite_key(base_tested_dir,
+                                            IN_TESTED_DIR_NEEDS)
+    category_targets = grade_history.get_category_targets(
+        os.path.join(base_tested_dir, "Test_Suite"))
+
+    args = [(student, repos_dir, grade_directory, base_repo_path, from_ref,
+             to_ref, suite_key, category_targets, every_commit)
+            for student in students]
+    results = sorted(run_tasks("grade-history", grade_student_history, args),
+                     key=lambda result: result[0].msu_net_id)
+
+    timeline_rows = []
+    first_pass_rows = []
+    for student, timeline, first_passes in results:
+        if timeline is None:
+            continue
+        for commit, test_results in timeline:
+            if test_results is None:
+                scores = [grade_history.UNGRADED] * len(grade_history.RESULT_NAMES)
+            else:
+                scores = [test_results.get(name, "")
+                          for name in grade_history.RESULT_NAMES]
+            timeline_rows.append(
+                [student.msu_net_id, commit.commit_id[:7],
+                 grade_history.format_commit_time(commit)] + scores)
+        for first_pass in first_passes:
+            first_pass_rows.append(
+                [student.msu_net_id, first_pass.target,
+                 first_pass.commit.commit_id[:7],
+                 grade_history.format_commit_time(first_pass.commit)])
+
+    suffix = "{}_to_{}.csv".format(from_ref, to_ref).replace("/", "_")
+    with open("history_for_" + suffix, 'w') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(["MSU_Net_ID", "Commit", "Commit_Time"] +
+                        grade_history.RESULT_NAMES)
+        writer.writerows(timeline_rows)
+    with open("first_passes_for_" + suffix, 'w') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(["MSU_Net_ID", "Target", "Commit", "Commit_Time"])
+        writer.writerows(first_pass_rows)
+
+
+def rescore_grades(csv_file, base_repo_dir, grade_directory, weights,
+                   needed_files_points, points_for_passing_all):
+    test_suite_folder = os.path.join(base_repo_dir, BASE_REPO_NAME,
+                                     grade_directory, "Test_Suite")
+    weights = dict(parse_weight(weight) for weight in weights)
+    try:
+        score_matrix.rescore(csv_file, test_suite_folder, weights,
+                             needed_files_points, points_for_passing_all)
+    except score_matrix.ScoringError as se:
+        raise AutograderError(str(se))
+
+
+def parse_weight(weight_str):
+    category, equals, points = weight_str.rpartition("=")
+    if not equals:
+        raise AutograderError(
+            "Weights must look like CATEGORY=POINTS: " + weight_str)
+    return category, float(points)
+
+
 def get_cmd_args():
     parser = argparse.ArgumentParser(description="""
 Autograder for CSE450 (Translation of Programming Languages)""")
@@ -457,6 +872,13 @@ Path to the csv file contain the students info (Github usernames, ...).""")
                         default=".", help="""
 Path to base repo (tube-main for CSE 450) containing folder.
 Defaults to current directory.""")
+    config.add_argument('--metrics-file', help="""
+Json file that the progress of every stage (completed, failed, throughput
+and ETA) is written to while running.""")
+    config.add_argument('--progress-interval', type=float,
+                        default=progress.REFRESH_INTERVAL, metavar="SECONDS",
+                        help="""
+Seconds between progress updates (and metrics file refreshes).""")
 
     subparsers = parser.add_subparsers(dest='command', help='commands')
 
@@ -476,6 +898,7 @@ Tags HEAD commit.""")
     grade = subparsers.add_parser("grade", help="""
 Grades student repos at an associated tag..
 Stores the tests results (and grade if run_tests knows how) to "grades.csv".
+Stores the time and memory used by every test to "usage_for_<tag>.csv".
 Concatinates READMEs to "all_readmes.txt".""")
     grade.add_argument('grade_directory', metavar="DIRECTORY_TO_GRADE", help="""
 Grade the specified directory.""")
@@ -483,6 +906,27 @@ Grade the specified directory.""")
 Tag that should be checked out for grading.""")
     grade.add_argument('late_penalty', default=0.0, type=float, help="""
 Late penalty to be applied, defaults to 0.""")
+    grade.add_argument('--quarantine', metavar="SCAN_CSV", help="""
+Csv written by scan: the repos it quarantined are graded last.""")
+    grade.add_argument('--quarantine-workers', type=int,
+                       default=NUM_QUARANTINE_WORKERS, help="""
+Number of quarantined repos graded at a time.""")
+
+    scan = subparsers.add_parser("scan", help="""
+Collects the object count, pack size, largest blobs and file count of every
+repo and quarantines the repos over the thresholds
+(see grade --quarantine).""")
+    scan.add_argument('--output', default=repo_health.DEFAULT_SCAN_FILE,
+                      help="Csv the scan is written to.")
+    scan.add_argument('--max-pack-mb', type=float,
+                      default=repo_health.MAX_PACK_MEGABYTES, help="""
+Quarantine repos whose git objects take more megabytes.""")
+    scan.add_argument('--max-blob-mb', type=float,
+                      default=repo_health.MAX_BLOB_MEGABYTES, help="""
+Quarantine repos with a larger blob (in megabytes).""")
+    scan.add_argument('--max-files', type=int,
+                      default=repo_health.MAX_FILES, help="""
+Quarantine repos whose working tree has more files.""")
 
     send_email = subparsers.add_parser("send-email", help="""
 Email students their grades.""")
@@ -491,15 +935,17 @@ Email students their grades.""")
                             help="CSV file from which to email students")
 
     merge_grades = subparsers.add_parser("merge-grades", help="""
-Combine two csv files (master and revisions)
+Combine a master csv file and any number of revisions csv files (rounds)
 to a new master ("grades_master.csv")
-with grades that were improved from master
-(taking into account late penalty).
+with each student's best grade
+(taking into account late penalty) and the round it came from.
 Also writes a new csv file ("grades_improved.csv") of the
-grades that were better in the revision
+grades that were better in a revision
 """)
     merge_grades.add_argument('old_master_csv', help="Master csv file")
-    merge_grades.add_argument('revisions_csv', help="Revisions csv file")
+    merge_grades.add_argument('revisions_csvs', nargs='+',
+                              metavar='revisions_csv',
+                              help="Revisions csv files, in round order")
 
     convert_to_D2L = subparsers.add_parser("convert-to-D2L", help="""
 Converts a csv file containing the test results for a project to a csv that
@@ -509,6 +955,61 @@ Desire2Learn can import.
     convert_to_D2L.add_argument('grade_item_name',
                                 help="D2L name for assignment")
 
+    export_to_D2L = subparsers.add_parser("export-D2L", help="""
+Joins any number of grades csvs (from grade or HackerRank) by username
+into one csv that Desire2Learn can import, with a column for each.
+""")
+    export_to_D2L.add_argument('sources', nargs='+', metavar="SOURCE",
+                               help="""
+"CSV[,name=ITEM][,scale=FACTOR][,late=FACTOR]": grades are divided by the
+scale factor after subtracting the csv's Late_Penalty times the late factor.
+The D2L grade item name defaults to the csv's name.""")
+    export_to_D2L.add_argument('--output', default=D2L_EXPORT_FILE)
+
+    similarity = subparsers.add_parser("similarity", help="""
+Finds clusters of similar repos at a tag (ignoring code from the base repo),
+writing the similar pairs to "similarity_for_<tag>.csv"
+for a detailed comparison.""")
+    similarity.add_argument('tag_name')
+    similarity.add_argument('--threshold', type=float,
+                            default=similarity_clusters.DEFAULT_THRESHOLD,
+                            help="""
+Estimated similarity (0 to 1) needed to report a pair.""")
+
+    history = subparsers.add_parser("grade-history", help="""
+Grades the commits of every student between two refs, reusing results for
+commits that didn't change the graded directory. The first commit every
+test and category passes at is found by bisection.
+Stores each student's grade at every graded commit to
+"history_for_<from>_to_<to>.csv" and the first passing commits to
+"first_passes_for_<from>_to_<to>.csv".""")
+    history.add_argument('grade_directory', metavar="DIRECTORY_TO_GRADE",
+                         help="Grade the specified directory.")
+    history.add_argument('from_ref', help="""
+First commit (i.e. the previous project's tag) to grade.""")
+    history.add_argument('to_ref', help="Last commit to grade.")
+    history.add_argument('--net-id', action='append', metavar="NET_ID",
+                         help="""
+Only grade the history of this student (can be repeated).""")
+    history.add_argument('--every-commit', action='store_true', help="""
+Grade every commit for a full timeline (not only what bisection needs).""")
+
+    rescore = subparsers.add_parser("rescore", help="""
+Recomputes every grade in a grades csv from its test results
+(without rerunning tests) using the base repo's points.txt.
+Writes "rescored_<csv_file>" and per-test and per-category analytics
+to "analytics_for_<csv_file>.txt".""")
+    rescore.add_argument('csv_file', help="Grades csv file to rescore")
+    rescore.add_argument('grade_directory', metavar="DIRECTORY_TO_GRADE",
+                         help="Directory in the base repo with the Test_Suite")
+    rescore.add_argument('--weight', action='append', default=[],
+                         metavar="CATEGORY=POINTS", help="""
+Override the points of a points.txt category (can be repeated).""")
+    rescore.add_argument('--needed-files-points', type=float,
+                         default=score_matrix.run_tests.NEEDED_FILES_POINTS)
+    rescore.add_argument('--points-for-passing-all', type=float,
+                         default=score_matrix.run_tests.POINTS_FOR_PASSING_ALL)
+
     command = subparsers.add_parser("command",
                                     help="""Run command on every repo.""")
     command.add_argument('given_command')
@@ -518,6 +1019,8 @@ Desire2Learn can import.
 
 def main():
     args = get_cmd_args()
+    PROGRESS.metrics_file = args.metrics_file
+    PROGRESS.interval = args.progress_interval
     students = get_students_from_file(args.students)
     if args.command == "clone":
         clone_repos_from_github(students, args.student_repos)
@@ -531,15 +1034,56 @@ def main():
                     args.base_repo,
                     args.grade_directory,
                     args.tag_name,
-                    args.late_penalty)
+                    args.late_penalty,
+                    repo_health.read_quarantined(args.quarantine)
+                    if args.quarantine else frozenset(),
+                    args.quarantine_workers)
+    elif args.command == "scan":
+        scan_repos(students,
+                   args.student_repos,
+                   repo_health.HealthThresholds(args.max_pack_mb,
+                                                args.max_blob_mb,
+                                                args.max_files),
+                   args.output)
     elif args.command == "send-email":
         send_email(args.subject_line, args.csv_file)
     elif args.command == "checkout":
         checkout_repos(students, args.student_repos, args.tag_name)
     elif args.command == "merge-grades":
-        merge_grades(args.old_master_csv, args.revisions_csv)
+        merge_grades(args.old_master_csv, args.revisions_csvs)
     elif args.command == "convert-to-D2L":
         convert_to_D2L(args.csv_file, args.grade_item_name)
+    elif args.command == "export-D2L":
+        export_to_D2L([parse_d2l_source(spec) for spec in args.sources],
+                      roster.load_roster(students_info_csv=args.students.name),
+                      args.output)
+    elif args.command == "similarity":
+        find_similar_repos(students,
+                           args.student_repos,
+                           args.base_repo,
+                           args.tag_name,
+                           args.threshold)
+    elif args.command == "grade-history":
+        if args.net_id:
+            net_ids = {roster.normalize_net_id(net_id)
+                       for net_id in args.net_id}
+            students = [student for student in students
+                        if roster.normalize_net_id(student.msu_net_id)
+                        in net_ids]
+        grade_histories(students,
+                        args.student_repos,
+                        args.base_repo,
+                        args.grade_directory,
+                        args.from_ref,
+                        args.to_ref,
+                        args.every_commit)
+    elif args.command == "rescore":
+        rescore_grades(args.csv_file,
+                       args.base_repo,
+                       args.grade_directory,
+                       args.weight,
+                       args.needed_files_points,
+                       args.points_for_passing_all)
     elif args.command == "command":
         run_arbitary_command_on_repos(students,
                                       args.student_repos,
@@ -1,34 +1,42 @@
 #!/usr/bin/env python3
 """
-Converts the class list provided by MSU's Office of the Registrar to a format
-that HackerRank can use to invite candidates.
+Converts the responses to the Google Form survey to a students_info csv
+(GitHub username, MSU NetID and name of every student).
 """
 import csv
 import argparse
 
+import roster
+
 
 def convert_form_to_student_info(
         form_csv,
-        student_info_csv):
-    reader = csv.DictReader(open(form_csv, 'r'))
-    info_fieldnames = ["github_username", "msu_net_id", "full_name"]
+        student_info_csv,
+        class_list_csv=None):
+    """
+    Writes the students who gave a GitHub username. If a class list is
+    given, responses from people not on it are reported and left out and
+    students who haven't responded are reported.
+    """
+    class_roster = roster.load_roster(class_list_csv=class_list_csv,
+                                      form_csv=form_csv)
     writer = csv.DictWriter(
-        open(student_info_csv, 'w'), info_fieldnames)
+        open(student_info_csv, 'w'), roster.STUDENTS_INFO_FIELDS)
     writer.writeheader()
-    msu_net_id_to_row = {}
-    for input_row in reader:
-        msu_net_id = input_row["""MSU Net ID (without the "@msu.edu" part)"""]
-        if "@" in msu_net_id:
-            msu_net_id = msu_net_id.partition('@')[0]
-        full_name = input_row["First name"] + " " + input_row["Last name"]
-        github_username = input_row["GitHub Username"]
-
-        row = {"github_username": github_username,
-               "msu_net_id": msu_net_id,
-               "full_name": full_name}
-        msu_net_id_to_row[msu_net_id] = row
-    for row in msu_net_id_to_row.values():
+    missing_usernames = []
+    for student in class_roster:
+        if student.github_username is None:
+            missing_usernames.append(student.email)
+            continue
+        row = {"github_username": student.github_username,
+               "msu_net_id": student.msu_net_id,
+               "full_name": student.full_name}
         writer.writerow(row)
+    if missing_usernames:
+        print("{} students haven't given a GitHub username:".format(
+            len(missing_usernames)))
+        for email in missing_usernames:
+            print("  {}".format(email))
 
 
 def main():
@@ -40,10 +48,13 @@ def main():
     """)
     parser.add_argument('form_csv')
     parser.add_argument('student_info_csv')
+    parser.add_argument('--class-list', help="""
+Class list csv from the registrar, to check the responses against""")
 
     args = parser.parse_args()
     convert_form_to_student_info(args.form_csv,
-                                 args.student_info_csv)
+                                 args.student_info_csv,
+                                 args.class_list)
 
 if __name__ == "__main__":
     main()
@@ -2,8 +2,16 @@
 import csv
 import argparse
 
+import roster
 
-def convert_hackerrank_to_d2l(hackerrank_csv, d2l_csv, assignment_name, scale_factor):
+
+def convert_hackerrank_to_d2l(hackerrank_csv, d2l_csv, assignment_name, scale_factor,
+                              class_roster=None):
+    """
+    Writes a D2L grades csv. If a roster is given, every Login ID is
+    resolved through it and those that don't match a student are
+    reported (and left out) instead of guessed at.
+    """
     hr_reader = csv.DictReader(open(hackerrank_csv, 'r'))
     grade_column = assignment_name + " Points Grade"
     d2l_fieldnames = header = ("Username",
@@ -12,14 +20,23 @@ def convert_hackerrank_to_d2l(hackerrank_csv, d2l_csv, assignment_name, scale_fa
     d2l_writer = csv.DictWriter(open(d2l_csv, 'w'), fieldnames=d2l_fieldnames)
     d2l_writer.writeheader()
 
+    unmatched = []
     for row in hr_reader:
         new_row = {}
-        new_row["Username"] = row["Login ID"].split('@')[0]
+        if class_roster is None:
+            new_row["Username"] = row["Login ID"].split('@')[0]
+        else:
+            student = class_roster.find(row["Login ID"])
+            if student is None:
+                unmatched.append(row["Login ID"])
+                continue
+            new_row["Username"] = student.msu_net_id
         score  = float(row["Total score"])
         new_score = score / scale_factor
         new_row[grade_column] = new_score
         new_row["End-of-Line Indicator"] = '#'
         d2l_writer.writerow(new_row)
+    roster.report_unmatched(hackerrank_csv, unmatched)
 
 def main():
     """
@@ -33,11 +50,13 @@ def main():
     parser.add_argument('assignment_name')
     parser.add_argument('--scale_factor', default=1, type=int, help="""
     Divide Total Score by scale_factor for points for D2L""")
+    roster.add_roster_arguments(parser)
 
     args = parser.parse_args()
     convert_hackerrank_to_d2l(args.HackerRank_csv_input_file,
                                      args.D2L_csv_output_file,
-                                     args.assignment_name, args.scale_factor)
+                                     args.assignment_name, args.scale_factor,
+                                     roster.roster_from_args(args))
 
 if __name__ == "__main__":
     main()
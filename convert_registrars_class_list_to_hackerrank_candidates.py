@@ -6,22 +6,20 @@ that HackerRank can use to invite candidates.
 import csv
 import argparse
 
+import roster
+
 
 def convert_class_list(
         class_list_filename,
         hackerrank_candidate_list_filename):
-    reader = csv.DictReader(open(class_list_filename, 'r'))
+    class_roster = roster.load_roster(class_list_csv=class_list_filename)
     hackerrank_fieldnames = ["Email", "Name"]
     hackerrank_writer = csv.DictWriter(
         open(hackerrank_candidate_list_filename, 'w'), hackerrank_fieldnames)
 
     hackerrank_writer.writeheader()
-    for input_row in reader:
-        email = input_row["MSUNet_ID"] + "@msu.edu"
-        comma_name = input_row["Student_Name"]
-        last_name, comma, first_name = comma_name.partition(", ")
-        name = first_name + " " + last_name
-        hackerrank_row = {"Email": email, "Name": name}
+    for student in class_roster:
+        hackerrank_row = {"Email": student.email, "Name": student.full_name}
         hackerrank_writer.writerow(hackerrank_row)
 
 
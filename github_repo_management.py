@@ -2,81 +2,380 @@
 """
 Script to create repos and teams.
 See http://github3py.readthedocs.io/ for docs.
+
+The org is listed once (a snapshot of its repos, teams and the memberships
+that matter) and compared against the roster to make a plan, so only the
+API calls that are actually needed get made.
+--github-url points it at a GitHub Enterprise (or stand-in) server, and
+"provision --dry-run" prints the plan without making any changes.
 """
 from os import path
+import os
+import collections
+import concurrent.futures
+import hashlib
+import json
 import re
-from github3 import login
+import threading
+import time
+from github3 import login, GitHubEnterprise, GitHubError
 import csv
 import argparse
 
 REPO_SUFFIX = "-database"
 ORGANIZATION_NAME = "CSE480-MSU"
 INSTRUCTOR_BASE_REPO = "instructor-database"
+ALL_STUDENTS_TEAM = "all-students"
+INSTRUCTORS_TEAM = "Instructors"
+
+# Kinds of Action
+CREATE_REPO = "create-repo"
+CREATE_TEAM = "create-team"
+INVITE = "invite"
+ADD_REPO = "add-repo"
+EDIT_TEAM = "edit-team"
+
+# Number of API calls made at once
+NUM_WORKERS = 8
+
+# Calls left (X-RateLimit-Remaining) at which workers wait for the reset
+RATE_LIMIT_RESERVE = 10
+
+# Attempts made for an action that is rate limited or fails on the server,
+# waiting Retry-After (or RETRY_BACKOFF ** attempt) seconds between them
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF = 2
+
+# Finished actions are appended to this file (one JSON list per line),
+# so an interrupted run only makes the calls that are left. It is named
+# after the org and a digest of the roster (so a new roster starts over)
+# and deleted once a run finishes every action.
+CHECKPOINT_FILENAME = ".provisioning_checkpoint_{}_{}.jsonl"
 
+# Struc that holds the state of the org that provisioning depends on;
+# team_members and team_repos are the members and repos of the students'
+# teams (by team name)
+Inventory = collections.namedtuple('Inventory',
+                                   ['repos', 'teams', 'all_students',
+                                    'all_students_repos',
+                                    'instructor_repos', 'team_members',
+                                    'team_repos'])
 
-def get_org(org_name):
+# Struc that holds one API call of a plan. Actions run phase by phase;
+# a failed invite of a username to ALL_STUDENTS_TEAM (in the first phase)
+# cancels the later actions with that username, and a team or repo that
+# couldn't be created cancels the later actions on it.
+Action = collections.namedtuple('Action',
+                                ['phase', 'kind', 'name', 'target',
+                                 'username'])
+
+
+def get_org(org_name, github_url=None):
     with open(path.expanduser("~/.github_token"), "r") as handle:
         token = handle.read().strip()
 
-    gh = login(token=token)
+    if github_url is None:
+        gh = login(token=token)
+    else:
+        gh = GitHubEnterprise(github_url, token=token)
     return gh.organization(org_name)
 
 
-def create_student_repos(org, rows):
-    print("Creating Repos")
-    new_repo_names = {row["msu_net_id"] + REPO_SUFFIX for row in rows}
-    for repo in org.iter_repos():
-        if repo.name in new_repo_names:
-            new_repo_names.remove(repo.name)
-    print(new_repo_names)
-    for new_repo_name in new_repo_names:
-        print("Creating:" + new_repo_name)
-        org.create_repo(new_repo_name,
-                        private=True,
-                        has_issues=False,
-                        has_wiki=False)
-
-
-def create_student_teams(org, rows):
-    print("Creating Teams")
-    team_name_to_github = {
-            row["msu_net_id"]: row["github_username"]
-            for row in rows}
-    for team in org.iter_teams():
-        if team.name in team_name_to_github:
-            del team_name_to_github[team.name]
-    for team_name in team_name_to_github:
-        team = org.create_team(team_name, permission="push")
-        github_username = team_name_to_github[team_name]
-        team.invite(github_username)
-        team.add_repo(ORGANIZATION_NAME + "/" + team_name + REPO_SUFFIX)
+def take_inventory(org, student_team_names=()):
+    """
+    Lists the org's repos and teams once, along with the members and
+    repos of ALL_STUDENTS_TEAM and of the given students' teams
+    (listed concurrently) and the repos of INSTRUCTORS_TEAM.
+    """
+    repos = {repo.name: repo for repo in org.iter_repos()}
+    teams = {team.name: team for team in org.iter_teams()}
+    all_students = set()
+    all_students_repos = set()
+    if ALL_STUDENTS_TEAM in teams:
+        all_students = {member.login for member in
+                        teams[ALL_STUDENTS_TEAM].iter_members()}
+        all_students_repos = {repo.name for repo in
+                              teams[ALL_STUDENTS_TEAM].iter_repos()}
+    instructor_repos = set()
+    if INSTRUCTORS_TEAM in teams:
+        instructor_repos = {repo.name for repo in
+                            teams[INSTRUCTORS_TEAM].iter_repos()}
+
+    def list_team(team):
+        return ({member.login for member in team.iter_members()},
+                {repo.name for repo in team.iter_repos()})
+
+    student_teams = [teams[team_name] for team_name in student_team_names
+                     if team_name in teams]
+    team_members = {}
+    team_repos = {}
+    with concurrent.futures.ThreadPoolExecutor(NUM_WORKERS) as pool:
+        for team, (members, team_repo_names) in zip(
+                student_teams, pool.map(list_team, student_teams)):
+            team_members[team.name] = members
+            team_repos[team.name] = team_repo_names
+    return Inventory(repos, teams, all_students, all_students_repos,
+                     instructor_repos, team_members, team_repos)
 
 
-def create_or_add_to_all_student_team(org, rows):
+def plan_provisioning(inventory, rows):
     """
-    Returns the rows with non-existent usernames.
+    Returns the Actions needed to give every student in the rows a private
+    repo and team, membership in ALL_STUDENTS_TEAM (with read access to
+    the base repo) and to give INSTRUCTORS_TEAM admin access to every repo.
+    A student is invited to (and their repo added to) their team whenever
+    the team doesn't have them yet, so a rerun finishes what an interrupted
+    run left undone.
     """
-    for team in org.iter_teams():
-        if team.name == "all-students":
-            all_students_team = team
-            break
-    else:
-        all_students_team = org.create_team("all-students", permission="pull")
-    bad_rows = []
+    actions = []
+    for team_name, permission in ((ALL_STUDENTS_TEAM, "pull"),
+                                  (INSTRUCTORS_TEAM, "admin")):
+        if team_name not in inventory.teams:
+            actions.append(Action(0, CREATE_TEAM, team_name, permission,
+                                  None))
+    # Makes sure the Instructors team keeps admin access
+    actions.append(Action(1, EDIT_TEAM, INSTRUCTORS_TEAM, "admin", None))
     for row in rows:
         username = row["github_username"]
-        is_invited = all_students_team.invite(username)
-        if not is_invited:
-            bad_rows.append(row)
-    for repo in org.iter_repos():
-        if repo.name == INSTRUCTOR_BASE_REPO:
-            base_repo = repo
-            break
-    else:
+        if username not in inventory.all_students:
+            actions.append(Action(1, INVITE, ALL_STUDENTS_TEAM, username,
+                                  username))
+    if INSTRUCTOR_BASE_REPO not in inventory.repos:
         print("Need to manually create instructor base repo named:")
         print(INSTRUCTOR_BASE_REPO)
-    all_students_team.add_repo(base_repo)
-    return bad_rows
+    elif INSTRUCTOR_BASE_REPO not in inventory.all_students_repos:
+        actions.append(Action(1, ADD_REPO, ALL_STUDENTS_TEAM,
+                              INSTRUCTOR_BASE_REPO, None))
+
+    for repo_name in sorted(set(inventory.repos) -
+                            inventory.instructor_repos):
+        actions.append(Action(3, ADD_REPO, INSTRUCTORS_TEAM, repo_name,
+                              None))
+    for row in rows:
+        username = row["github_username"]
+        team_name = row["msu_net_id"]
+        repo_name = team_name + REPO_SUFFIX
+        if repo_name not in inventory.repos:
+            actions.append(Action(2, CREATE_REPO, repo_name, None, username))
+            actions.append(Action(3, ADD_REPO, INSTRUCTORS_TEAM, repo_name,
+                                  username))
+        if team_name not in inventory.teams:
+            actions.append(Action(2, CREATE_TEAM, team_name, "push",
+                                  username))
+        if username not in inventory.team_members.get(team_name, ()):
+            actions.append(Action(3, INVITE, team_name, username, username))
+        if repo_name not in inventory.team_repos.get(team_name, ()):
+            actions.append(Action(3, ADD_REPO, team_name, repo_name,
+                                  username))
+    return actions
+
+
+def perform_action(org, inventory, action):
+    """
+    Makes the API call for an action, returning False if it failed.
+    """
+    if action.kind == CREATE_REPO:
+        repo = org.create_repo(action.name,
+                               private=True,
+                               has_issues=False,
+                               has_wiki=False)
+        if repo is None:
+            return False
+        inventory.repos[action.name] = repo
+        return True
+    if action.kind == CREATE_TEAM:
+        team = org.create_team(action.name, permission=action.target)
+        if team is None:
+            return False
+        inventory.teams[action.name] = team
+        return True
+    team = inventory.teams.get(action.name)
+    if team is None:
+        print("Error: {} (no team named {})".format(action, action.name))
+        return False
+    if action.kind == INVITE:
+        return team.invite(action.target)
+    if action.kind == ADD_REPO:
+        return team.add_repo(org.login + "/" + action.target)
+    if action.kind == EDIT_TEAM:
+        return team.edit(team.name, permission=action.target)
+    raise ValueError("Unknown action: {}".format(action.kind))
+
+
+class RateLimiter:
+    """
+    Watches the rate limit headers of every response (as a requests
+    response hook) and makes workers wait when the limit is nearly used up
+    or the server asks them to back off (a secondary rate limit).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.remaining = None
+        self.reset = 0
+        self.pause_until = 0
+        self.limited = threading.local()
+
+    def __call__(self, response, *args, **kwargs):
+        headers = response.headers
+        now = time.time()
+        with self.lock:
+            if "X-RateLimit-Remaining" in headers:
+                self.remaining = int(headers["X-RateLimit-Remaining"])
+                self.reset = int(headers.get("X-RateLimit-Reset", 0))
+            limited = response.status_code == 429 or (
+                response.status_code == 403 and
+                ("Retry-After" in headers or self.remaining == 0 or
+                 "rate limit" in response.text.lower()))
+            if limited:
+                retry_after = headers.get("Retry-After")
+                if retry_after is not None and retry_after.isdigit():
+                    pause_until = now + int(retry_after)
+                elif self.remaining == 0:
+                    pause_until = self.reset
+                else:
+                    pause_until = now + RETRY_BACKOFF
+                self.pause_until = max(self.pause_until, pause_until)
+        self.limited.value = limited
+        return response
+
+    def wait(self):
+        """
+        Sleeps until calls may be made.
+        """
+        self.limited.value = False
+        with self.lock:
+            until = self.pause_until
+            if self.remaining is not None and \
+                    self.remaining <= RATE_LIMIT_RESERVE:
+                until = max(until, self.reset)
+        delay = until - time.time()
+        if delay > 0:
+            print("Rate limited, waiting {:.0f} seconds".format(delay))
+            time.sleep(delay)
+
+    def was_limited(self):
+        return getattr(self.limited, "value", False)
+
+
+def watch_rate_limit(org):
+    """
+    Returns a RateLimiter watching every response of the org's session.
+    """
+    rate_limiter = RateLimiter()
+    session = getattr(org, "session", None) or org._session
+    session.hooks["response"].append(rate_limiter)
+    return rate_limiter
+
+
+def perform_with_retries(org, inventory, action, rate_limiter):
+    """
+    Performs an action, retrying it when it is rate limited
+    or fails on the server.
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        rate_limiter.wait()
+        try:
+            return perform_action(org, inventory, action)
+        except GitHubError as error:
+            retry = rate_limiter.was_limited() or error.code >= 500
+            if not retry or attempt + 1 == MAX_ATTEMPTS:
+                print("Error: {} ({})".format(action, error))
+                return False
+            if not rate_limiter.was_limited():
+                time.sleep(RETRY_BACKOFF ** attempt)
+    return False
+
+
+def load_checkpoint(checkpoint_filename):
+    """
+    Returns the set of Actions finished by earlier runs.
+    """
+    if not path.exists(checkpoint_filename):
+        return set()
+    with open(checkpoint_filename, 'r') as checkpoint_handle:
+        return {Action(*json.loads(line)) for line in checkpoint_handle
+                if line.strip()}
+
+
+def get_checkpoint_filename(org, rows):
+    """
+    Returns the checkpoint file for provisioning the rows in the org.
+    """
+    roster = sorted((row["msu_net_id"], row["github_username"])
+                    for row in rows)
+    digest = hashlib.sha1(json.dumps(roster).encode()).hexdigest()[:12]
+    return CHECKPOINT_FILENAME.format(org.login, digest)
+
+
+def run_plan(org, inventory, actions, checkpoint_filename,
+             num_workers=NUM_WORKERS):
+    """
+    Runs the actions phase by phase, up to num_workers at a time, skipping
+    the ones already in the checkpoint file and adding the ones that
+    finish. The checkpoint file is deleted if every action finished.
+    Returns the usernames that couldn't be invited.
+    """
+    def is_cancelled(action):
+        return action.username in bad_usernames or \
+            action.name in failed_names or \
+            (action.kind == ADD_REPO and action.target in failed_names)
+
+    rate_limiter = watch_rate_limit(org)
+    finished = load_checkpoint(checkpoint_filename)
+    bad_usernames = set()
+    # Teams and repos that couldn't be created
+    failed_names = set()
+    failed = 0
+    phases = collections.defaultdict(list)
+    for action in actions:
+        if action not in finished:
+            phases[action.phase].append(action)
+    if len(actions) > sum(map(len, phases.values())):
+        print("Skipping {} actions finished by an earlier run".format(
+            len(actions) - sum(map(len, phases.values()))))
+
+    print_lock = threading.Lock()
+
+    def run_action(action):
+        with print_lock:
+            print("{} {} {}".format(action.kind, action.name,
+                                    action.target or ""))
+        return perform_with_retries(org, inventory, action, rate_limiter)
+
+    with open(checkpoint_filename, 'a') as checkpoint_handle, \
+            concurrent.futures.ThreadPoolExecutor(num_workers) as pool:
+        for phase in sorted(phases):
+            phase_actions = []
+            for action in phases[phase]:
+                if is_cancelled(action):
+                    failed += 1
+                    print("Cancelled: {}".format(action))
+                else:
+                    phase_actions.append(action)
+            for action, succeeded in zip(phase_actions,
+                                         pool.map(run_action, phase_actions)):
+                if succeeded:
+                    checkpoint_handle.write(json.dumps(list(action)) + "\n")
+                    checkpoint_handle.flush()
+                else:
+                    failed += 1
+                    print("Failed: {}".format(action))
+                    if action.kind == INVITE and \
+                            action.name == ALL_STUDENTS_TEAM:
+                        bad_usernames.add(action.username)
+                    elif action.kind in (CREATE_TEAM, CREATE_REPO):
+                        failed_names.add(action.name)
+    if not failed and not bad_usernames:
+        os.remove(checkpoint_filename)
+    return bad_usernames
+
+
+def print_plan(actions):
+    for action in sorted(actions, key=lambda action: action.phase):
+        print("{} {} {}".format(action.kind, action.name,
+                                action.target or ""))
+    print("{} actions planned".format(len(actions)))
 
 
 def delete_repos_and_teams(org, except_list=None):
@@ -92,23 +391,11 @@ def delete_repos_and_teams(org, except_list=None):
             team.delete()
 
 
-def print_repos_and_teams(org):
-    for team in org.iter_teams():
-        print("TEAM: {}".format(team.name))
-    for repo in org.iter_repos():
-        print("REPO: {}".format(repo.name))
-
-
-def add_instructors_to_every_repo(org):
-    for team in org.iter_teams():
-        if team.name == "Instructors":
-            instructor_team = team
-            break
-    else:
-        instructor_team = org.create_team("Instructors", permission="admin")
-    for repo in org.iter_repos():
-        instructor_team.add_repo(repo)
-    instructor_team.edit(instructor_team.name, permission="admin")
+def print_repos_and_teams(inventory):
+    for team_name in sorted(inventory.teams):
+        print("TEAM: {}".format(team_name))
+    for repo_name in sorted(inventory.repos):
+        print("REPO: {}".format(repo_name))
 
 
 def load_github_usernames(student_info_csv):
@@ -117,41 +404,30 @@ def load_github_usernames(student_info_csv):
     return rows
 
 
-def main():
-    parser = argparse.ArgumentParser(description="""
-    Script for making GitHub private repos for a class.
-    Not for normal use (see nahumjos@msu.edu for instruction).
-    """)
-    parser.add_argument('student_info_csv')
-    args = parser.parse_args()
-    rows = load_github_usernames(args.student_info_csv)
-    org = get_org(ORGANIZATION_NAME)
-
-    bad_usernnames_rows = create_or_add_to_all_student_team(org, rows)
-    all_usernames = {row["github_username"] for row in rows}
-    bad_usernnames = {row["github_username"] for row in bad_usernnames_rows}
+def provision(org, rows, dry_run=False, num_workers=NUM_WORKERS):
+    inventory = take_inventory(org, [row["msu_net_id"] for row in rows])
+    actions = plan_provisioning(inventory, rows)
+    if dry_run:
+        print_plan(actions)
+        return
+    bad_usernames = run_plan(org, inventory, actions,
+                             get_checkpoint_filename(org, rows),
+                             num_workers)
     print("Bad Username Rows:")
-    for row in bad_usernnames_rows:
-        print(row)
+    for row in rows:
+        if row["github_username"] in bad_usernames:
+            print(row)
     print("Done with Bad Usernames")
-    good_usernames = all_usernames - bad_usernnames
-    good_rows = [row for row in rows
-                 if row["github_username"] in good_usernames]
-    print("Good Rows")
-    print(good_rows)
-    create_student_repos(org, good_rows)
-    create_student_teams(org, good_rows)
-    add_instructors_to_every_repo(org)
-    print_repos_and_teams(org)
-
-
-def delete_main():
+    print_repos_and_teams(inventory)
+
+
+def delete_main(org):
     print("Deleting")
-    org = get_org(ORGANIZATION_NAME)
-    print_repos_and_teams(org)
-    except_list = {"Instructors"}
-    for team in org.iter_teams():
-        if team.name not in except_list:
+    inventory = take_inventory(org)
+    print_repos_and_teams(inventory)
+    except_list = {INSTRUCTORS_TEAM}
+    for team_name, team in inventory.teams.items():
+        if team_name not in except_list:
             print(team)
             team.delete()
     # delete_repos_and_teams(
@@ -162,5 +438,40 @@ def delete_main():
     # print_repos_and_teams(org)
 
 
+def main():
+    parser = argparse.ArgumentParser(description="""
+    Script for making GitHub private repos for a class.
+    Not for normal use (see nahumjos@msu.edu for instruction).
+    """)
+    parser.add_argument('--github-url', help="""
+URL of a GitHub Enterprise (or test) server to use instead of github.com""")
+    parser.add_argument('--org', default=ORGANIZATION_NAME)
+    subparsers = parser.add_subparsers(dest='command', help='commands')
+
+    provision_parser = subparsers.add_parser("provision", help="""
+Creates the missing repos, teams and invitations for the students""")
+    provision_parser.add_argument('student_info_csv')
+    provision_parser.add_argument('--dry-run', action='store_true', help="""
+Only prints the API calls that would be made""")
+    provision_parser.add_argument('--workers', type=int, default=NUM_WORKERS,
+                                  help="Number of API calls made at once")
+
+    subparsers.add_parser("list", help="Prints the org's teams and repos")
+    subparsers.add_parser("delete", help="""
+Deletes every team except the Instructors team""")
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error("a command is required")
+    org = get_org(args.org, args.github_url)
+    if args.command == "provision":
+        rows = load_github_usernames(args.student_info_csv)
+        provision(org, rows, args.dry_run, args.workers)
+    elif args.command == "list":
+        print_repos_and_teams(take_inventory(org))
+    elif args.command == "delete":
+        delete_main(org)
+
+
 if __name__ == "__main__":
-    delete_main()
+    main()
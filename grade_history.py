@@ -0,0 +1,282 @@
+"""
+The purpose of this module is to grade a student's commit history
+without running the test suite on every commit.
+Suite results are cached by the tree of the graded directory (so commits
+that didn't change it, in this run or any later one, share one result)
+and the first commit that every test and category passes at is found by
+bisection, which takes O(log n) suite runs instead of n.
+"""
+import collections
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import subprocess
+
+import run_tests
+
+HISTORY_CACHE_DIR = ".grade_history_cache"
+
+# Cache key of commits that don't have the graded directory
+MISSING_TREE = "missing"
+
+# Result written for commits the suite couldn't be run on
+UNGRADED = "ungraded"
+
+# Lines of the machine mode output that aren't tests
+RESULT_NAMES = ["grade", "extra_credit"]
+
+# Struc that holds a commit of a student's history; tree is the id of the
+# graded directory's tree at the commit (None if it doesn't have it)
+Commit = collections.namedtuple('Commit',
+                                ['commit_id', 'commit_time', 'tree'])
+
+# Struc that holds a test or a category (a group of tests that must all
+# pass) to find the first passing commit of
+Target = collections.namedtuple('Target', ['name', 'tests'])
+
+# Struc that holds the first commit a target passes at (and keeps passing
+# at, as far as the graded commits show)
+FirstPass = collections.namedtuple('FirstPass', ['target', 'commit'])
+
+
+def get_tree_path(grade_directory):
+    path = os.path.normpath(grade_directory)
+    return "" if path == "." else path
+
+
+def list_commits(repo_path, from_ref, to_ref, grade_directory):
+    """
+    Returns the commits from from_ref to to_ref (both included, oldest
+    first, following first parents so the history is a line).
+    """
+    def log(*revisions):
+        output = subprocess.check_output(
+            ["git", "log", "--first-parent", "--format=%H %ct"] +
+            list(revisions) + ["--"],
+            cwd=repo_path, universal_newlines=True)
+        return [line.split() for line in output.splitlines()]
+
+    entries = log("--no-walk", from_ref) + list(reversed(
+        log("{}..{}".format(from_ref, to_ref))))
+
+    tree_path = get_tree_path(grade_directory)
+    objects = "".join("{}:{}\n".format(commit_id, tree_path)
+                      for commit_id, _ in entries)
+    output = subprocess.check_output(
+        ["git", "cat-file", "--batch-check"],
+        cwd=repo_path, input=objects, universal_newlines=True)
+    trees = []
+    for line in output.splitlines():
+        object_id, object_type = line.split()[:2]
+        trees.append(object_id if object_type == "tree" else None)
+    return [Commit(commit_id, int(commit_time), tree)
+            for (commit_id, commit_time), tree in zip(entries, trees)]
+
+
+def get_suite_key(base_tested_dir, in_tested_dir_needs):
+    """
+    Returns a digest identifying the tests, their performance calibration
+    and the scripts that run them (cached results are only reused
+    while it stays the same).
+    """
+    digest = hashlib.sha1()
+    for path in in_tested_dir_needs:
+        full_path = os.path.join(base_tested_dir, path)
+        if os.path.isdir(full_path):
+            digest.update(run_tests.get_suite_version(full_path).encode())
+            calibration_path = os.path.join(full_path,
+                                            run_tests.CALIBRATION_FILENAME)
+            with contextlib.suppress(OSError):
+                with open(calibration_path, 'rb') as file_handle:
+                    digest.update(file_handle.read())
+        else:
+            with open(full_path, 'rb') as file_handle:
+                digest.update(file_handle.read())
+    return digest.hexdigest()
+
+
+def get_category_targets(test_suite_folder):
+    """
+    Returns a Target for every category (and extra credit category)
+    in the Test_Suite's points.txt, with its tests by file name
+    (as they are named in the machine mode output).
+    """
+    manifest = run_tests.compile_manifest(test_suite_folder, version=None)
+    return [Target("category " + os.path.relpath(category.pattern,
+                                                 test_suite_folder),
+                   [os.path.basename(manifest.tests[index])
+                    for index in category.tests])
+            for category in manifest.categories + manifest.extra_categories
+            if category.tests]
+
+
+class ResultCache:
+    """
+    Suite results by the tree they were graded at, one file per tree
+    (so several graders can share the cache), kept apart for each
+    version of the suite.
+    """
+
+    def __init__(self, suite_key, cache_dir=HISTORY_CACHE_DIR):
+        self.directory = os.path.join(cache_dir, suite_key)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def get_path(self, tree):
+        return os.path.join(self.directory, tree + ".json")
+
+    def get(self, tree):
+        """
+        Returns the cached (test, score) pairs (None if there aren't any).
+        """
+        try:
+            with open(self.get_path(tree), 'r') as file_handle:
+                return [tuple(pair) for pair in json.load(file_handle)]
+        except (OSError, ValueError):
+            return None
+
+    def put(self, tree, test_to_scores):
+        path = self.get_path(tree)
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(temp_path, 'w') as file_handle:
+                json.dump(test_to_scores, file_handle)
+            os.replace(temp_path, path)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+
+
+class HistoryGrader:
+    """
+    Grades the commits of a history on demand. The suite is only run
+    (through run_suite, which takes a Commit and returns its (test, score)
+    pairs, or None if the commit can't be graded) for trees that aren't
+    cached. Commits that can't be graded are skipped when bisecting.
+    """
+
+    def __init__(self, commits, run_suite, cache):
+        self.commits = commits
+        self.run_suite = run_suite
+        self.cache = cache
+        self.results = {}
+        self.ungraded = set()
+        self.runs = 0
+
+    def get_cached(self, index):
+        """
+        Returns the results of the commit if they are known without
+        running the suite (None otherwise).
+        """
+        if index not in self.results:
+            tree = self.commits[index].tree or MISSING_TREE
+            test_to_scores = self.cache.get(tree)
+            if test_to_scores is None:
+                return None
+            self.results[index] = collections.OrderedDict(test_to_scores)
+        return self.results[index]
+
+    def grade(self, index):
+        """
+        Returns the results of the commit (None if it can't be graded).
+        """
+        if index in self.ungraded:
+            return None
+        results = self.get_cached(index)
+        if results is None:
+            commit = self.commits[index]
+            test_to_scores = self.run_suite(commit)
+            self.runs += 1
+            if test_to_scores is None:
+                self.ungraded.add(index)
+                return None
+            self.cache.put(commit.tree or MISSING_TREE, test_to_scores)
+            results = self.results[index] = collections.OrderedDict(
+                test_to_scores)
+        return results
+
+    def find_graded(self, indices):
+        """
+        Returns the first of the indices whose commit can be graded
+        (None if none of them can).
+        """
+        for index in indices:
+            if self.grade(index) is not None:
+                return index
+        return None
+
+    def passes(self, index, target):
+        results = self.grade(index)
+        return all(results.get(test, 0) >= 1 for test in target.tests)
+
+    def find_first_pass(self, target):
+        """
+        Returns the index of the first graded commit the target passes at
+        (None if it doesn't pass at the last graded commit).
+        The commits graded so far narrow the range before bisecting it:
+        the target passes from high on and fails at low.
+        """
+        high = self.find_graded(reversed(range(len(self.commits))))
+        if high is None or not self.passes(high, target):
+            return None
+        low = -1
+        for index in sorted(self.results, reverse=True):
+            if index > high:
+                continue
+            if self.passes(index, target):
+                high = index
+            else:
+                low = index
+                break
+        while high - low > 1:
+            center = (low + high) / 2
+            middle = self.find_graded(sorted(
+                range(low + 1, high), key=lambda index: abs(index - center)))
+            if middle is None:
+                break
+            if self.passes(middle, target):
+                high = middle
+            else:
+                low = middle
+        return high
+
+
+def grade_history(commits, run_suite, cache, category_targets,
+                  every_commit=False):
+    """
+    Grades the first and last commits, bisects for the first passing
+    commit of every category and test and returns the timeline (the
+    (Commit, results) of every commit whose results are known, the
+    results are None if the commit couldn't be graded), the FirstPasses
+    (in commit order) and the number of suite runs.
+    If every_commit is True, every commit is graded.
+    """
+    grader = HistoryGrader(commits, run_suite, cache)
+    last = len(commits) - 1
+    for index in (range(len(commits)) if every_commit else [0, last]):
+        grader.grade(index)
+
+    last_graded = grader.find_graded(reversed(range(len(commits))))
+    targets = list(category_targets)
+    if last_graded is not None:
+        targets += [Target(test, [test]) for test in grader.grade(last_graded)
+                    if test not in RESULT_NAMES]
+    index_to_targets = collections.defaultdict(list)
+    for target in targets:
+        index = grader.find_first_pass(target)
+        if index is not None:
+            index_to_targets[index].append(target.name)
+    first_passes = [FirstPass(name, commits[index])
+                    for index in sorted(index_to_targets)
+                    for name in index_to_targets[index]]
+
+    timeline = [(commit, grader.grade(index))
+                for index, commit in enumerate(commits)
+                if index in grader.ungraded or
+                grader.get_cached(index) is not None]
+    return timeline, first_passes, grader.runs
+
+
+def format_commit_time(commit):
+    return datetime.datetime.fromtimestamp(commit.commit_time).isoformat()
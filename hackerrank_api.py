@@ -1,9 +1,15 @@
-import requests
+#!/usr/bin/env python3
+"""
+The purpose of this module is to download results from HackerRank.
+"""
+import argparse
 import os.path
-from pprint import pprint
-import os
+import pprint
 import string
 
+import hackerrank_client
+import hackerrank_store
+
 
 def sanitize(input_):
     allowed_chars = string.ascii_letters + string.digits
@@ -11,42 +17,113 @@ def sanitize(input_):
     return "".join(letters)
 
 
-output_filename = "output.html"
-
-with open(os.path.expanduser("~/.hackerrank_token")) as ht:
-    token = ht.read().strip()
-base_url = 'https://www.hackerrank.com/x/api/v2'
-
-test_url = "/tests"
-payload = {'access_token': token}
-r = requests.get(base_url + test_url, params=payload)
-response = r.json()
-tests = response['data']
-id_names = {test["name"]: test["id"] for test in tests}
-# print(id_names)
-test_name = "CSE480 Homework #9"
-test_id = id_names[test_name]
-
-test_results_url = "/tests/" + str(test_id) + "/candidates/"
-payload = {'access_token': token}
-r = requests.get(base_url + test_results_url, params=payload)
-response = r.json()
-completed = response['data']
-# pprint(completed)
-
-test_name = sanitize(test_name)
-os.makedirs(test_name, exist_ok=True)
-
-email_to_response = {}
-for student in completed:
-    email = student["email"]
-    student_folder = os.path.join(test_name, email)
-    os.makedirs(student_folder, exist_ok=True)
-    if "questions" not in student:
-        break
-    for question_number, question in enumerate(student["questions"]):
-        solution = question["answer"]
-        solution_path = os.path.join(student_folder,
-                                     "q" + str(question_number + 1) + ".txt")
-        with open(solution_path, "w") as file_handle:
-            file_handle.writelines(solution)
+def list_tests(client):
+    for test in client.get_tests():
+        print("{}\t{}".format(test["id"], test["name"]))
+
+
+def export_answers(client, test_name, output_dir="."):
+    """
+    Writes every candidate's answer to question N to
+    <test name>/<email>/q<N>.txt.
+    """
+    test_id = client.get_test_id(test_name)
+    candidates = client.get_candidates(test_id)
+    test_folder = os.path.join(output_dir, sanitize(test_name))
+    os.makedirs(test_folder, exist_ok=True)
+    for candidate in candidates:
+        if "questions" not in candidate:
+            continue
+        student_folder = os.path.join(test_folder, candidate["email"])
+        os.makedirs(student_folder, exist_ok=True)
+        for question_number, question in enumerate(candidate["questions"]):
+            solution_path = os.path.join(
+                student_folder, "q" + str(question_number + 1) + ".txt")
+            with open(solution_path, "w") as file_handle:
+                file_handle.write(question["answer"] or "")
+    print("Exported {} candidates to {}".format(len(candidates), test_folder))
+
+
+def show_candidate(client, test_name, email):
+    """
+    Prints the score and answer of each of a candidate's questions.
+    """
+    test_id = client.get_test_id(test_name)
+    for candidate in client.get_candidates(test_id):
+        if candidate["email"] == email:
+            for question in candidate.get("questions", []):
+                print("Score: {}".format(question["score"]))
+                print(question["answer"])
+            return
+    print("No candidate with email {}".format(email))
+
+
+def sync_answers(client, store_path, test_names, output_dir="."):
+    """
+    Updates the store and answer files of each test, only fetching
+    candidates whose attempts changed since the last sync.
+    """
+    connection = hackerrank_store.open_store(store_path)
+    try:
+        for test_name in test_names:
+            test_folder = os.path.join(output_dir, sanitize(test_name))
+            fetched, written = hackerrank_store.sync_test(
+                client, connection, test_name, test_folder)
+            print("{}: fetched {} changed candidates, wrote {} answer "
+                  "files".format(test_name, fetched, written))
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""
+    Downloads tests and candidate answers from HackerRank.""")
+    parser.add_argument('--base-url', default=hackerrank_client.BASE_URL)
+    parser.add_argument('--token-file',
+                        default=hackerrank_client.TOKEN_FILENAME)
+    parser.add_argument('--cache-dir',
+                        default=hackerrank_client.CACHE_DIRECTORY, help="""
+Directory where responses are cached""")
+    parser.add_argument('--no-cache', action='store_true')
+    subparsers = parser.add_subparsers(dest='command', help='commands')
+
+    subparsers.add_parser("tests", help="Lists the tests and their ids")
+
+    export = subparsers.add_parser("export", help="""
+Writes every candidate's answers to <test name>/<email>/q<N>.txt""")
+    export.add_argument('test_name', help='e.g. "CSE480 Homework #9"')
+    export.add_argument('--output-dir', default=".")
+
+    show = subparsers.add_parser("show", help="""
+Prints a candidate's score and answer for each question""")
+    show.add_argument('test_name')
+    show.add_argument('email')
+
+    sync = subparsers.add_parser("sync", help="""
+Like export, but keeps the results in a local store so only candidates
+whose attempts changed are fetched and only changed answers are written""")
+    sync.add_argument('test_names', nargs='+', metavar='test_name')
+    sync.add_argument('--output-dir', default=".")
+    sync.add_argument('--store', default=hackerrank_store.DEFAULT_STORE,
+                      help="Path to the store (sqlite) file")
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error("a command is required")
+    client = hackerrank_client.HackerRankClient(
+        hackerrank_client.read_token(args.token_file), args.base_url,
+        None if args.no_cache else args.cache_dir)
+    with client:
+        if args.command == "tests":
+            list_tests(client)
+        elif args.command == "export":
+            export_answers(client, args.test_name, args.output_dir)
+        elif args.command == "show":
+            show_candidate(client, args.test_name, args.email)
+        elif args.command == "sync":
+            sync_answers(client, args.store, args.test_names,
+                         args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
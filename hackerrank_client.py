@@ -0,0 +1,208 @@
+"""
+The purpose of this module is to talk to the HackerRank for Work API.
+A single session (so connections are reused) fetches every page of a
+listing, with the pages after the first fetched concurrently under a
+rate limit. Responses are cached on disk and revalidated with conditional
+requests, so unchanged data is never downloaded twice.
+The base URL can point the client at any server with the same API
+(see hackerrank_api.py --base-url).
+"""
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+
+BASE_URL = "https://www.hackerrank.com/x/api/v3"
+TOKEN_FILENAME = os.path.expanduser("~/.hackerrank_token")
+CACHE_DIRECTORY = os.path.expanduser("~/.hackerrank_cache")
+
+# Largest page the API returns
+PAGE_SIZE = 100
+
+NUM_WORKERS = 8
+REQUESTS_PER_SECOND = 5
+REQUEST_TIMEOUT = 60
+
+# Attempts made for a request that is rate limited (429) or fails (5xx),
+# waiting RETRY_BACKOFF ** attempt seconds (or Retry-After) between them
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF = 2
+
+
+class HackerRankError(Exception):
+    pass
+
+
+def read_token(filename=TOKEN_FILENAME):
+    with open(filename) as token_handle:
+        return token_handle.read().strip()
+
+
+class RateLimiter:
+    """
+    Spaces calls to wait() at least 1 / rate seconds apart
+    across threads.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class ResponseCache:
+    """
+    Stores response bodies on disk along with their validators
+    (ETag and Last-Modified).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, url, params):
+        key = json.dumps([url, sorted((params or {}).items())])
+        return os.path.join(self.directory,
+                            hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+    def load(self, url, params):
+        """
+        Returns the cached entry (a dict with "etag", "last_modified" and
+        "body") or None.
+        """
+        if self.directory is None:
+            return None
+        try:
+            with open(self.get_path(url, params), 'r') as cache_handle:
+                return json.load(cache_handle)
+        except (OSError, ValueError):
+            return None
+
+    def store(self, url, params, response):
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if self.directory is None or not (etag or last_modified):
+            return
+        path = self.get_path(url, params)
+        temp_path = "{}.{}".format(path, threading.get_ident())
+        with open(temp_path, 'w') as cache_handle:
+            json.dump({"etag": etag, "last_modified": last_modified,
+                       "body": response.json()}, cache_handle)
+        os.replace(temp_path, path)
+
+
+class HackerRankClient:
+    """
+    A client for the HackerRank for Work API.
+    """
+
+    def __init__(self, token=None, base_url=BASE_URL,
+                 cache_directory=CACHE_DIRECTORY,
+                 requests_per_second=REQUESTS_PER_SECOND,
+                 num_workers=NUM_WORKERS):
+        if token is None:
+            token = read_token()
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = token
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=num_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.cache = ResponseCache(cache_directory)
+        self.num_workers = num_workers
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, path, params=None):
+        """
+        Returns the decoded JSON at the path, revalidating any cached copy.
+        """
+        url = self.base_url + path
+        cached = self.cache.load(url, params)
+        headers = {}
+        if cached is not None:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+        for attempt in range(MAX_ATTEMPTS):
+            self.rate_limiter.wait()
+            response = self.session.get(url, params=params, headers=headers,
+                                        timeout=REQUEST_TIMEOUT)
+            if response.status_code == 304 and cached is not None:
+                return cached["body"]
+            if response.status_code == 429 or response.status_code >= 500:
+                delay = response.headers.get("Retry-After")
+                time.sleep(float(delay) if delay and delay.isdigit()
+                           else RETRY_BACKOFF ** attempt)
+                continue
+            if response.status_code != 200:
+                raise HackerRankError("GET {} returned {}: {}".format(
+                    path, response.status_code, response.text[:200]))
+            self.cache.store(url, params, response)
+            return response.json()
+        raise HackerRankError("GET {} kept failing with {}".format(
+            path, response.status_code))
+
+    def get_all(self, path, params=None):
+        """
+        Returns the records from every page of a listing.
+        The first page gives the total, the rest are fetched concurrently.
+        """
+        params = dict(params or {}, limit=PAGE_SIZE, offset=0)
+        first_page = self.get(path, params)
+        records = list(first_page["data"])
+        total = first_page.get("total", len(records))
+        # The server may return smaller pages than asked for
+        page_size = len(records)
+        offsets = range(page_size, total, page_size) if page_size else []
+        with concurrent.futures.ThreadPoolExecutor(self.num_workers) as pool:
+            pages = pool.map(
+                lambda offset: self.get(path, dict(params, offset=offset)),
+                offsets)
+            for page in pages:
+                records += page["data"]
+        return records
+
+    def get_tests(self):
+        return self.get_all("/tests")
+
+    def get_test_id(self, test_name):
+        for test in self.get_tests():
+            if test["name"] == test_name:
+                return test["id"]
+        raise HackerRankError("No test named {}".format(test_name))
+
+    def get_candidates(self, test_id, fields=None):
+        """
+        Returns every candidate of a test
+        (only the given fields, if any, to keep the pages small).
+        """
+        params = {"fields": ",".join(fields)} if fields else None
+        return self.get_all("/tests/{}/candidates".format(test_id), params)
+
+    def get_candidate(self, test_id, candidate_id):
+        return self.get("/tests/{}/candidates/{}".format(test_id,
+                                                         candidate_id))
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+The purpose of this module is to regrade downloaded HackerRank answers
+locally (see hackerrank_api.py export).
+Every candidate's <email>/q<N>.txt answer is run on each of the
+instructor's q<N>/*input.txt tests (as stdin) and passes a test if its
+output matches the test's correct.txt exactly (the same diff run_tests.py
+uses). The per-question scores are written as a csv that
+convert_hackerrank_to_d2l.py can read.
+"""
+import argparse
+import csv
+import glob
+import multiprocessing
+import os
+import re
+import shlex
+import subprocess
+
+import run_single_test
+import run_tests
+
+DEFAULT_INTERPRETER = "python3"
+TEST_TIMEOUT = 10
+NUM_POOL_WORKERS = 8
+
+# Points for a question not listed in the tests' points.txt
+DEFAULT_QUESTION_POINTS = 1
+
+ANSWER_PATTERN = re.compile(r"^q(\d+)\.txt$")
+QUESTION_PATTERN = re.compile(r"^q(\d+)$")
+
+
+def get_questions(tests_dir):
+    """
+    Returns a dict from question number to its (sorted) input files.
+    """
+    questions = {}
+    for name in os.listdir(tests_dir):
+        match = QUESTION_PATTERN.match(name)
+        if match:
+            questions[int(match.group(1))] = sorted(glob.glob(
+                os.path.join(tests_dir, name, "*input.txt")))
+    return questions
+
+
+def get_question_points(tests_dir, questions):
+    """
+    Returns a dict from question number to its points
+    (from points.txt lines like "q1 10" if there is one).
+    """
+    question_points = dict.fromkeys(questions, DEFAULT_QUESTION_POINTS)
+    if os.path.exists(os.path.join(tests_dir, run_tests.POINTS_FILENAME)):
+        for path, points, _ in run_tests.read_points(tests_dir):
+            match = QUESTION_PATTERN.match(os.path.basename(path))
+            if match and int(match.group(1)) in question_points:
+                question_points[int(match.group(1))] = points
+    return question_points
+
+
+def get_answers(answers_dir):
+    """
+    Returns a dict from each candidate (email) to a dict from question
+    number to the path of their answer.
+    """
+    candidates = {}
+    for email in sorted(os.listdir(answers_dir)):
+        candidate_dir = os.path.join(answers_dir, email)
+        if not os.path.isdir(candidate_dir):
+            continue
+        candidates[email] = {
+            int(match.group(1)): os.path.join(candidate_dir, name)
+            for name in os.listdir(candidate_dir)
+            for match in [ANSWER_PATTERN.match(name)] if match}
+    return candidates
+
+
+def run_answer(arg):
+    """
+    Takes (email, question, answer path, input path, interpreter, timeout)
+    and returns (email, question, passed).
+    """
+    email, question, answer_path, input_path, interpreter, timeout = arg
+    correct_output = run_single_test.get_correct_output(input_path)
+    args = shlex.split(interpreter) + [os.path.abspath(answer_path)]
+    with run_single_test.scratch_directory() as scratch_dir, \
+            open(input_path, 'r') as input_handle:
+        try:
+            # Only stdout is compared, so warnings don't fail an answer
+            output, returncode, _ = run_tests.capture_output(
+                args, timeout=timeout, stdin=input_handle, cwd=scratch_dir,
+                stderr=subprocess.DEVNULL)
+        except (subprocess.TimeoutExpired,
+                run_tests.OutputLimitExceeded, OSError):
+            return email, question, False
+    passed = not returncode and not run_tests.get_diff(correct_output,
+                                                       output)
+    return email, question, passed
+
+
+def regrade(answers_dir, tests_dir, interpreter=DEFAULT_INTERPRETER,
+            timeout=TEST_TIMEOUT):
+    """
+    Returns the question numbers and a dict from each candidate to their
+    score on each question.
+    """
+    questions = get_questions(tests_dir)
+    question_points = get_question_points(tests_dir, questions)
+    candidates = get_answers(answers_dir)
+    args = [(email, question, answers[question], input_path, interpreter,
+             timeout)
+            for email, answers in candidates.items()
+            for question, input_paths in questions.items()
+            if question in answers
+            for input_path in input_paths]
+    with multiprocessing.Pool(NUM_POOL_WORKERS) as pool:
+        results = pool.map(run_answer, args, chunksize=4)
+
+    passes = {email: dict.fromkeys(questions, 0) for email in candidates}
+    for email, question, passed in results:
+        passes[email][question] += passed
+    scores = {
+        email: {question: (question_points[question] *
+                           question_passes[question] /
+                           len(questions[question])
+                           if questions[question] else 0)
+                for question in questions}
+        for email, question_passes in passes.items()}
+    return sorted(questions), scores
+
+
+def write_scores(questions, scores, output_csv):
+    """
+    Writes a "Login ID", q<N>..., "Total score" row for every candidate.
+    """
+    with open(output_csv, 'w') as csv_handle:
+        writer = csv.writer(csv_handle)
+        writer.writerow(["Login ID"] +
+                        ["q{}".format(question) for question in questions] +
+                        ["Total score"])
+        for email, question_scores in sorted(scores.items()):
+            row = [round(question_scores[question], 2)
+                   for question in questions]
+            writer.writerow([email] + row +
+                            [round(sum(question_scores.values()), 2)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""
+    Regrades downloaded HackerRank answers (<answers_dir>/<email>/q<N>.txt)
+    against the tests in <tests_dir>/q<N>/ (each *input.txt is given as
+    stdin and the output must match its *correct.txt). An optional
+    <tests_dir>/points.txt gives each question's points ("q1 10").""")
+    parser.add_argument('answers_dir')
+    parser.add_argument('tests_dir')
+    parser.add_argument('output_csv')
+    parser.add_argument('--interpreter', default=DEFAULT_INTERPRETER,
+                        help="Command the answers are run with")
+    parser.add_argument('--timeout', type=float, default=TEST_TIMEOUT,
+                        help="Seconds before an answer is killed")
+    args = parser.parse_args()
+
+    questions, scores = regrade(args.answers_dir, args.tests_dir,
+                                args.interpreter, args.timeout)
+    write_scores(questions, scores, args.output_csv)
+    print("Regraded {} candidates on {} questions".format(len(scores),
+                                                          len(questions)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+The purpose of this module is to keep a local copy of HackerRank results.
+Tests, candidates and per-question answers and scores are stored in an
+sqlite database. A sync lists the candidates (only the fields needed to
+tell whether an attempt changed) and fetches the full record of just the
+candidates that changed since the last sync, and answer files are only
+rewritten when their contents change.
+"""
+import concurrent.futures
+import hashlib
+import os
+import sqlite3
+
+DEFAULT_STORE = "hackerrank.sqlite"
+
+# Fields listed for every candidate; a candidate is refetched when any of
+# them differ from the stored values
+SUMMARY_FIELDS = ["id", "email", "attempt_endtime", "score"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tests (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS candidates (
+    test_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    email TEXT NOT NULL,
+    attempt_endtime TEXT,
+    score REAL,
+    PRIMARY KEY (test_id, id));
+CREATE INDEX IF NOT EXISTS candidates_by_email
+    ON candidates (email, test_id);
+CREATE TABLE IF NOT EXISTS answers (
+    test_id INTEGER NOT NULL,
+    candidate_id INTEGER NOT NULL,
+    question_number INTEGER NOT NULL,
+    score REAL,
+    answer TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (test_id, candidate_id, question_number));
+"""
+
+
+def open_store(store_path):
+    connection = sqlite3.connect(store_path)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def get_changed_candidates(connection, test_id, summaries):
+    """
+    Returns the summaries of candidates that are new or whose
+    attempt changed since the last sync.
+    """
+    stored = {row[0]: row[1:] for row in connection.execute(
+        "SELECT id, email, attempt_endtime, score FROM candidates "
+        "WHERE test_id = ?", (test_id,))}
+    return [summary for summary in summaries
+            if stored.get(summary["id"]) !=
+            (summary["email"], summary.get("attempt_endtime"),
+             summary.get("score"))]
+
+
+def write_answer_if_changed(path, answer):
+    """
+    Writes the answer unless the file already holds it.
+    Returns True if the file was written.
+    """
+    try:
+        with open(path, 'r') as file_handle:
+            if file_handle.read() == answer:
+                return False
+    except FileNotFoundError:
+        pass
+    with open(path, 'w') as file_handle:
+        file_handle.write(answer)
+    return True
+
+
+def store_candidate(connection, test_id, candidate, test_folder):
+    """
+    Stores a full candidate record (every question's score, even when its
+    answer didn't change), writing the answer files that changed.
+    Returns the number of answer files written.
+    """
+    connection.execute(
+        "INSERT OR REPLACE INTO candidates (test_id, id, email, "
+        "attempt_endtime, score) VALUES (?, ?, ?, ?, ?)",
+        (test_id, candidate["id"], candidate["email"],
+         candidate.get("attempt_endtime"), candidate.get("score")))
+    stored = dict(connection.execute(
+        "SELECT question_number, digest FROM answers "
+        "WHERE test_id = ? AND candidate_id = ?",
+        (test_id, candidate["id"])))
+    student_folder = os.path.join(test_folder, candidate["email"])
+    written = 0
+    for question_number, question in enumerate(
+            candidate.get("questions", []), 1):
+        answer = question["answer"] or ""
+        digest = hashlib.sha1(answer.encode()).hexdigest()
+        path = os.path.join(student_folder,
+                            "q" + str(question_number) + ".txt")
+        if stored.get(question_number) == digest:
+            # The answer is the same but it may have been regraded
+            connection.execute(
+                "UPDATE answers SET score = ? WHERE test_id = ? AND "
+                "candidate_id = ? AND question_number = ?",
+                (question.get("score"), test_id, candidate["id"],
+                 question_number))
+            if os.path.exists(path):
+                continue
+        else:
+            connection.execute(
+                "INSERT OR REPLACE INTO answers (test_id, candidate_id, "
+                "question_number, score, answer, digest) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (test_id, candidate["id"], question_number,
+                 question.get("score"), answer, digest))
+        os.makedirs(student_folder, exist_ok=True)
+        written += write_answer_if_changed(path, answer)
+    return written
+
+
+def sync_test(client, connection, test_name, test_folder):
+    """
+    Brings the store and the answer files (in test_folder) of a test
+    up to date.
+    Returns the number of candidates fetched and answer files written.
+    """
+    test_id = client.get_test_id(test_name)
+    with connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO tests (id, name) VALUES (?, ?)",
+            (test_id, test_name))
+    summaries = client.get_candidates(test_id, SUMMARY_FIELDS)
+    changed = get_changed_candidates(connection, test_id, summaries)
+    written = 0
+    with concurrent.futures.ThreadPoolExecutor(client.num_workers) as pool:
+        candidates = pool.map(
+            lambda summary: client.get_candidate(test_id, summary["id"]),
+            changed)
+        for candidate in candidates:
+            with connection:
+                written += store_candidate(connection, test_id, candidate,
+                                           test_folder)
+    return len(changed), written
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+A Python client for the MOSS (Measure Of Software Similarity) service,
+speaking the same protocol as the vendored moss script.
+Uploads are written through a large buffer without waiting on the server
+between files, byte-identical submissions are only sent once (and
+reported as exact matches) and dropped connections are retried.
+--server and --port point it at any server speaking the protocol
+(i.e. a local stand-in when trying out changes).
+"""
+import argparse
+import collections
+import hashlib
+import os
+import socket
+import sys
+import time
+
+MOSS_SERVER = "moss.stanford.edu"
+MOSS_PORT = 7690
+
+# The userid is read from this file when it exists
+USERID_FILENAME = os.path.expanduser("~/.moss_userid")
+DEFAULT_USERID = 413351695
+
+LANGUAGES = ["c", "cc", "java", "ml", "pascal", "ada", "lisp", "scheme",
+             "haskell", "fortran", "ascii", "vhdl", "perl", "matlab",
+             "python", "mips", "prolog", "spice", "vb", "csharp", "modula2",
+             "a8086", "javascript", "plsql"]
+
+DEFAULT_LANGUAGE = "c"
+DEFAULT_MAX_MATCHES = 10
+DEFAULT_SHOW = 250
+
+# Number of bytes buffered before they are sent to the server
+SEND_BUFFER_SIZE = 1024 * 1024
+
+# Seconds to wait on the server (the query can take minutes)
+CONNECT_TIMEOUT = 30
+RESPONSE_TIMEOUT = 600
+
+# Attempts made to submit, waiting RETRY_BACKOFF ** attempt seconds
+# between them
+MAX_ATTEMPTS = 4
+RETRY_BACKOFF = 2
+
+# Struc that holds a file to upload
+MossFile = collections.namedtuple('MossFile', ['name', 'contents'])
+
+
+class MossError(Exception):
+    pass
+
+
+def get_userid():
+    try:
+        with open(USERID_FILENAME, 'r') as file_handle:
+            return file_handle.read().strip()
+    except FileNotFoundError:
+        return str(DEFAULT_USERID)
+
+
+def read_files(filenames):
+    """
+    Returns MossFiles for the files.
+    """
+    files = []
+    for filename in filenames:
+        with open(filename, 'rb') as file_handle:
+            files.append(MossFile(filename, file_handle.read()))
+    return files
+
+
+def get_submission(file_, directory):
+    """
+    Returns the name of the submission a file belongs to
+    (its directory in directory mode).
+    """
+    return os.path.dirname(file_.name) if directory else file_.name
+
+
+def remove_duplicates(files, directory=False):
+    """
+    Returns the files without byte-identical submissions and a dict from
+    each removed submission to the submission it duplicates.
+    """
+    submission_to_files = collections.OrderedDict()
+    for file_ in files:
+        submission_to_files.setdefault(get_submission(file_, directory),
+                                       []).append(file_)
+    digest_to_submission = {}
+    duplicates = collections.OrderedDict()
+    unique_files = []
+    for submission, submission_files in submission_to_files.items():
+        digest = hashlib.sha256()
+        for file_ in sorted(submission_files):
+            name = os.path.relpath(file_.name, submission) \
+                if directory else ""
+            digest.update(name.encode() + b"\0")
+            digest.update(hashlib.sha256(file_.contents).digest())
+        digest = digest.digest()
+        if digest in digest_to_submission:
+            duplicates[submission] = digest_to_submission[digest]
+        else:
+            digest_to_submission[digest] = submission
+            unique_files += submission_files
+    return unique_files, duplicates
+
+
+def upload_file(writer, file_, file_id, language):
+    writer.write("file {} {} {} {}\n".format(
+        file_id, language, len(file_.contents),
+        file_.name.replace(" ", "_")).encode())
+    writer.write(file_.contents)
+
+
+def send_query(files, language, base_files, directory, max_matches,
+               comment, server, port, userid):
+    """
+    Submits the files in one session and returns the report's URL.
+    """
+    with socket.create_connection((server, port),
+                                  timeout=CONNECT_TIMEOUT) as sock:
+        sock.settimeout(RESPONSE_TIMEOUT)
+        reader = sock.makefile('rb')
+        writer = sock.makefile('wb', buffering=SEND_BUFFER_SIZE)
+        writer.write("moss {}\n".format(userid).encode())
+        writer.write("directory {}\n".format(int(directory)).encode())
+        writer.write(b"X 0\n")
+        writer.write("maxmatches {}\n".format(max_matches).encode())
+        writer.write("show {}\n".format(DEFAULT_SHOW).encode())
+        writer.write("language {}\n".format(language).encode())
+        writer.flush()
+        reply = reader.readline().strip()
+        if not reply:
+            raise ConnectionError("Connection closed by the server")
+        if reply == b"no":
+            writer.write(b"end\n")
+            writer.flush()
+            raise MossError("Unrecognized language {}".format(language))
+
+        for file_ in base_files:
+            upload_file(writer, file_, 0, language)
+        for file_id, file_ in enumerate(files, 1):
+            upload_file(writer, file_, file_id, language)
+        writer.write("query 0 {}\n".format(comment).encode())
+        writer.flush()
+        print("Query submitted.  Waiting for the server's response.")
+        url = reader.readline().decode('utf-8', 'ignore').strip()
+        writer.write(b"end\n")
+        writer.flush()
+    if not url:
+        raise ConnectionError("Connection closed by the server")
+    if not url.startswith("http"):
+        raise MossError(url)
+    return url
+
+
+def submit(files, language=DEFAULT_LANGUAGE, base_files=(),
+           directory=False, max_matches=DEFAULT_MAX_MATCHES, comment="",
+           server=MOSS_SERVER, port=MOSS_PORT, userid=None):
+    """
+    Submits the MossFiles (skipping byte-identical submissions) and returns
+    the report's URL along with a dict from each skipped submission to the
+    submission it duplicates.
+    """
+    if language not in LANGUAGES:
+        raise MossError("Unrecognized language {}".format(language))
+    if userid is None:
+        userid = get_userid()
+    files, duplicates = remove_duplicates(files, directory)
+    if not files:
+        raise MossError("No files submitted.")
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            url = send_query(files, language, base_files, directory,
+                             max_matches, comment, server, port, userid)
+            return url, duplicates
+        except OSError as error:
+            if attempt + 1 == MAX_ATTEMPTS:
+                raise
+            delay = RETRY_BACKOFF ** attempt
+            print("Problem talking to {}:{} ({}), retrying in {} seconds"
+                  .format(server, port, error, delay))
+            time.sleep(delay)
+
+
+def print_duplicates(duplicates):
+    for submission, original in duplicates.items():
+        print("{} is identical to {} (100% match, not uploaded)".format(
+            submission, original))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""
+    Submits files to MOSS and prints the URL of the report.""")
+    parser.add_argument('-l', dest='language', default=DEFAULT_LANGUAGE,
+                        choices=LANGUAGES, help="Language of the files")
+    parser.add_argument('-d', dest='directory', action='store_true', help="""
+Treats files in the same directory as one submission""")
+    parser.add_argument('-b', dest='base_files', action='append', default=[],
+                        help="""
+Base file (code given to every student); can be given more than once""")
+    parser.add_argument('-m', dest='max_matches', type=int,
+                        default=DEFAULT_MAX_MATCHES, help="""
+Code appearing in more than this many submissions is ignored""")
+    parser.add_argument('-c', dest='comment', default="",
+                        help="Comment shown on the report")
+    parser.add_argument('--server', default=MOSS_SERVER)
+    parser.add_argument('--port', type=int, default=MOSS_PORT)
+    parser.add_argument('files', nargs='+')
+    args = parser.parse_args()
+
+    try:
+        url, duplicates = submit(read_files(args.files), args.language,
+                                 read_files(args.base_files), args.directory,
+                                 args.max_matches, args.comment,
+                                 args.server, args.port)
+    except (MossError, OSError) as error:
+        print("Request not sent: {}".format(error))
+        sys.exit(1)
+    print_duplicates(duplicates)
+    print(url)
+
+
+if __name__ == "__main__":
+    main()
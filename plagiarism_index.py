@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""
+Local plagiarism pre-screening (an offline alternative to MOSS).
+Submissions are tokenized, fingerprinted with winnowed k-grams
+and stored in a persistent inverted index (an sqlite database),
+so past terms never need to be fingerprinted again.
+The report ranks pairs of submissions by how many fingerprints they share
+and shows the matching line ranges.
+"""
+import argparse
+import collections
+import hashlib
+import multiprocessing
+import os
+import re
+import sqlite3
+import sys
+
+import submit_mimir_to_moss
+
+# Number of tokens in each k-gram and number of k-grams in each window.
+# Any match at least WINDOW + K_GRAM_SIZE - 1 tokens long is guaranteed
+# to be found.
+K_GRAM_SIZE = 12
+WINDOW_SIZE = 8
+
+# Fingerprints shared by more than this many submissions are treated
+# as boilerplate (like MOSS's -m option).
+MAX_SUBMISSIONS_PER_FINGERPRINT = 10
+
+# Fingerprints from these submissions are never reported as matches.
+BASE_TERM = "__base__"
+
+NUM_POOL_WORKERS = 8
+DEFAULT_REPORT_SIZE = 50
+
+KEYWORDS = frozenset("""
+and as assert async await break case catch char class const continue def
+default del delete do double elif else enum except extends false final
+finally float for from function global if import in int interface is
+lambda let long new none nonlocal not null or pass private protected public
+raise return self short static struct super switch this throw true try
+typedef var void while with yield
+select insert update delete from where join on group by order having
+create table values into limit offset primary key
+""".split())
+
+TOKEN_REGEX = re.compile(r"""
+    (?P<comment>\#[^\n]*|//[^\n]*|/\*.*?\*/|--\s[^\n]*)
+  | (?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+  | (?P<number>\d+(?:\.\d*)?)
+  | (?P<name>[A-Za-z_]\w*)
+  | (?P<newline>\n)
+  | (?P<operator>[^\s\w])
+""", re.VERBOSE | re.DOTALL)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    id INTEGER PRIMARY KEY,
+    term TEXT NOT NULL,
+    name TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    fingerprint_count INTEGER NOT NULL,  -- distinct hashes
+    UNIQUE (term, name));
+CREATE TABLE IF NOT EXISTS fingerprints (
+    hash INTEGER NOT NULL,
+    submission INTEGER NOT NULL,
+    start_line INTEGER NOT NULL,
+    end_line INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS fingerprints_by_hash
+    ON fingerprints (hash, submission);
+CREATE INDEX IF NOT EXISTS fingerprints_by_submission
+    ON fingerprints (submission);
+"""
+
+# Struc that holds a selected k-gram
+Fingerprint = collections.namedtuple('Fingerprint',
+                                     ['hash', 'start_line', 'end_line'])
+
+# Struc that holds a suspicious pair of submissions
+Match = collections.namedtuple('Match',
+                               ['similarity', 'shared', 'first', 'second',
+                                'first_lines', 'second_lines'])
+
+
+def tokenize(source):
+    """
+    Returns a list of (token, line number) pairs with comments and
+    whitespace removed and identifiers, numbers and strings normalized,
+    so renaming variables doesn't hide copying.
+    """
+    tokens = []
+    line = 1
+    for match in TOKEN_REGEX.finditer(source):
+        kind = match.lastgroup
+        text = match.group()
+        if kind == "newline":
+            line += 1
+            continue
+        if kind == "name":
+            token = text.lower() if text.lower() in KEYWORDS else "V"
+        elif kind == "number":
+            token = "N"
+        elif kind == "string":
+            token = "S"
+        elif kind == "operator":
+            token = text
+        else:
+            token = None
+        if token is not None:
+            tokens.append((token, line))
+        line += text.count("\n")
+    return tokens
+
+
+def hash_k_gram(tokens):
+    """
+    Returns a stable 63 bit hash of a k-gram (Python's hash isn't stable).
+    """
+    digest = hashlib.blake2b(" ".join(tokens).encode(), digest_size=8)
+    return int.from_bytes(digest.digest(), "big") >> 1
+
+
+def winnow(tokens, k=K_GRAM_SIZE, window=WINDOW_SIZE):
+    """
+    Returns the winnowed Fingerprints of the tokens: the smallest k-gram
+    hash in every window of consecutive k-grams (the rightmost on ties).
+    """
+    hashes = [hash_k_gram([token for token, _ in tokens[i:i + k]])
+              for i in range(len(tokens) - k + 1)]
+    selected = []
+    last_index = None
+    for start in range(max(len(hashes) - window + 1, 0)):
+        window_hashes = hashes[start:start + window]
+        smallest = min(window_hashes)
+        index = start + max(i for i, value in enumerate(window_hashes)
+                            if value == smallest)
+        if index != last_index:
+            selected.append(Fingerprint(hashes[index], tokens[index][1],
+                                        tokens[index + k - 1][1]))
+            last_index = index
+    if hashes and not selected:
+        index = hashes.index(min(hashes))
+        selected.append(Fingerprint(hashes[index], tokens[index][1],
+                                    tokens[index + k - 1][1]))
+    return selected
+
+
+def fingerprint_source(arg):
+    """
+    Takes a (name, source) pair and returns the name, digest of the source
+    and its Fingerprints.
+    """
+    name, source = arg
+    digest = hashlib.sha1(source.encode()).hexdigest()
+    return name, digest, winnow(tokenize(source))
+
+
+def open_index(index_path):
+    connection = sqlite3.connect(index_path)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def add_submissions(connection, term, named_sources):
+    """
+    Adds (name, source) pairs to the index for the term.
+    Submissions already indexed with the same contents are skipped.
+    Returns the number of submissions fingerprinted.
+    """
+    existing = dict(connection.execute(
+        "SELECT name, digest FROM submissions WHERE term = ?", (term,)))
+    to_add = []
+    for name, source in named_sources:
+        digest = hashlib.sha1(source.encode()).hexdigest()
+        if existing.get(name) != digest:
+            to_add.append((name, source))
+    if not to_add:
+        return 0
+
+    with multiprocessing.Pool(NUM_POOL_WORKERS) as pool:
+        results = pool.map(fingerprint_source, to_add)
+
+    with connection:
+        for name, digest, fingerprints in results:
+            old = connection.execute(
+                "SELECT id FROM submissions WHERE term = ? AND name = ?",
+                (term, name)).fetchone()
+            if old is not None:
+                connection.execute(
+                    "DELETE FROM fingerprints WHERE submission = ?", old)
+                connection.execute("DELETE FROM submissions WHERE id = ?",
+                                   old)
+            cursor = connection.execute(
+                "INSERT INTO submissions (term, name, digest, "
+                "fingerprint_count) VALUES (?, ?, ?, ?)",
+                (term, name, digest,
+                 len({fingerprint.hash for fingerprint in fingerprints})))
+            connection.executemany(
+                "INSERT INTO fingerprints VALUES (?, ?, ?, ?)",
+                [(fingerprint.hash, cursor.lastrowid,
+                  fingerprint.start_line, fingerprint.end_line)
+                 for fingerprint in fingerprints])
+    return len(results)
+
+
+def merge_line_ranges(ranges):
+    """
+    Merges overlapping or adjacent (start, end) line ranges.
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(line_range) for line_range in merged]
+
+
+def find_matches(connection, term=None, limit=DEFAULT_REPORT_SIZE,
+                 max_submissions=MAX_SUBMISSIONS_PER_FINGERPRINT):
+    """
+    Returns the most similar pairs of submissions (at least one of which
+    is from the term, if given) as Matches, most similar first.
+    Similarity is the shared fingerprints over the smaller submission's.
+    """
+    connection.execute("DROP TABLE IF EXISTS temp.shared")
+    connection.execute("""
+        CREATE TEMP TABLE shared AS
+        SELECT hash FROM fingerprints
+        GROUP BY hash
+        HAVING COUNT(DISTINCT submission) BETWEEN 2 AND ?
+        EXCEPT
+        SELECT hash FROM fingerprints JOIN submissions
+            ON submissions.id = fingerprints.submission
+        WHERE submissions.term = ?""", (max_submissions, BASE_TERM))
+    term_filter = ""
+    params = []
+    if term is not None:
+        term_filter = "AND (sa.term = ? OR sb.term = ?)"
+        params = [term, term]
+    rows = connection.execute("""
+        SELECT a.submission, b.submission, COUNT(DISTINCT a.hash),
+               sa.fingerprint_count, sb.fingerprint_count
+        FROM shared
+        JOIN fingerprints a ON a.hash = shared.hash
+        JOIN fingerprints b ON b.hash = shared.hash
+            AND a.submission < b.submission
+        JOIN submissions sa ON sa.id = a.submission
+        JOIN submissions sb ON sb.id = b.submission
+        WHERE sa.term != ? AND sb.term != ? {}
+        GROUP BY a.submission, b.submission""".format(term_filter),
+        [BASE_TERM, BASE_TERM] + params).fetchall()
+
+    def similarity(row):
+        return row[2] / max(min(row[3], row[4]), 1)
+
+    rows.sort(key=similarity, reverse=True)
+    names = {row[0]: "{}/{}".format(row[1], row[2]) for row in
+             connection.execute("SELECT id, term, name FROM submissions")}
+    matches = []
+    for row in rows[:limit]:
+        first, second, shared, _, _ = row
+        line_pairs = connection.execute("""
+            SELECT a.start_line, a.end_line, b.start_line, b.end_line
+            FROM fingerprints a
+            JOIN fingerprints b ON a.hash = b.hash
+            JOIN shared ON shared.hash = a.hash
+            WHERE a.submission = ? AND b.submission = ?""",
+            (first, second)).fetchall()
+        matches.append(Match(
+            similarity(row), shared, names[first], names[second],
+            merge_line_ranges([pair[:2] for pair in line_pairs]),
+            merge_line_ranges([pair[2:] for pair in line_pairs])))
+    return matches
+
+
+def format_line_ranges(ranges):
+    return ",".join("{}-{}".format(start, end) for start, end in ranges)
+
+
+def print_matches(matches):
+    for match in matches:
+        print("{:>4.0%} ({} shared)  {} lines {}  <->  {} lines {}".format(
+            match.similarity, match.shared,
+            match.first, format_line_ranges(match.first_lines),
+            match.second, format_line_ranges(match.second_lines)))
+
+
+def read_sources(filenames):
+    """
+    Returns (filename, contents) pairs for the files.
+    """
+    sources = []
+    for filename in filenames:
+        with open(filename, 'rb') as file_handle:
+            sources.append((filename,
+                            file_handle.read().decode('utf-8', 'ignore')))
+    return sources
+
+
+def read_mimir_sources(zip_file, path_to_file_to_check):
+    """
+    Returns (submission, contents) pairs for the file being checked
+    in every submission of a Mimir export.
+    """
+    return [(os.path.join(submission, name),
+             contents.decode('utf-8', 'ignore'))
+            for submission, name, contents in
+            submit_mimir_to_moss.read_submissions(zip_file,
+                                                  path_to_file_to_check)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""
+    Offline plagiarism pre-screening using winnowed fingerprints
+    stored in a persistent index.""")
+    parser.add_argument('index', help="Path to the index (sqlite) file")
+    subparsers = parser.add_subparsers(dest='command', help='commands')
+
+    add = subparsers.add_parser("add", help="""
+    Fingerprints files into the index under a term (unchanged files that
+    are already indexed are skipped).""")
+    add.add_argument('term', help="Term (i.e. FS2017) of the submissions")
+    add.add_argument('files', nargs='+')
+
+    add_mimir = subparsers.add_parser("add-mimir", help="""
+    Fingerprints one file from every submission in a Mimir export.""")
+    add_mimir.add_argument('term')
+    add_mimir.add_argument('zip_file')
+    add_mimir.add_argument('path_to_file_to_check')
+
+    base = subparsers.add_parser("base", help="""
+    Adds files (i.e. starter code) whose fingerprints never count as
+    matches.""")
+    base.add_argument('files', nargs='+')
+
+    report = subparsers.add_parser("report", help="""
+    Prints the most similar pairs of submissions.""")
+    report.add_argument('--term', help="""
+    Only report pairs involving this term's submissions.""")
+    report.add_argument('--top', type=int, default=DEFAULT_REPORT_SIZE)
+    report.add_argument('-m', type=int,
+                        default=MAX_SUBMISSIONS_PER_FINGERPRINT,
+                        dest='max_submissions', help="""
+    Ignore fingerprints shared by more than this many submissions.""")
+
+    args = parser.parse_args()
+    connection = open_index(args.index)
+    if args.command == "add":
+        added = add_submissions(connection, args.term,
+                                read_sources(args.files))
+        print("Fingerprinted {} submissions".format(added))
+    elif args.command == "add-mimir":
+        added = add_submissions(connection, args.term, read_mimir_sources(
+            args.zip_file, args.path_to_file_to_check))
+        print("Fingerprinted {} submissions".format(added))
+    elif args.command == "base":
+        add_submissions(connection, BASE_TERM, read_sources(args.files))
+    elif args.command == "report":
+        print_matches(find_matches(connection, args.term, args.top,
+                                   args.max_submissions))
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
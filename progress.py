@@ -0,0 +1,221 @@
+"""
+The purpose of this module is to show how far along a long run is.
+Every stage of a run (i.e. fetching, then grading every repo) reports
+its completed and failed tasks, its throughput and an ETA from the moving
+average of its recent task durations. The status line and an optional
+json metrics file are refreshed periodically, even when no task finishes,
+so a stuck run can be told apart from a slow one.
+"""
+import collections
+import contextlib
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+# Seconds between refreshes of the status line and metrics file
+REFRESH_INTERVAL = 5.0
+
+# Seconds between status lines when the stream isn't a terminal (where
+# every status line is a new line rather than a rewrite of the last one)
+LOG_INTERVAL = 60.0
+
+# Number of recent task durations averaged for the ETA
+MOVING_AVERAGE_WINDOW = 20
+
+# Struc that holds what a task returned (or raised) and how long it took
+TaskOutcome = collections.namedtuple('TaskOutcome',
+                                     ['result', 'error', 'seconds'])
+
+
+class TimedTask:
+    """
+    Wraps a function so calling it returns a TaskOutcome instead of
+    raising (it can be given to a multiprocessing.Pool if the function can).
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, arg):
+        start = time.monotonic()
+        try:
+            result, error = self.function(arg), None
+        except Exception as exc:
+            result, error = None, exc
+        return TaskOutcome(result, error, time.monotonic() - start)
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return "?"
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+class Stage:
+    """
+    The progress of one stage of a run.
+    """
+
+    def __init__(self, name, total, workers=1,
+                 window=MOVING_AVERAGE_WINDOW):
+        self.name = name
+        self.total = total
+        self.workers = workers
+        self.completed = 0
+        self.failed = 0
+        self.durations = collections.deque(maxlen=window)
+        self.start_time = time.monotonic()
+        self.last_completion_time = self.start_time
+        self.end_time = None
+
+    def record(self, seconds, failed=False):
+        self.completed += 1
+        self.failed += failed
+        self.durations.append(seconds)
+        self.last_completion_time = time.monotonic()
+
+    def get_metrics(self):
+        now = self.end_time or time.monotonic()
+        elapsed = now - self.start_time
+        remaining = self.total - self.completed
+        average = (sum(self.durations) / len(self.durations)
+                   if self.durations else None)
+        eta = None
+        if average is not None:
+            eta = remaining * average / max(1, min(self.workers, remaining))
+        return collections.OrderedDict([
+            ("stage", self.name),
+            ("total", self.total),
+            ("completed", self.completed),
+            ("failed", self.failed),
+            ("workers", self.workers),
+            ("elapsed_seconds", round(elapsed, 2)),
+            ("tasks_per_second",
+             round(self.completed / elapsed, 3) if elapsed else None),
+            ("average_task_seconds",
+             round(average, 3) if average is not None else None),
+            ("eta_seconds", round(eta, 1) if eta is not None else None),
+            ("seconds_since_last_completion",
+             round(now - self.last_completion_time, 1)),
+            ("finished", self.end_time is not None)])
+
+    def format(self):
+        metrics = self.get_metrics()
+        line = "{}: {}/{} done".format(self.name, self.completed, self.total)
+        if self.failed:
+            line += ", {} failed".format(self.failed)
+        if metrics["tasks_per_second"] is not None:
+            line += ", {:.2f}/s".format(metrics["tasks_per_second"])
+        if self.end_time is not None:
+            return line + ", took {}".format(
+                format_seconds(metrics["elapsed_seconds"]))
+        return line + ", ETA {} (last finished {} ago)".format(
+            format_seconds(metrics["eta_seconds"]),
+            format_seconds(metrics["seconds_since_last_completion"]))
+
+
+class ProgressReporter:
+    """
+    Shows the current stage's status line (rewritten in place on a
+    terminal, otherwise a new line every log_interval seconds) and writes
+    every stage's metrics to the metrics file (if there is one) every
+    interval seconds and when a stage finishes.
+    """
+
+    def __init__(self, metrics_file=None, interval=REFRESH_INTERVAL,
+                 stream=sys.stdout, log_interval=LOG_INTERVAL):
+        self.metrics_file = metrics_file
+        self.interval = interval
+        self.stream = stream
+        self.log_interval = log_interval
+        self.last_logged = time.monotonic()
+        self.stages = []
+        self.current = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start_stage(self, name, total, workers=1):
+        with self.lock:
+            self.current = Stage(name, total, workers)
+            self.stages.append(self.current)
+            self.last_logged = self.current.start_time
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.refresh_forever,
+                                               daemon=True)
+                self.thread.start()
+        return self.current
+
+    def finish_stage(self, stage):
+        with self.lock:
+            stage.end_time = time.monotonic()
+            self.show(stage, final=True)
+            self.write_metrics()
+            if self.current is stage:
+                self.current = None
+
+    def refresh_forever(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if self.current is not None:
+                    self.show(self.current)
+                    self.write_metrics()
+
+    def show(self, stage, final=False):
+        if self.stream.isatty():
+            self.stream.write("\r\033[K" + stage.format() +
+                              ("\n" if final else ""))
+        elif final or (time.monotonic() - self.last_logged >=
+                       self.log_interval):
+            self.stream.write(stage.format() + "\n")
+            self.last_logged = time.monotonic()
+        else:
+            return
+        self.stream.flush()
+
+    def write_metrics(self):
+        """
+        Replaces the metrics file, silently giving up if it can't be written.
+        """
+        if self.metrics_file is None:
+            return
+        temp_path = "{}.{}.tmp".format(self.metrics_file, os.getpid())
+        try:
+            with open(temp_path, 'w') as file_handle:
+                json.dump({"updated": datetime.datetime.now().isoformat(),
+                           "stages": [stage.get_metrics()
+                                      for stage in self.stages]},
+                          file_handle, indent=2)
+            os.replace(temp_path, self.metrics_file)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+
+    def run(self, name, function, args, pool=None, workers=1):
+        """
+        Yields what the function returns for every arg (in the order they
+        finish, running them on the pool if one is given) while reporting
+        the stage's progress.
+        The first exception raised by a task is raised right away (leaving
+        the pool's other tasks for its owner to terminate).
+        """
+        args = list(args)
+        stage = self.start_stage(name, len(args),
+                                 workers if pool is not None else 1)
+        task = TimedTask(function)
+        if pool is not None:
+            outcomes = pool.imap_unordered(task, args)
+        else:
+            outcomes = map(task, args)
+        try:
+            for outcome in outcomes:
+                with self.lock:
+                    stage.record(outcome.seconds, outcome.error is not None)
+                if outcome.error is not None:
+                    raise outcome.error
+                yield outcome.result
+        finally:
+            self.finish_stage(stage)
@@ -0,0 +1,169 @@
+"""
+The purpose of this module is to find the student repos that would slow
+down a whole grading run (i.e. a committed dataset or thousands of
+generated files) before grading starts.
+Every repo's object count, pack size, largest blobs and working tree file
+count are collected (from git's own bookkeeping, without reading any
+file contents) and repos over the thresholds are quarantined, so the
+grader can run them last on their own few workers.
+"""
+import collections
+import csv
+import heapq
+import os
+import subprocess
+
+DEFAULT_SCAN_FILE = "repo_health.csv"
+
+# Default thresholds for quarantining a repo
+MAX_PACK_MEGABYTES = 100.0
+MAX_BLOB_MEGABYTES = 20.0
+MAX_FILES = 5000
+
+# Number of largest blobs listed for each repo
+NUM_LARGEST_BLOBS = 3
+
+KILOBYTE = 1024
+MEGABYTE = 1024 * 1024
+
+SCAN_FIELDS = ["MSU_Net_ID", "Quarantined", "Objects", "Pack_MB",
+               "Loose_MB", "Largest_Blob_MB", "Files", "Problems",
+               "Largest_Blobs"]
+
+# Struc that holds the size of a repo; largest_blobs are (size in bytes,
+# object id) pairs, largest first
+RepoHealth = collections.namedtuple('RepoHealth',
+                                    ['object_count', 'pack_bytes',
+                                     'loose_bytes', 'largest_blobs',
+                                     'file_count'])
+
+# Struc that holds the limits a repo must stay under to be graded
+# with everyone else
+HealthThresholds = collections.namedtuple('HealthThresholds',
+                                          ['max_pack_megabytes',
+                                           'max_blob_megabytes',
+                                           'max_files'])
+
+DEFAULT_THRESHOLDS = HealthThresholds(MAX_PACK_MEGABYTES, MAX_BLOB_MEGABYTES,
+                                      MAX_FILES)
+
+
+def count_objects(repo_path):
+    """
+    Returns the "git count-objects -v" statistics (sizes in KiB).
+    """
+    output = subprocess.check_output(["git", "count-objects", "-v"],
+                                     cwd=repo_path, universal_newlines=True)
+    statistics = {}
+    for line in output.splitlines():
+        key, _, value = line.partition(":")
+        statistics[key.strip()] = int(value)
+    return statistics
+
+
+def get_largest_blobs(repo_path, number=NUM_LARGEST_BLOBS):
+    """
+    Returns the (size, object id) of the largest blobs in the repo's
+    object database, largest first.
+    """
+    with subprocess.Popen(
+            ["git", "cat-file", "--batch-all-objects",
+             "--batch-check=%(objecttype) %(objectsize) %(objectname)"],
+            cwd=repo_path, stdout=subprocess.PIPE,
+            universal_newlines=True) as proc:
+        blobs = (line.split()[1:] for line in proc.stdout
+                 if line.startswith("blob "))
+        largest = heapq.nlargest(number, ((int(size), object_id)
+                                          for size, object_id in blobs))
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    return largest
+
+
+def count_files(repo_path):
+    """
+    Returns the number of files in the working tree (outside of .git).
+    """
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(repo_path):
+        if ".git" in dirnames:
+            dirnames.remove(".git")
+        count += len(filenames)
+    return count
+
+
+def scan_repo(arg):
+    """
+    Takes (name, repo path) and returns (name, RepoHealth),
+    the RepoHealth is None if the repo couldn't be scanned.
+    """
+    name, repo_path = arg
+    try:
+        statistics = count_objects(repo_path)
+        health = RepoHealth(
+            object_count=statistics["count"] + statistics["in-pack"],
+            pack_bytes=statistics["size-pack"] * KILOBYTE,
+            loose_bytes=statistics["size"] * KILOBYTE,
+            largest_blobs=get_largest_blobs(repo_path),
+            file_count=count_files(repo_path))
+    except (subprocess.CalledProcessError, OSError, KeyError, ValueError):
+        print("Problem scanning repo: " + repo_path)
+        return name, None
+    return name, health
+
+
+def get_problems(health, thresholds):
+    """
+    Returns a description of every threshold the repo is over.
+    """
+    problems = []
+    pack_megabytes = (health.pack_bytes + health.loose_bytes) / MEGABYTE
+    if pack_megabytes > thresholds.max_pack_megabytes:
+        problems.append("objects take {:.1f} MB".format(pack_megabytes))
+    if health.largest_blobs and \
+            health.largest_blobs[0][0] / MEGABYTE > \
+            thresholds.max_blob_megabytes:
+        problems.append("a {:.1f} MB blob".format(
+            health.largest_blobs[0][0] / MEGABYTE))
+    if health.file_count > thresholds.max_files:
+        problems.append("{} files".format(health.file_count))
+    return problems
+
+
+def write_scan(name_to_health, thresholds, scan_csv=DEFAULT_SCAN_FILE):
+    """
+    Writes every repo's health to a csv and returns the names of the
+    quarantined repos.
+    """
+    quarantined = []
+    rows = []
+    for name, health in sorted(name_to_health.items()):
+        if health is None:
+            rows.append([name, 0, "", "", "", "", "", "could not scan", ""])
+            continue
+        problems = get_problems(health, thresholds)
+        if problems:
+            quarantined.append(name)
+        largest_blob = (health.largest_blobs[0][0]
+                        if health.largest_blobs else 0)
+        rows.append([name, int(bool(problems)), health.object_count,
+                     round(health.pack_bytes / MEGABYTE, 2),
+                     round(health.loose_bytes / MEGABYTE, 2),
+                     round(largest_blob / MEGABYTE, 2),
+                     health.file_count, "; ".join(problems),
+                     " ".join("{}:{}".format(object_id[:10], size)
+                              for size, object_id in health.largest_blobs)])
+    with open(scan_csv, 'w') as csv_handle:
+        writer = csv.writer(csv_handle)
+        writer.writerow(SCAN_FIELDS)
+        writer.writerows(rows)
+    return quarantined
+
+
+def read_quarantined(scan_csv):
+    """
+    Returns the set of repo names a scan quarantined.
+    """
+    with open(scan_csv, 'r') as csv_handle:
+        return {row["MSU_Net_ID"] for row in csv.DictReader(csv_handle)
+                if row["Quarantined"] == "1"}
@@ -0,0 +1,309 @@
+"""
+The purpose of this module is to keep one roster of the class that every
+script resolves students through.
+The roster is built from the registrar's class list, the Google Form
+survey and/or a students_info csv, indexed by MSU NetID, email, GitHub
+username and name (so every lookup is a dict access) and cached until
+one of its source files changes.
+Records that can't be matched to a student are collected and reported
+together instead of being silently dropped.
+"""
+import collections
+import csv
+import json
+import os
+
+EMAIL_DOMAIN = "msu.edu"
+ROSTER_CACHE_FILENAME = ".roster_cache.json"
+ROSTER_CACHE_FORMAT = 2
+
+# Columns of the source files
+REGISTRAR_NET_ID = "MSUNet_ID"
+REGISTRAR_NAME = "Student_Name"  # "Last, First"
+FORM_NET_ID = """MSU Net ID (without the "@msu.edu" part)"""
+FORM_FIRST_NAME = "First name"
+FORM_LAST_NAME = "Last name"
+FORM_GITHUB_USERNAME = "GitHub Username"
+STUDENTS_INFO_FIELDS = ["github_username", "msu_net_id", "full_name"]
+
+# Struc that holds what is known about a student
+# (github_username is None until they fill out the survey)
+RosterEntry = collections.namedtuple('RosterEntry',
+                                     ['msu_net_id', 'email',
+                                      'github_username', 'full_name'])
+
+
+def strip_net_id(net_id):
+    """
+    Returns the NetID without whitespace or an email domain
+    (keeping its case, which repo names use).
+    """
+    return net_id.strip().partition("@")[0]
+
+
+def normalize_net_id(net_id):
+    """
+    Returns the key NetIDs are looked up by (NetIDs are case insensitive).
+    """
+    return strip_net_id(net_id).lower()
+
+
+def normalize_name(name):
+    """
+    Returns a key for a name, given as "First Last" or "Last, First".
+    """
+    last, comma, first = name.partition(",")
+    if comma:
+        name = first + " " + last
+    return " ".join(name.split()).casefold()
+
+
+def make_entry(msu_net_id, github_username=None, full_name=""):
+    msu_net_id = strip_net_id(msu_net_id)
+    github_username = (github_username or "").strip() or None
+    return RosterEntry(msu_net_id,
+                       "{}@{}".format(msu_net_id, EMAIL_DOMAIN),
+                       github_username,
+                       " ".join(full_name.split()))
+
+
+class Roster:
+    """
+    The students of the class, with an index for each way
+    other files refer to them.
+    """
+
+    def __init__(self, entries=(), unmatched=()):
+        self.by_net_id = collections.OrderedDict()
+        self.by_email = {}
+        self.by_github_username = {}
+        self.by_name = {}
+        self.ambiguous_names = set()
+        # (source, records) pairs of records that didn't match anyone
+        self.unmatched = list(unmatched)
+        for entry in entries:
+            self.add(entry)
+
+    def add(self, entry):
+        """
+        Adds a student, filling in what an earlier source
+        didn't know about them (the earlier source's NetID case is kept).
+        """
+        key = normalize_net_id(entry.msu_net_id)
+        old = self.by_net_id.get(key)
+        if old is not None:
+            entry = RosterEntry(old.msu_net_id, old.email,
+                                entry.github_username or old.github_username,
+                                old.full_name or entry.full_name)
+            if old.github_username and \
+                    old.github_username != entry.github_username:
+                del self.by_github_username[old.github_username.lower()]
+        self.by_net_id[key] = entry
+        self.by_email[entry.email.lower()] = entry
+        if entry.github_username:
+            self.by_github_username[entry.github_username.lower()] = entry
+        if entry.full_name:
+            name = normalize_name(entry.full_name)
+            other = self.by_name.get(name)
+            if other is not None and \
+                    normalize_net_id(other.msu_net_id) != key:
+                self.ambiguous_names.add(name)
+            self.by_name[name] = entry
+
+    def __iter__(self):
+        return iter(self.by_net_id.values())
+
+    def __len__(self):
+        return len(self.by_net_id)
+
+    def find_by_net_id(self, net_id):
+        return self.by_net_id.get(normalize_net_id(net_id))
+
+    def find_by_email(self, email):
+        return self.by_email.get(email.strip().lower())
+
+    def find_by_github_username(self, github_username):
+        return self.by_github_username.get(github_username.strip().lower())
+
+    def find_by_name(self, name):
+        """
+        Returns the student with the name (None if several students have it).
+        """
+        name = normalize_name(name)
+        if name in self.ambiguous_names:
+            return None
+        return self.by_name.get(name)
+
+    def find(self, key):
+        """
+        Returns the student a NetID, email, GitHub username or name
+        refers to (None if it doesn't match anyone).
+        """
+        if "@" in key:
+            return self.find_by_email(key)
+        return (self.find_by_net_id(key) or
+                self.find_by_github_username(key) or
+                self.find_by_name(key))
+
+    def resolve(self, keys, find=None):
+        """
+        Returns a dict from each key to its student and the list of keys
+        that didn't match anyone.
+        """
+        if find is None:
+            find = self.find
+        matched = {}
+        unmatched = []
+        for key in keys:
+            entry = find(key)
+            if entry is None:
+                unmatched.append(key)
+            else:
+                matched[key] = entry
+        return matched, unmatched
+
+
+def report_unmatched(source, unmatched):
+    """
+    Prints every record from the source that didn't match a student.
+    """
+    if not unmatched:
+        return
+    print("{} records in {} don't match anyone on the roster:".format(
+        len(unmatched), source))
+    for record in unmatched:
+        print("  {}".format(record))
+
+
+def read_registrar_class_list(class_list_csv):
+    with open(class_list_csv, 'r') as csv_handle:
+        return [make_entry(row[REGISTRAR_NET_ID],
+                           full_name=normalize_registrar_name(
+                               row[REGISTRAR_NAME]))
+                for row in csv.DictReader(csv_handle)]
+
+
+def normalize_registrar_name(comma_name):
+    last_name, comma, first_name = comma_name.partition(", ")
+    return first_name + " " + last_name
+
+
+def read_google_form(form_csv):
+    """
+    Returns an entry for each survey response
+    (a later response from a student replaces an earlier one).
+    """
+    with open(form_csv, 'r') as csv_handle:
+        return [make_entry(row[FORM_NET_ID], row[FORM_GITHUB_USERNAME],
+                           row[FORM_FIRST_NAME] + " " + row[FORM_LAST_NAME])
+                for row in csv.DictReader(csv_handle)]
+
+
+def read_students_info(students_info_csv):
+    with open(students_info_csv, 'r') as csv_handle:
+        reader = csv.reader(csv_handle, strict=True)
+        header = next(reader)
+        assert header == STUDENTS_INFO_FIELDS
+        return [make_entry(msu_net_id, github_username, full_name)
+                for github_username, msu_net_id, full_name in reader]
+
+
+def get_sources_signature(sources):
+    signature = []
+    for source in sources:
+        if source is None:
+            signature.append(None)
+        else:
+            stat = os.stat(source)
+            signature.append([os.path.abspath(source), stat.st_size,
+                              stat.st_mtime_ns])
+    return signature
+
+
+def build_roster(class_list_csv=None, form_csv=None, students_info_csv=None):
+    """
+    Builds the roster from the given sources. When there is a class list,
+    it decides who is in the class and records from the other sources
+    that aren't on it are collected in the roster's unmatched list
+    (see report_roster_unmatched).
+    """
+    roster = Roster()
+    if class_list_csv is not None:
+        for entry in read_registrar_class_list(class_list_csv):
+            roster.add(entry)
+    for source, reader in ((form_csv, read_google_form),
+                           (students_info_csv, read_students_info)):
+        if source is None:
+            continue
+        unmatched = []
+        for entry in reader(source):
+            if class_list_csv is not None and \
+                    roster.find_by_net_id(entry.msu_net_id) is None:
+                unmatched.append(entry.msu_net_id)
+            else:
+                roster.add(entry)
+        if unmatched:
+            roster.unmatched.append((source, unmatched))
+    return roster
+
+
+def report_roster_unmatched(class_roster):
+    for source, unmatched in class_roster.unmatched:
+        report_unmatched(source, unmatched)
+
+
+def load_roster(class_list_csv=None, form_csv=None, students_info_csv=None,
+                cache_filename=ROSTER_CACHE_FILENAME):
+    """
+    Returns the roster built from the sources, reusing the cached roster
+    if none of the sources changed since it was built. Either way, the
+    records that didn't match anyone are reported.
+    """
+    signature = get_sources_signature([class_list_csv, form_csv,
+                                       students_info_csv])
+    try:
+        with open(cache_filename, 'r') as cache_handle:
+            cached = json.load(cache_handle)
+        if cached["format"] == ROSTER_CACHE_FORMAT and \
+                cached["sources"] == signature:
+            roster = Roster((RosterEntry(*entry)
+                             for entry in cached["entries"]),
+                            [tuple(pair) for pair in cached["unmatched"]])
+            report_roster_unmatched(roster)
+            return roster
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    roster = build_roster(class_list_csv, form_csv, students_info_csv)
+    report_roster_unmatched(roster)
+    try:
+        with open(cache_filename, 'w') as cache_handle:
+            json.dump({"format": ROSTER_CACHE_FORMAT, "sources": signature,
+                       "entries": [list(entry) for entry in roster],
+                       "unmatched": roster.unmatched},
+                      cache_handle)
+    except OSError:
+        pass
+    return roster
+
+
+def add_roster_arguments(parser):
+    """
+    Adds the options that give the roster's sources to an ArgumentParser.
+    """
+    parser.add_argument('--class-list', help="""
+Class list csv from the registrar (decides who is in the class)""")
+    parser.add_argument('--form', help="""
+Csv of the Google Form survey (GitHub usernames)""")
+    parser.add_argument('--students-info', help="""
+students_info csv (as written by convert_google_form_to_students_info.py)""")
+
+
+def roster_from_args(args):
+    """
+    Returns the roster from the add_roster_arguments options
+    (None if none were given).
+    """
+    if not (args.class_list or args.form or args.students_info):
+        return None
+    return load_roster(args.class_list, args.form, args.students_info)
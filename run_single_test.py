@@ -5,20 +5,72 @@ with a project.
 """
 
 import argparse
+import collections
+import glob
+import json
 import traceback
 import os
+import resource
+import selectors
+import signal
 import subprocess
 import sys
 import re
+import tempfile
+import time
 
 # Number of seconds before killing command
 TEST_TIMEOUT = 2
 PROJECT_EXECUTABLE = "cli.py"
 
+# Number of bytes the project may print or write to its output file.
+OUTPUT_LIMIT = 1024 * 1024
 
-def remove(filename):
-    if os.path.exists(filename):
-        os.remove(filename)
+# Largest file (in bytes) the project may write at all (i.e. its database
+# files). This only keeps a runaway project from filling the disk; the
+# output is held to OUTPUT_LIMIT when it is read.
+FILE_SIZE_LIMIT = 1024 * 1024 * 1024
+
+# Return code used when the project's output is too big.
+# Make sure this matches the value in run_tests.py.
+OUTPUT_LIMIT_EXCEEDED_RETURNCODE = 3
+
+# Number of bytes read from the project's output at a time.
+READ_CHUNK_SIZE = 64 * 1024
+
+# Memory backed filesystem used for scratch output when available.
+TMPFS_DIRECTORY = "/dev/shm"
+OUTPUT_FILENAME = "output.txt"
+
+# Number of seconds between checks on whether the project has exited.
+WAIT_POLL_INTERVAL = 0.005
+
+# In batch mode every test's output is preceded by a header line:
+# "==> STATUS LENGTH WALL USER SYS MAXRSS TEST_FILE" where LENGTH is the
+# number of bytes of output that follow (then a newline), the times are
+# in seconds and MAXRSS is in kilobytes (all 0 if the project didn't run).
+BATCH_RECORD_HEADER = "==> {} {} {:.4f} {:.4f} {:.4f} {} {}\n"
+BATCH_OK = "ok"
+BATCH_TIMEOUT = "timeout"
+BATCH_ERROR = "error"
+BATCH_NO_OUTPUT = "no-output"
+BATCH_OUTPUT_LIMIT = "output-limit"
+
+# Struc that holds the resources used by the project (maxrss in kilobytes)
+ResourceUsage = collections.namedtuple('ResourceUsage',
+                                       ['wall', 'user', 'sys', 'maxrss'])
+NO_USAGE = ResourceUsage(0, 0, 0, 0)
+
+
+def scratch_directory():
+    """
+    Returns a private temporary directory for a single test's output,
+    placed on tmpfs when available so the output never touches the disk.
+    """
+    tmpfs = TMPFS_DIRECTORY
+    if not (os.path.isdir(tmpfs) and os.access(tmpfs, os.W_OK | os.X_OK)):
+        tmpfs = None
+    return tempfile.TemporaryDirectory(prefix="run_single_test_", dir=tmpfs)
 
 
 class TestRunnerException(Exception):
@@ -28,19 +80,101 @@ class TestRunnerException(Exception):
     pass
 
 
-def get_output_from_args(args, timeout):
+class OutputLimitExceeded(Exception):
+    """
+    Exception used to indicate the project printed or wrote too much.
+    """
+    pass
+
+
+def limit_file_size():
+    """
+    Run in the project's process so it can't write files over
+    FILE_SIZE_LIMIT.
+    """
+    resource.setrlimit(resource.RLIMIT_FSIZE,
+                       (FILE_SIZE_LIMIT, FILE_SIZE_LIMIT))
+
+
+def drain_output(proc, timeout, limit):
+    """
+    Reads the process's stdout through a buffer of at most limit bytes,
+    then reaps it and returns its ResourceUsage.
+    Raises OutputLimitExceeded or subprocess.TimeoutExpired
+    (the caller is responsible for killing the process).
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    total = 0
+    with selectors.DefaultSelector() as selector:
+        selector.register(proc.stdout, selectors.EVENT_READ)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(proc.args, timeout)
+            if not selector.select(remaining):
+                continue
+            chunk = os.read(proc.stdout.fileno(), READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            total += len(chunk)
+            if total > limit:
+                raise OutputLimitExceeded(limit)
+    while True:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            return ResourceUsage(time.monotonic() - start, rusage.ru_utime,
+                                 rusage.ru_stime, rusage.ru_maxrss)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise subprocess.TimeoutExpired(proc.args, timeout)
+        time.sleep(min(WAIT_POLL_INTERVAL, remaining))
+
+
+def get_output_from_args(args, timeout, limit=OUTPUT_LIMIT,
+                         limit_files=True):
+    """
+    Runs the project, discarding what it prints (tests are judged on the
+    output file) without ever holding more than a chunk of it in memory.
+    Returns a list of problems and the project's ResourceUsage
+    (None if it was killed).
+    Raises OutputLimitExceeded if it prints more than limit bytes.
+    Unless limit_files is False (for the reference solution), the files
+    it writes are capped at FILE_SIZE_LIMIT.
+    """
     output = []
-    try:
-        stdout = subprocess.check_output(args,
-                                         stderr=subprocess.STDOUT,
-                                         universal_newlines=True,
-                                         timeout=timeout)
-        output.append(stdout)
-    except subprocess.CalledProcessError as cpe:
+    usage = None
+    with subprocess.Popen(args,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT,
+                          start_new_session=True,
+                          preexec_fn=limit_file_size if limit_files
+                          else None) as proc:
+        try:
+            usage = drain_output(proc, timeout, limit)
+        except subprocess.TimeoutExpired as te:
+            output.append("TestRunner: {} took too long, killing it.".format(
+                args[0]))
+        finally:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+    if proc.returncode:
         output.append("Non-Zero Return Code")
-    except subprocess.TimeoutExpired as te:
-        output.append("TestRunner: {} took too long, killing it.".format(
-            args[0]))
+    return output, usage
+
+
+def read_output_file(filename, limit=OUTPUT_LIMIT):
+    """
+    Returns the contents of the project's output file,
+    raising OutputLimitExceeded if it is over limit bytes.
+    """
+    with open(filename, 'r') as file_handle:
+        output = file_handle.read(limit + 1)
+    if len(output.encode()) > limit:
+        raise OutputLimitExceeded(limit)
     return output
 
 
@@ -51,13 +185,90 @@ def get_input(test_file):
     return test_file.read()
 
 
+def get_correct_output(test_file_name):
+    """
+    Returns the correct output for a test.
+    """
+    chars_to_remove = len("input.txt")
+    correct_file_name = test_file_name[:-chars_to_remove]
+    correct_file_name += "correct.txt"
+    with open(correct_file_name, 'r') as file_handle:
+        return file_handle.read()
+
+
+def run_project(test_file_name, timeout):
+    """
+    Runs the project on a test in a private scratch directory.
+    Returns the status (one of the BATCH_ constants), the output
+    (None if the project didn't write any) and its ResourceUsage.
+    """
+    with scratch_directory() as scratch_dir:
+        output_path = os.path.join(scratch_dir, OUTPUT_FILENAME)
+        executable_args = ["python3",
+                           PROJECT_EXECUTABLE,
+                           test_file_name,
+                           output_path]
+        try:
+            problems, usage = get_output_from_args(executable_args, timeout)
+            output = None
+            if os.path.exists(output_path):
+                output = read_output_file(output_path)
+        except OutputLimitExceeded:
+            return BATCH_OUTPUT_LIMIT, None, None
+    if usage is None:
+        status = BATCH_TIMEOUT
+    elif problems:
+        status = BATCH_ERROR
+    elif output is None:
+        status = BATCH_NO_OUTPUT
+    else:
+        status = BATCH_OK
+    return status, output, usage
+
+
+def run_batch(test_patterns, timeout, output_handle,
+              correct=False, test_input=False):
+    """
+    Runs every test matching the patterns (filenames or globs), in one
+    process, writing a BATCH_RECORD_HEADER and the output for each test
+    as soon as it finishes.
+    A pattern that doesn't match a test file is reported as an error
+    without running the project.
+    """
+    for pattern in test_patterns:
+        test_file_names = sorted(glob.glob(pattern)) or [pattern]
+        for test_file_name in test_file_names:
+            status, usage = BATCH_OK, NO_USAGE
+            try:
+                if not os.path.isfile(test_file_name):
+                    status, output = BATCH_ERROR, None
+                elif test_input:
+                    with open(test_file_name, 'r') as test_file:
+                        output = get_input(test_file)
+                elif correct:
+                    output = get_correct_output(test_file_name)
+                else:
+                    status, output, usage = run_project(test_file_name,
+                                                        timeout)
+            except (OSError, ValueError):
+                # Includes UnicodeDecodeError; only this test fails
+                status, output, usage = BATCH_ERROR, None, None
+            data = (output or "").encode()
+            usage = usage or NO_USAGE
+            output_handle.write(BATCH_RECORD_HEADER.format(
+                status, len(data), usage.wall, usage.user, usage.sys,
+                usage.maxrss, test_file_name).encode())
+            output_handle.write(data + b"\n")
+            output_handle.flush()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="""
     Runs a single test.
     If no arguments (apart from the test filename) are given,
     it outputs your project's test output.
     """)
-    parser.add_argument('test_file', type=argparse.FileType('r'),
+    parser.add_argument('test_file', nargs='?', type=argparse.FileType('r'),
                         help="The file containing the test contents.")
     parser.add_argument('output_file', nargs='?', type=argparse.FileType('w'),
                         default=sys.stdout, help="""The file to write the output of this program to.
@@ -66,22 +277,52 @@ If not given, outputs to stdout.""")
     If given, outputs the correct output for a test.""")
     parser.add_argument('--input', action='store_true', help="""
 If given, outputs the contents of the test.""")
+    parser.add_argument('--reference', action='store_true', help="""
+    If given, the project is the reference solution
+    (the size of the files it writes isn't limited).""")
+    parser.add_argument('--usage-file', help="""
+    If given, the resources the project used (not counting this script)
+    are written to this file as json.""")
+    parser.add_argument('--timeout', type=float, default=TEST_TIMEOUT, help="""
+Number of seconds before killing the project (defaults to {}).""".format(
+        TEST_TIMEOUT))
+    parser.add_argument('--batch', nargs='+', metavar="TEST", help="""
+Runs every given test file (or glob) in this one process, writing each
+test's output to stdout after a header line of the form
+"==> STATUS LENGTH WALL USER SYS MAXRSS TEST_FILE".""")
 
     args = parser.parse_args()
+    if args.batch:
+        if args.test_file is not None:
+            parser.error("test_file can't be given with --batch")
+        run_batch(args.batch, args.timeout, sys.stdout.buffer,
+                  correct=args.correct, test_input=args.input)
+        sys.exit(0)
+    if args.test_file is None:
+        parser.error("test_file (or --batch) is required")
+
     if args.input:
         output = args.test_file.read()
     elif args.correct:
-        chars_to_remove = len("input.txt")
-        correct_file_name = args.test_file.name[:-chars_to_remove]
-        correct_file_name += "correct.txt"
-        output = open(correct_file_name, 'r').read()
+        output = get_correct_output(args.test_file.name)
     else:
-        executable_args = ["python3",
-                           PROJECT_EXECUTABLE,
-                           args.test_file.name,
-                           "output.txt"]
-        get_output_from_args(executable_args, TEST_TIMEOUT)
-        output = open("output.txt", 'r').read()
+        with scratch_directory() as scratch_dir:
+            output_path = os.path.join(scratch_dir, OUTPUT_FILENAME)
+            executable_args = ["python3",
+                               PROJECT_EXECUTABLE,
+                               args.test_file.name,
+                               output_path]
+            try:
+                _, usage = get_output_from_args(
+                    executable_args, args.timeout,
+                    limit_files=not args.reference)
+                if args.usage_file and usage is not None:
+                    with open(args.usage_file, 'w') as usage_handle:
+                        json.dump(usage._asdict(), usage_handle)
+                output = read_output_file(output_path)
+            except OutputLimitExceeded as ole:
+                print("TestRunner: output limit of {} bytes exceeded, "
+                      "killing it.".format(ole.args[0]))
+                sys.exit(OUTPUT_LIMIT_EXCEEDED_RETURNCODE)
 
     args.output_file.write(output)
-    remove("output.txt")
@@ -9,35 +9,49 @@ returned.
 import argparse
 import contextlib
 import collections
+import ctypes
+import ctypes.util
 import difflib
 import fnmatch
 import functools
 import glob
+import hashlib
 import itertools
+import json
+import locale
 import os
+import select
+import selectors
+import signal
+import socket
+import struct
 import subprocess
 import sys
+import tempfile
+import time
 
 # These global variables are unlikely to need to change
 PROJECT_EXECUTABLE = "run_single_test.py"
 TEST_SUITE_FOLDER = "Test_Suite"
-TEST_FILES_TO_POINTS = collections.OrderedDict()
+# Extra credit test globs are relative to the Test_Suite (like points.txt)
 EXTRA_CREDIT_TEST_FILES_TO_POINTS = collections.OrderedDict([
-    ("Test_Suite/extra.*", 1)
+    ("extra.*", 1)
 ])
 POINTS_FOR_PASSING_ALL = 1
-POINTS_FILENAME = os.path.join(TEST_SUITE_FOLDER, "points.txt")
-with open(POINTS_FILENAME, 'r') as file_handle:
-    for line in file_handle:
-        category, point_str = line.split()
-        point_value = float(point_str)
+POINTS_FILENAME = "points.txt"
+NEEDED_FILES_FILENAME = "needed_files.txt"
 
-        category_path = os.path.join(TEST_SUITE_FOLDER, category)
-        TEST_FILES_TO_POINTS[category_path] = point_value
+# Compiled description of the Test_Suite, rebuilt whenever the suite changes.
+MANIFEST_FILENAME = ".manifest.json"
+MANIFEST_FORMAT = 2
 
-NEEDED_FILES_FILENAME = os.path.join(TEST_SUITE_FOLDER, "needed_files.txt")
-with open(NEEDED_FILES_FILENAME, 'r') as file_handle:
-    NEEDED_FILES = [line.strip() for line in file_handle]
+# Reference runtimes of the performance tests, measured per grading host
+# by running "run_tests.py --calibrate" against the reference solution.
+CALIBRATION_FILENAME = ".calibration.json"
+CALIBRATION_RUNS = 3
+
+# Files in the Test_Suite that don't count towards its version.
+SUITE_CACHE_FILENAMES = {MANIFEST_FILENAME, CALIBRATION_FILENAME}
 
 # These Global Variables may need to be changed depending on the project
 NEEDED_FILES_POINTS = 0.5
@@ -46,16 +60,88 @@ NEEDED_FILES_POINTS = 0.5
 # Make sure this is strictly larger than the timeout in run_single_test.py.
 TEST_TIMEOUT = 20
 
-# Struc that holds per test result
+# Number of bytes of output to keep from a command before killing it.
+# Make sure this is strictly larger than the limit in run_single_test.py.
+OUTPUT_LIMIT = 2 * 1024 * 1024
+
+# Return code used by run_single_test.py when the project's output is too big.
+# Make sure this matches the value in run_single_test.py.
+OUTPUT_LIMIT_EXCEEDED_RETURNCODE = 3
+
+# Number of bytes read from a command's output at a time.
+READ_CHUNK_SIZE = 64 * 1024
+
+# Smallest CPU time budget (in seconds) a performance test can have,
+# so tests that the reference solution runs instantly aren't all noise.
+PERF_MIN_BUDGET = 0.25
+
+# Performance tests are killed after this multiple of their budget
+# (in wall time), instead of after run_single_test.py's default timeout.
+PERF_TIMEOUT_FACTOR = 2
+
+# File (in a private temporary directory) run_single_test.py writes the
+# project's own ResourceUsage to, so budgets don't include the harness.
+USAGE_FILENAME = "usage.json"
+
+# Number of seconds between checks on whether a command has exited.
+WAIT_POLL_INTERVAL = 0.005
+
+# Number of tests listed in the slowest tests report by default.
+SLOWEST_TESTS_SHOWN = 5
+
+# Recent outcomes of each test (kept locally so tests that failed last
+# time can be run first). Only used when students run the tests.
+HISTORY_FILENAME = ".run_tests_history.json"
+HISTORY_LENGTH = 5
+
+# Watch mode settings: seconds between scans when inotify isn't available,
+# and seconds to wait for an editor to finish saving before rerunning.
+WATCH_POLL_INTERVAL = 0.5
+WATCH_SETTLE_TIME = 0.1
+
+# Files that trigger a rerun in watch mode (along with the Test_Suite),
+# files the project writes while running (i.e. databases) don't.
+WATCHED_FILE_PATTERNS = ["*.py"]
+
+# inotify constants (from <sys/inotify.h>)
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_ISDIR = 0x40000000
+IN_WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                 IN_CREATE | IN_DELETE)
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+
+# Struc that holds per test result (usage is a ResourceUsage or None)
 TestOutcome = collections.namedtuple('TestOutcome',
-                                     ['file', 'passed', 'output'])
+                                     ['file', 'passed', 'output', 'usage'])
+
+# Struc that holds the resources used by a command (maxrss in kilobytes)
+ResourceUsage = collections.namedtuple('ResourceUsage',
+                                       ['wall', 'user', 'sys', 'maxrss'])
+
+# Struc that holds a test category, tests are indices into Manifest.tests.
+# Performance categories have a budget_multiplier: their tests must
+# also finish within that multiple of the reference solution's CPU time.
+Category = collections.namedtuple('Category', ['pattern', 'weight', 'tests',
+                                               'budget_multiplier'])
+
+# Struc that holds everything needed to run and grade a Test_Suite
+Manifest = collections.namedtuple('Manifest',
+                                  ['version', 'tests', 'categories',
+                                   'extra_categories', 'needed_files',
+                                   'digests'])
 
 
 class TestResult(Exception):
     """
     Test results are raised as exceptions.
+    The ResourceUsage of the project (if it ran) is stored in usage.
     """
-    pass
+    usage = None
 
 
 class TestFailed(TestResult):
@@ -96,27 +182,276 @@ Please include this message and stack trace to assist debugging.
         self.args = [long_message]
 
 
-def calculate_grade(outcomes, print_output=True):
+def read_points(test_suite_folder):
+    """
+    Returns a list of (test glob, points, budget multiplier) triples from
+    the points.txt file. Each line is a category glob and its points,
+    optionally followed by "perf=<multiplier>" for performance categories.
+    """
+    points_path = os.path.join(test_suite_folder, POINTS_FILENAME)
+    test_globs_to_points = []
+    with open(points_path, 'r') as file_handle:
+        for line in file_handle:
+            if not line.strip():
+                continue
+            category, point_str, *options = line.split()
+            point_value = float(point_str)
+            budget_multiplier = None
+            for option in options:
+                key, _, value = option.partition("=")
+                if key != "perf":
+                    raise InternalTestSuiteException(
+                        "Unknown option in {}: {}".format(points_path,
+                                                          option))
+                budget_multiplier = float(value)
+
+            category_path = os.path.join(test_suite_folder, category)
+            test_globs_to_points.append(
+                (category_path, point_value, budget_multiplier))
+    return test_globs_to_points
+
+
+def read_needed_files(test_suite_folder):
+    """
+    Returns the list of files from the needed_files.txt file.
+    """
+    needed_files_path = os.path.join(test_suite_folder, NEEDED_FILES_FILENAME)
+    with open(needed_files_path, 'r') as file_handle:
+        return [line.strip() for line in file_handle]
+
+
+def get_suite_version(test_suite_folder):
+    """
+    Returns a digest identifying the current contents of the Test_Suite
+    (file names, sizes and modification times).
+    """
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(test_suite_folder):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename in SUITE_CACHE_FILENAMES:
+                continue
+            stat = os.stat(os.path.join(dirpath, filename))
+            entries.append("{} {} {}".format(
+                os.path.join(dirpath, filename), stat.st_size,
+                stat.st_mtime_ns))
+    key = "\n".join([str(MANIFEST_FORMAT)] + entries)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def get_test_digest(test_file_path):
+    """
+    Returns a digest of a test's input and correct output.
+    """
+    digest = hashlib.sha1()
+    paths = [test_file_path]
+    if test_file_path.endswith("input.txt"):
+        paths.append(test_file_path[:-len("input.txt")] + "correct.txt")
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, 'rb') as file_handle:
+                digest.update(file_handle.read())
+    return digest.hexdigest()
+
+
+def compile_manifest(test_suite_folder, version):
+    """
+    Globs the Test_Suite once and records every test, the tests in each
+    category (so grading doesn't need to pattern match) and their digests.
+    """
+    test_globs_to_points = read_points(test_suite_folder)
+    extra_globs_to_points = [
+        (os.path.join(test_suite_folder, test_glob), points, None)
+        for test_glob, points in EXTRA_CREDIT_TEST_FILES_TO_POINTS.items()]
+
+    tests = []
+    for test_file in test_files_in_order(
+            [test_glob for test_glob, _, _ in test_globs_to_points] +
+            [test_glob for test_glob, _, _ in extra_globs_to_points]):
+        if test_file not in tests:
+            tests.append(test_file)
+
+    def make_categories(test_globs_to_points):
+        categories = []
+        for test_glob, points, budget_multiplier in test_globs_to_points:
+            members = [index for index, test in enumerate(tests)
+                       if fnmatch.fnmatch(test, test_glob)]
+            categories.append(
+                Category(test_glob, points, members, budget_multiplier))
+        return categories
+
+    return Manifest(version=version,
+                    tests=tests,
+                    categories=make_categories(test_globs_to_points),
+                    extra_categories=make_categories(extra_globs_to_points),
+                    needed_files=read_needed_files(test_suite_folder),
+                    digests={test: get_test_digest(test) for test in tests})
+
+
+def manifest_from_json(data):
+    """
+    Rebuilds a Manifest from its json form.
+    """
+    def to_categories(rows):
+        return [Category(*row) for row in rows]
+    manifest = Manifest(**data)
+    return manifest._replace(
+        categories=to_categories(manifest.categories),
+        extra_categories=to_categories(manifest.extra_categories))
+
+
+def write_manifest(manifest, manifest_path):
+    """
+    Caches the manifest, silently giving up if the Test_Suite is read only.
+    """
+    temp_path = "{}.{}.tmp".format(manifest_path, os.getpid())
+    try:
+        with open(temp_path, 'w') as file_handle:
+            json.dump(manifest._asdict(), file_handle)
+        os.replace(temp_path, manifest_path)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+
+
+@functools.lru_cache(maxsize=None)
+def load_manifest(test_suite_folder=TEST_SUITE_FOLDER):
+    """
+    Returns the Manifest for the Test_Suite, using the cached copy next to
+    the suite if it matches the suite's current version.
+    """
+    version = get_suite_version(test_suite_folder)
+    manifest_path = os.path.join(test_suite_folder, MANIFEST_FILENAME)
+    try:
+        with open(manifest_path, 'r') as file_handle:
+            manifest = manifest_from_json(json.load(file_handle))
+        if manifest.version == version:
+            return manifest
+    except (OSError, ValueError, TypeError):
+        pass
+    manifest = compile_manifest(test_suite_folder, version)
+    write_manifest(manifest, manifest_path)
+    return manifest
+
+
+def get_perf_tests(manifest):
+    """
+    Returns a dictionary of performance tests to their budget multiplier
+    (the smallest multiplier if a test is in more than one category).
+    """
+    test_to_multiplier = {}
+    for category in manifest.categories + manifest.extra_categories:
+        if category.budget_multiplier is None:
+            continue
+        for index in category.tests:
+            test = manifest.tests[index]
+            test_to_multiplier[test] = min(
+                category.budget_multiplier,
+                test_to_multiplier.get(test, category.budget_multiplier))
+    return test_to_multiplier
+
+
+def load_calibration(manifest, test_suite_folder=TEST_SUITE_FOLDER):
+    """
+    Returns a dictionary of performance tests to the reference solution's
+    CPU time on this host, or None if this host hasn't been calibrated
+    for the current version of the Test_Suite.
+    """
+    calibration_path = os.path.join(test_suite_folder, CALIBRATION_FILENAME)
+    try:
+        with open(calibration_path, 'r') as file_handle:
+            hosts = json.load(file_handle)
+    except (OSError, ValueError):
+        return None
+    calibration = hosts.get(socket.gethostname())
+    if not calibration or calibration.get("version") != manifest.version:
+        return None
+    return calibration["reference_times"]
+
+
+def calibrate(manifest, test_suite_folder=TEST_SUITE_FOLDER):
+    """
+    Measures the reference solution (the project in the current directory)
+    on every performance test and records the fastest of CALIBRATION_RUNS
+    CPU times for this host. Does nothing if already calibrated.
+    """
+    perf_tests = get_perf_tests(manifest)
+    if not perf_tests or load_calibration(manifest,
+                                          test_suite_folder) is not None:
+        return
+    reference_times = {}
+    for test_file_path in sorted(perf_tests):
+        cpu_times = []
+        for _ in range(CALIBRATION_RUNS):
+            passed, output, usage = get_test_result(test_file_path,
+                                                    reference=True)
+            if not passed:
+                raise InternalTestSuiteException(
+                    "Reference solution failed performance test {}:\n{}"
+                    .format(test_file_path, "\n".join(output)))
+            cpu_times.append(usage.user + usage.sys)
+        reference_times[test_file_path] = min(cpu_times)
+        print("{:<40} {:.3f}s CPU".format(test_file_path,
+                                           reference_times[test_file_path]))
+
+    calibration_path = os.path.join(test_suite_folder, CALIBRATION_FILENAME)
+    try:
+        with open(calibration_path, 'r') as file_handle:
+            hosts = json.load(file_handle)
+    except (OSError, ValueError):
+        hosts = {}
+    hosts[socket.gethostname()] = {"version": manifest.version,
+                                   "reference_times": reference_times}
+    with open(calibration_path, 'w') as file_handle:
+        json.dump(hosts, file_handle, indent=1, sort_keys=True)
+
+
+def get_budgets(manifest, require_calibration):
     """
-    Takes an iterable of TestOutcomes and returns the points
-    (and extra credit points) awarded. It also can print the tests outcomes.
+    Returns a dictionary of performance tests to their CPU time budgets.
+    Without a calibration for this host, performance tests are only
+    checked for correctness (unless require_calibration is True).
+    """
+    perf_tests = get_perf_tests(manifest)
+    if not perf_tests:
+        return {}
+    reference_times = load_calibration(manifest)
+    if reference_times is None:
+        if require_calibration:
+            raise InternalTestSuiteException(
+                "No performance calibration for host {}; run "
+                "'run_tests.py --calibrate' with the reference solution."
+                .format(socket.gethostname()))
+        print("Warning: performance tests aren't calibrated for this "
+              "machine, only checking their output.")
+        return {}
+    return {test: max(reference_times[test] * multiplier, PERF_MIN_BUDGET)
+            for test, multiplier in perf_tests.items()
+            if test in reference_times}
+
+
+def calculate_grade(outcomes, manifest, print_output=True):
+    """
+    Takes an iterable of TestOutcomes and the suite's Manifest and returns
+    the points (and extra credit points) awarded.
+    It also can print the tests outcomes.
     """
 
-    def grade_category(file_token, test_to_passed, weight, proportional=False):
+    def grade_category(category, test_to_passed, proportional=False):
         """
-        Takes a pattern (i.e. "test.initial.*"),
+        Takes a Category (its pattern, i.e. "test.initial.*",
+        weight in points and tests),
         a dictionary of test_names to if passed booleans,
-        the weigth in points of the category,
         and if the points are proportional
         (in accordance with the number of tests passed)
         or not (all-or-nothing).
         """
         score = 0
-        tests = []
-        output = ["Grading tests '{}'.".format(file_token)]
-        for test, passed in test_to_passed.items():
-            if fnmatch.fnmatch(test, file_token):
-                tests.append(passed)
+        weight = category.weight
+        output = ["Grading tests '{}'.".format(category.pattern)]
+        tests = [test_to_passed[manifest.tests[index]]
+                 for index in category.tests
+                 if manifest.tests[index] in test_to_passed]
 
         if not tests:
             raise NoMatchingTestsFound()
@@ -143,21 +478,20 @@ def calculate_grade(outcomes, print_output=True):
             score, weight))
         return output, score
 
-    def get_output_score(test_to_passed, category_to_weight):
+    def get_output_score(test_to_passed, categories):
         """
         Returns the output and score for every test category.
         """
         output = []
         total = 0.0
         total_weight = 0.0
-        for test_type, weight in category_to_weight.items():
+        for category in categories:
             try:
                 partial_output, partial_score = grade_category(
-                    test_type, test_to_passed,
-                    weight=weight, proportional=True)
+                    category, test_to_passed, proportional=True)
                 output += partial_output
                 total += partial_score
-                total_weight += weight
+                total_weight += category.weight
             except NoMatchingTestsFound:
                 pass
         return output, total, total_weight
@@ -180,7 +514,7 @@ def calculate_grade(outcomes, print_output=True):
     total += needed_score
 
     test_output, test_score, total_weight = get_output_score(
-        test_to_passed, TEST_FILES_TO_POINTS)
+        test_to_passed, manifest.categories)
 
     if test_score == total_weight:
         points_for_passing_all_awarded = POINTS_FOR_PASSING_ALL
@@ -196,7 +530,7 @@ def calculate_grade(outcomes, print_output=True):
     total += test_score
 
     extra_output, extra_score, extra_weight = get_output_score(
-        test_to_passed, EXTRA_CREDIT_TEST_FILES_TO_POINTS)
+        test_to_passed, manifest.extra_categories)
     if extra_output:
         output += ["", "Extra credit (not actually worth points):"]
         output += extra_output + [""]
@@ -204,37 +538,129 @@ def calculate_grade(outcomes, print_output=True):
     if print_output:
         print("\n".join(output))
         possible_points = NEEDED_FILES_POINTS + sum(
-            TEST_FILES_TO_POINTS.values()) + POINTS_FOR_PASSING_ALL
+            category.weight for category in manifest.categories
+        ) + POINTS_FOR_PASSING_ALL
         print("Current tentative grade is: {:.1f} of {:.1f}".format(
             total, possible_points))
     return total, extra_score
 
 
-def check_needed_files():
+def check_needed_files(needed_files):
     """
-    Raise appropiate TestResult for if the NEEDED_FILES are present.
+    Raise appropiate TestResult for if the needed_files are present.
     """
-    for filename in NEEDED_FILES:
+    for filename in needed_files:
         if not os.path.exists(filename):
             raise TestFailed([
                 "Failed ('{}' file doesn't exist)".format(filename)])
     raise TestPassed(["Passed (has all required files)"])
 
 
+class RunCancelled(Exception):
+    """
+    This class is used to indicate a test run was abandoned
+    (because the project changed while it was running).
+    """
+    pass
+
+
+class OutputLimitExceeded(Exception):
+    """
+    This class is used to indicate a command produced more output than
+    allowed (the command has already been killed).
+    """
+    pass
+
+
+def kill_process_group(proc):
+    """
+    Kills the process and every process it started.
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def capture_output(args, timeout=None, limit=OUTPUT_LIMIT, stdin=None,
+                   cwd=None, stderr=subprocess.STDOUT):
+    """
+    Runs the command (in cwd, reading stdin from the given file if any),
+    streaming its stdout (and stderr, unless stderr says where else it
+    goes) through a buffer of at most limit bytes, and returns the output,
+    returncode and the ResourceUsage of the command (and the processes it
+    waited for).
+    The command is killed (and OutputLimitExceeded raised) as soon as
+    the limit is hit, so memory use doesn't depend on what it prints.
+    Raises subprocess.TimeoutExpired if the command takes too long.
+    """
+    start = time.monotonic()
+    deadline = None if timeout is None else start + timeout
+
+    def time_left():
+        if deadline is None:
+            return None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise subprocess.TimeoutExpired(args, timeout)
+        return remaining
+
+    def wait_for_usage(proc):
+        """
+        Reaps the command with wait4 (to get its rusage),
+        without waiting past the deadline.
+        """
+        while True:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                proc.returncode = os.waitstatus_to_exitcode(status)
+                wall = time.monotonic() - start
+                return ResourceUsage(wall, rusage.ru_utime, rusage.ru_stime,
+                                     rusage.ru_maxrss)
+            time.sleep(min(WAIT_POLL_INTERVAL, time_left() or
+                           WAIT_POLL_INTERVAL))
+
+    buffer = bytearray()
+    with subprocess.Popen(args, stdin=stdin, stdout=subprocess.PIPE,
+                          stderr=stderr, cwd=cwd,
+                          start_new_session=True) as proc:
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(proc.stdout, selectors.EVENT_READ)
+                while True:
+                    if not selector.select(time_left()):
+                        continue
+                    chunk = os.read(proc.stdout.fileno(), READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if len(buffer) + len(chunk) > limit:
+                        raise OutputLimitExceeded(limit)
+                    buffer += chunk
+            usage = wait_for_usage(proc)
+        except (subprocess.TimeoutExpired, OutputLimitExceeded):
+            kill_process_group(proc)
+            raise
+    return decode_output(bytes(buffer)), proc.returncode, usage
+
+
+def decode_output(raw_output):
+    """
+    Decodes output the way universal_newlines=True would.
+    """
+    encoding = locale.getpreferredencoding(False)
+    output = raw_output.decode(encoding, errors="replace")
+    return output.replace("\r\n", "\n").replace("\r", "\n")
+
+
 def call_and_get_output(args, timeout=None):
     """
-    Run command (and possible timeout), returning the output and returncode.
-    If the command times out or raises an OSError (likely file not found),
-    raise a TestFailed.
+    Run command (and possible timeout), returning the output, returncode
+    and ResourceUsage.
+    If the command times out, prints too much or raises an OSError
+    (likely file not found), raise a TestFailed.
     """
     try:
-        output = subprocess.check_output(args, stderr=subprocess.STDOUT,
-                                         universal_newlines=True,
-                                         timeout=timeout)
-        returncode = 0
-    except subprocess.CalledProcessError as cpe:
-        output = cpe.output
-        returncode = cpe.returncode
+        output, returncode, usage = capture_output(args, timeout=timeout)
     except subprocess.TimeoutExpired as te:
         command_str = " ".join(args)
         output = ["""
@@ -243,30 +669,75 @@ def call_and_get_output(args, timeout=None):
             command_str, te.timeout),
             "Failed (execution took too long)"]
         raise TestFailed(output)
+    except OutputLimitExceeded as ole:
+        command_str = " ".join(args)
+        output = ["""
+        Command: {} printed too much.
+        Process printed more than {} bytes. Killing it.""".format(
+            command_str, ole.args[0]),
+            "Failed (output limit exceeded)"]
+        raise TestFailed(output)
     except OSError as ose:
         output = ["Command: \"" + " ".join(args) + "\" raised OSError",
                   ose.strerror,
                   "Failed (couldn't run command {})".format(" ".join(args))]
         raise TestFailed(output)
 
-    return output, returncode
+    return output, returncode, usage
+
+
+def read_project_usage(usage_path):
+    """
+    Returns the ResourceUsage run_single_test.py measured for the project
+    (None if it didn't write one, i.e. an older run_single_test.py).
+    """
+    try:
+        with open(usage_path, 'r') as file_handle:
+            return ResourceUsage(**json.load(file_handle))
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def format_usage(usage):
+    return "{:.3f}s CPU ({:.3f}s user, {:.3f}s sys), {:.3f}s wall, " \
+        "{} KB peak RSS".format(usage.user + usage.sys, usage.user,
+                                usage.sys, usage.wall, usage.maxrss)
+
+
+def get_diff(correct_output, project_output):
+    """
+    Returns the lines of a context diff between the outputs
+    (empty if the test passed).
+    """
+    return list(difflib.context_diff(correct_output.splitlines(True),
+                                     project_output.splitlines(True),
+                                     fromfile="Correct Output",
+                                     tofile="Student Output",
+                                     lineterm='\n'))
 
 
-def run_test(test_file_path):
+def run_test(test_file_path, budget=None, reference=False):
     """
     Runs a given test file (uses PROJECT_EXECUTABLE),
     raises either TestPassed or TestFailed.
+    If a budget (in CPU seconds) is given, the test also fails if the
+    project uses more CPU time than that.
+    If reference is True, the project is the reference solution
+    (so the files it writes aren't limited).
+    The ResourceUsage of the project is stored in the TestResult's usage.
     """
+    measured = {}
 
     @contextlib.contextmanager
     def add_lines_to_TestResult(lines):
         """
-        Captures TestResult exceptions and adds lines to them.
+        Captures TestResult exceptions and adds lines (and usage) to them.
         """
         try:
             yield
         except TestResult as tr:
             tr.args = (lines + tr.args[0],)
+            tr.usage = measured.get("usage")
             raise tr
 
     def run_executable(args):
@@ -276,10 +747,17 @@ def run_test(test_file_path):
         test_path = args[0]
         base_command = ["./" + PROJECT_EXECUTABLE, test_path]
         project_command = base_command
+        if budget is not None:
+            project_timeout = min(budget * PERF_TIMEOUT_FACTOR,
+                                  TEST_TIMEOUT - 1)
+            project_command = base_command + [
+                "--timeout={}".format(project_timeout)]
+        if reference:
+            project_command = project_command + ["--reference"]
         correct_command = base_command + ["--correct"]
         input_command = base_command + ["--input"]
 
-        correct_stdout, correct_returncode = call_and_get_output(
+        correct_stdout, correct_returncode, _ = call_and_get_output(
             correct_command, timeout=TEST_TIMEOUT)
         if correct_returncode:
             raise InternalTestSuiteException("""
@@ -287,11 +765,29 @@ def run_test(test_file_path):
             Command: {}
             Output: {}
             """.format(correct_command, correct_stdout))
-        project_stdout, project_returncode = call_and_get_output(
-            project_command, timeout=TEST_TIMEOUT)
-        input_stdout, _ = call_and_get_output(input_command)
-
-        lines = ["Test Contents:", input_stdout]
+        with tempfile.TemporaryDirectory(prefix="run_tests_") as usage_dir:
+            usage_path = os.path.join(usage_dir, USAGE_FILENAME)
+            project_stdout, project_returncode, usage = call_and_get_output(
+                project_command + ["--usage-file=" + usage_path],
+                timeout=TEST_TIMEOUT)
+            # Falls back to the usage of the whole harness process tree
+            usage = read_project_usage(usage_path) or usage
+        measured["usage"] = usage
+        input_stdout, _, _ = call_and_get_output(input_command)
+
+        lines = ["Test Contents:", input_stdout,
+                 "Resources used: " + format_usage(usage)]
+        if budget is not None:
+            cpu_time = usage.user + usage.sys
+            lines.append("Performance budget: {:.3f}s CPU".format(budget))
+            if cpu_time > budget:
+                lines += ["Failed (exceeded performance budget: "
+                          "{:.3f}s of {:.3f}s CPU)".format(cpu_time, budget)]
+                raise TestFailed(lines)
+        if project_returncode == OUTPUT_LIMIT_EXCEEDED_RETURNCODE:
+            lines += [project_stdout,
+                      "Failed (output limit exceeded)"]
+            raise TestFailed(lines)
         if project_returncode:
             lines += ["Failed (Executable returned a non-zero error code)"]
             raise TestFailed(lines)
@@ -301,12 +797,7 @@ def run_test(test_file_path):
         """
         Raises appropiate TestResult according to diff of created files.
         """
-        correct_output = correct_stdout.splitlines(True)
-        project_output = project_stdout.splitlines(True)
-        diff_lines = list(difflib.context_diff(correct_output, project_output,
-                                               fromfile="Correct Output",
-                                               tofile="Student Output",
-                                               lineterm='\n'))
+        diff_lines = get_diff(correct_stdout, project_stdout)
         if not diff_lines:
             raise TestPassed(["Passed"])
         else:
@@ -333,23 +824,42 @@ def test_files_in_order(test_globs):
             yield test_file
 
 
-def get_test_result(test_file_path):
+def get_test_result(test_file_path, budget=None, reference=False):
     """
-    Runs the test file and returns if the test passed and what the output was.
+    Runs the test file and returns if the test passed, what the output was
+    and the ResourceUsage of the project (None if it couldn't run).
     """
     try:
-        run_test(test_file_path)
+        run_test(test_file_path, budget, reference)
     except TestFailed as tf:
         passed = False
         output = tf.args[0]
+        usage = tf.usage
     except TestPassed as tp:
         passed = True
         output = tp.args[0]
+        usage = tp.usage
     else:
         message = "No TestResult Exception Raised On Test: {}".format(
             test_file_path)
         raise InternalTestSuiteException(message)
-    return passed, output
+    return passed, output, usage
+
+
+def print_slowest_tests(outcomes, number_shown):
+    """
+    Prints the tests that used the most CPU time.
+    """
+    measured = [outcome for outcome in outcomes if outcome.usage is not None]
+    measured.sort(key=lambda outcome: outcome.usage.user + outcome.usage.sys,
+                  reverse=True)
+    if not measured or number_shown <= 0:
+        return
+    print("Slowest Tests:")
+    for outcome in measured[:number_shown]:
+        print("{:<40} {}".format(outcome.file, format_usage(outcome.usage)))
+    total_wall = sum(outcome.usage.wall for outcome in measured)
+    print("Total time running tests: {:.3f}s wall".format(total_wall))
 
 
 def print_first_failure(outcomes):
@@ -365,35 +875,108 @@ def print_first_failure(outcomes):
         print("\n".join(first_failure.output))
 
 
-def run_tests(test_globs_to_points):
+def run_tests(test_files, budgets=None, fail_fast=False, cancel=None):
     """
     Runs the tests, and returns a list of TestOutcomes.
+    Budgets is a dictionary of performance tests to their CPU time budget.
+    If fail_fast is True, stops after the first failing test.
+    If given, cancel is called before each test and the run is abandoned
+    (raising RunCancelled) if it returns True.
     """
+    if budgets is None:
+        budgets = {}
     outcomes = []
-    test_globs = test_globs_to_points.keys()
-    for test_file_path in test_files_in_order(test_globs):
-        passed, output = get_test_result(test_file_path)
-        outcome = TestOutcome(test_file_path, passed, output)
+    for test_file_path in test_files:
+        if cancel is not None and cancel():
+            raise RunCancelled()
+        passed, output, usage = get_test_result(test_file_path,
+                                                budgets.get(test_file_path))
+        outcome = TestOutcome(test_file_path, passed, output, usage)
         outcomes.append(outcome)
+        if fail_fast and not passed:
+            break
     return outcomes
 
 
-def get_all_outcomes(tests, extra=None):
+def get_category_tests(manifest, categories):
+    """
+    Returns the tests in the categories in the order they should be run.
+    """
+    indices = sorted({index for category in categories
+                      for index in category.tests})
+    return [manifest.tests[index] for index in indices]
+
+
+def get_all_outcomes(manifest, extra=False, require_calibration=False,
+                     select_tests=None, fail_fast=False, cancel=None):
     """
     Generates a list of TestOutcomes from the tests and has_needed_files
-    (including extra credit if provided).
+    (including extra credit if extra is True).
+    If given, select_tests takes the list of tests and returns the
+    tests to run (in the order to run them).
     """
     all_outcomes = []
+    budgets = get_budgets(manifest, require_calibration)
 
     check = try_to_outcome_wrapper("has_needed_files", check_needed_files)
-    all_outcomes.append(check())
-
-    all_outcomes.extend(run_tests(tests))
-    if extra is not None:
-        all_outcomes.extend(run_tests(extra))
+    all_outcomes.append(check(manifest.needed_files))
+
+    test_files = get_category_tests(manifest, manifest.categories)
+    if extra:
+        test_files += [
+            test_file for test_file in get_category_tests(
+                manifest, manifest.extra_categories)
+            if test_file not in test_files]
+    if select_tests is not None:
+        test_files = select_tests(test_files)
+    all_outcomes.extend(run_tests(test_files, budgets, fail_fast, cancel))
     return all_outcomes
 
 
+def load_history():
+    """
+    Returns a dictionary of tests to their recent outcomes (oldest first).
+    """
+    try:
+        with open(HISTORY_FILENAME, 'r') as file_handle:
+            return json.load(file_handle)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_history(history, outcomes):
+    """
+    Adds the outcomes to the history and saves it.
+    """
+    for outcome in outcomes:
+        recent = history.get(outcome.file, []) + [outcome.passed]
+        history[outcome.file] = recent[-HISTORY_LENGTH:]
+    with contextlib.suppress(OSError):
+        with open(HISTORY_FILENAME, 'w') as file_handle:
+            json.dump(history, file_handle)
+
+
+def order_by_history(test_files, history):
+    """
+    Moves the tests that failed the last time they were run to the front
+    (otherwise keeping the usual order).
+    """
+    def failed_last_time(test_file):
+        recent = history.get(test_file)
+        return bool(recent) and not recent[-1]
+    return sorted(test_files, key=lambda test_file: not failed_last_time(
+        test_file))
+
+
+def filter_tests(test_files, test_glob):
+    """
+    Returns the tests whose path or filename matches the glob.
+    """
+    return [test_file for test_file in test_files
+            if fnmatch.fnmatch(test_file, test_glob) or
+            fnmatch.fnmatch(os.path.basename(test_file), test_glob)]
+
+
 def try_to_outcome_wrapper(test_name, func):
     """
     Calls the provided function and generates a TestOutcome from the result.
@@ -403,9 +986,9 @@ def try_to_outcome_wrapper(test_name, func):
         try:
             func(*args, **kwargs)
         except TestFailed as tf:
-            return TestOutcome(test_name, False, tf.args[0])
+            return TestOutcome(test_name, False, tf.args[0], None)
         except TestPassed as tp:
-            return TestOutcome(test_name, True, tp.args[0])
+            return TestOutcome(test_name, True, tp.args[0], None)
         raise InternalTestSuiteException(
             "Test Name = {} isn't passing or failing.")
     return wrapper
@@ -436,37 +1019,53 @@ def machine_mode():
     """
     This function is called when --run-machine-mode is specified.
     The output is made to be parsed by the autograder.
+    Each test line is "name, passed" followed by the project's wall,
+    user and sys time (in seconds) and peak RSS (in KB) when it ran.
     """
-    outcomes = get_all_outcomes(
-        TEST_FILES_TO_POINTS,
-        EXTRA_CREDIT_TEST_FILES_TO_POINTS)
+    manifest = load_manifest()
+    outcomes = get_all_outcomes(manifest, extra=True,
+                                require_calibration=True)
 
     lines = []
     for outcome in outcomes:
         file_basename = os.path.basename(outcome.file)
         passed = 1 if outcome.passed else 0
-        lines.append("{}, {}".format(file_basename, passed))
-    regular_grade, extra_grade = calculate_grade(outcomes, print_output=False)
+        fields = [file_basename, passed]
+        if outcome.usage is not None:
+            fields += ["{:.4f}".format(seconds)
+                       for seconds in outcome.usage[:3]]
+            fields.append(outcome.usage.maxrss)
+        lines.append(", ".join(map(str, fields)))
+    regular_grade, extra_grade = calculate_grade(outcomes, manifest,
+                                                 print_output=False)
     lines.append("{}, {}".format("grade", regular_grade))
     lines.append("{}, {}".format("extra_credit", extra_grade))
     print("\n".join(lines))
 
 
-def normal_mode(args):
+def run_and_report(args, cancel=None):
     """
-    Default function that runs the tests and pretty outputs the test results,
+    Runs the tests and pretty outputs the test results,
     the grade, and the details regarding the first failure.
+    Tests that failed last time are run first.
+    Returns if every test passed.
     """
-    # check_for_uncommitted_work()
     print("Starting Tests")
     sys.stdout.flush()
 
-    if args['extra']:
-        outcomes = get_all_outcomes(
-            TEST_FILES_TO_POINTS,
-            EXTRA_CREDIT_TEST_FILES_TO_POINTS)
-    else:
-        outcomes = get_all_outcomes(TEST_FILES_TO_POINTS)
+    manifest = load_manifest()
+    history = load_history()
+
+    def select_tests(test_files):
+        if args['only'] is not None:
+            test_files = filter_tests(test_files, args['only'])
+        return order_by_history(test_files, history)
+
+    outcomes = get_all_outcomes(manifest, extra=args['extra'],
+                                select_tests=select_tests,
+                                fail_fast=args['fail_fast'],
+                                cancel=cancel)
+    save_history(history, outcomes[1:])
 
     def passed_all_tests(outcomes):
         return all(outcome.passed for outcome in outcomes)
@@ -476,19 +1075,211 @@ def normal_mode(args):
         print(output)
 
     print()
-    regular_grade, extra_grade = calculate_grade(outcomes, print_output=True)
+    print_slowest_tests(outcomes, args['slowest'])
+    print()
+    if args['only'] is not None or args['fail_fast']:
+        print("Grade not calculated (not every test was run).")
+    else:
+        regular_grade, extra_grade = calculate_grade(outcomes, manifest,
+                                                     print_output=True)
     print()
 
     if passed_all_tests(outcomes):
         print("Passes all tests!")
-        exit(0)
+        return True
     else:
         print()
         print("First Failure's Details:")
         print_first_failure(outcomes)
+        return False
+
+
+def normal_mode(args):
+    """
+    Default function that runs the tests and pretty outputs the results.
+    """
+    # check_for_uncommitted_work()
+    if run_and_report(args):
+        exit(0)
+    else:
         exit(1)
 
 
+def is_watched_directory(path):
+    """
+    Returns if files in the directory can trigger a rerun
+    (hidden directories, like .git, can't).
+    """
+    return not any(part.startswith(".") or part == "__pycache__"
+                   for part in os.path.normpath(path).split(os.sep)
+                   if part != ".")
+
+
+def is_watched(path):
+    """
+    Returns if changes to the file should trigger a rerun.
+    """
+    filename = os.path.basename(path)
+    if filename.startswith(".") or not is_watched_directory(
+            os.path.dirname(path)):
+        return False
+    in_test_suite = os.path.normpath(path).startswith(
+        TEST_SUITE_FOLDER + os.sep)
+    return in_test_suite or any(fnmatch.fnmatch(filename, pattern)
+                                for pattern in WATCHED_FILE_PATTERNS)
+
+
+def get_watched_directories(root):
+    directories = []
+    for dirpath, dirnames, _ in os.walk(root):
+        dirnames[:] = [dirname for dirname in dirnames
+                       if is_watched_directory(os.path.join(dirpath,
+                                                            dirname))]
+        directories.append(dirpath)
+    return directories
+
+
+class InotifyWatcher(object):
+    """
+    Watches every directory under root using Linux's inotify.
+    """
+
+    def __init__(self, root):
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("Can't find libc for inotify")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.root = root
+        self.watched = {}
+        self.add_watches()
+
+    def add_watches(self):
+        for directory in get_watched_directories(self.root):
+            if directory in self.watched.values():
+                continue
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(directory), IN_WATCH_MASK)
+            if wd >= 0:
+                self.watched[wd] = directory
+
+    def changed(self, timeout):
+        """
+        Waits up to timeout seconds and returns if a watched file changed.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = INOTIFY_EVENT_HEADER.unpack_from(
+                    data, offset)
+                offset += INOTIFY_EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                path = os.path.join(self.watched.get(wd, self.root),
+                                    os.fsdecode(name))
+                if mask & IN_ISDIR:
+                    self.add_watches()
+                elif is_watched(path):
+                    changed = True
+        return changed
+
+
+class PollingWatcher(object):
+    """
+    Watches every file under root by comparing modification times.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.snapshot = self.take_snapshot()
+
+    def take_snapshot(self):
+        snapshot = {}
+        for directory in get_watched_directories(self.root):
+            with contextlib.suppress(OSError):
+                for entry in os.scandir(directory):
+                    if entry.is_file() and is_watched(entry.path):
+                        stat = entry.stat()
+                        snapshot[entry.path] = (stat.st_mtime_ns,
+                                                stat.st_size)
+        return snapshot
+
+    def changed(self, timeout):
+        """
+        Waits up to timeout seconds and returns if a watched file changed.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            snapshot = self.take_snapshot()
+            if snapshot != self.snapshot:
+                self.snapshot = snapshot
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(WATCH_POLL_INTERVAL, remaining))
+
+
+def make_watcher(root):
+    """
+    Returns an inotify based watcher, or a polling one if that isn't
+    available on this system.
+    """
+    try:
+        return InotifyWatcher(root)
+    except (OSError, AttributeError):
+        print("Note: inotify isn't available, checking for changes every "
+              "{} seconds.".format(WATCH_POLL_INTERVAL))
+        return PollingWatcher(root)
+
+
+def watch_mode(args):
+    """
+    Runs the tests every time a project file changes (previously failing
+    tests first), abandoning a run if the project changes during it.
+    """
+    watcher = make_watcher(".")
+
+    def wait_for_settle():
+        while watcher.changed(WATCH_SETTLE_TIME):
+            pass
+
+    def cancel():
+        if watcher.changed(0):
+            wait_for_settle()
+            return True
+        return False
+
+    try:
+        while True:
+            load_manifest.cache_clear()
+            try:
+                run_and_report(args, cancel=cancel)
+            except RunCancelled:
+                print()
+                print("Change detected, restarting tests.")
+                continue
+            print()
+            print("Watching for changes (Ctrl-C to stop).")
+            sys.stdout.flush()
+            while not watcher.changed(WATCH_POLL_INTERVAL):
+                pass
+            wait_for_settle()
+            print("=" * 40)
+    except KeyboardInterrupt:
+        print()
+
+
 if __name__ == "__main__":
     """
     Runs the tests and chooses output mode.
@@ -505,10 +1296,34 @@ if __name__ == "__main__":
     parser.add_argument('--extra', action="store_true", help="""
     Runs the extra credit tests and reports their results as well.
     """)
+    parser.add_argument('--slowest', type=int, default=SLOWEST_TESTS_SHOWN,
+                        metavar="N", help="""
+    Number of slowest tests to show resource usage for
+    (defaults to {}, 0 to hide).
+    """.format(SLOWEST_TESTS_SHOWN))
+
+    parser.add_argument('--fail-fast', action="store_true", help="""
+    Stops after the first failing test.
+    """)
+    parser.add_argument('--only', metavar="GLOB", help="""
+    Only runs the tests whose path or filename matches GLOB
+    (i.e. "test.initial.*").
+    """)
+    parser.add_argument('--watch', action="store_true", help="""
+    Keeps running, rerunning the tests whenever a project file changes.
+    """)
+    parser.add_argument('--calibrate', action="store_true", help="""
+    Measures the reference solution on the performance tests (if this
+    machine isn't calibrated yet). For instructor use only.
+    """)
 
     args = vars(parser.parse_args())
 
-    if args['run_machine_mode']:
+    if args['calibrate']:
+        calibrate(load_manifest())
+    elif args['run_machine_mode']:
         machine_mode()
+    elif args['watch']:
+        watch_mode(args)
     else:
         normal_mode(args)
@@ -0,0 +1,239 @@
+"""
+The purpose of this module is to score a whole class at once.
+It builds a students x tests pass/fail matrix from a grades csv
+(as written by autograder.py grade) and applies the scoring policy
+from a Test_Suite's points.txt column by column, so categories can be
+re-weighted without rerunning any tests.
+"""
+import collections
+import csv
+import os
+import statistics
+
+import run_tests
+
+# Columns of the grades csv that aren't test results
+STUDENT_COLUMNS = ["MSU_Net_ID", "GitHub_Username", "Full_Name", "Commit",
+                   "Late_Penalty", "Round"]
+RESULT_COLUMNS = ["grade", "extra_credit"]
+NEEDED_FILES_COLUMN = "has_needed_files"
+
+# Number of buckets in the per-category score histograms
+HISTOGRAM_BUCKETS = 10
+
+# Struc that holds the pass/fail results of every student;
+# columns[j][i] is 1 if student i passed tests[j]
+ScoreMatrix = collections.namedtuple('ScoreMatrix',
+                                     ['header', 'rows', 'tests', 'columns'])
+
+# Struc that holds how points are awarded; categories are
+# (pattern, weight, column indices) triples
+ScoringPolicy = collections.namedtuple('ScoringPolicy',
+                                       ['categories', 'extra_categories',
+                                        'needed_files_points',
+                                        'points_for_passing_all'])
+
+# Struc that holds the result of scoring the matrix
+ClassScores = collections.namedtuple('ClassScores',
+                                     ['grades', 'extra_credit',
+                                      'category_scores'])
+
+
+class ScoringError(Exception):
+    pass
+
+
+def load_score_matrix(grades_csv):
+    """
+    Reads a grades csv into a ScoreMatrix (a blank test cell, i.e. a test
+    a merged revision didn't have, counts as failed).
+    """
+    with open(grades_csv, 'r') as csv_handle:
+        reader = csv.reader(csv_handle)
+        header = next(reader)
+        rows = list(reader)
+    tests = [column for column in header
+             if column not in STUDENT_COLUMNS + RESULT_COLUMNS]
+    indices = [header.index(test) for test in tests]
+    columns = [[float(row[index] or 0) for row in rows] for index in indices]
+    return ScoreMatrix(header, rows, tests, columns)
+
+
+def get_scoring_policy(
+        matrix, test_suite_folder, weights=None,
+        needed_files_points=run_tests.NEEDED_FILES_POINTS,
+        points_for_passing_all=run_tests.POINTS_FOR_PASSING_ALL):
+    """
+    Maps the categories of the Test_Suite onto the matrix's columns.
+    Weights (category pattern from points.txt to points) override the
+    weights in points.txt.
+    """
+    if weights is None:
+        weights = {}
+    manifest = run_tests.compile_manifest(test_suite_folder, version=None)
+    test_to_column = {test: index for index, test in enumerate(matrix.tests)}
+
+    def map_categories(categories):
+        mapped = []
+        for category in categories:
+            name = os.path.relpath(category.pattern, test_suite_folder)
+            columns = [test_to_column[os.path.basename(manifest.tests[i])]
+                       for i in category.tests
+                       if os.path.basename(manifest.tests[i])
+                       in test_to_column]
+            mapped.append((name, weights.get(name, category.weight),
+                           columns))
+        return mapped
+
+    unknown = set(weights) - {
+        os.path.relpath(category.pattern, test_suite_folder)
+        for category in manifest.categories}
+    if unknown:
+        raise ScoringError("Unknown categories: {}".format(
+            ", ".join(sorted(unknown))))
+    return ScoringPolicy(map_categories(manifest.categories),
+                         map_categories(manifest.extra_categories),
+                         needed_files_points,
+                         points_for_passing_all)
+
+
+def add_columns(columns, size):
+    """
+    Returns the elementwise sum of the columns.
+    """
+    if not columns:
+        return [0.0] * size
+    return [sum(values) for values in zip(*columns)]
+
+
+def scale_column(column, factor):
+    return [value * factor for value in column]
+
+
+def score_categories(matrix, categories):
+    """
+    Returns the total score and total weight columns, along with
+    each category's score column.
+    """
+    size = len(matrix.rows)
+    category_scores = collections.OrderedDict()
+    for name, weight, columns in categories:
+        if not columns:
+            continue
+        passes = add_columns([matrix.columns[j] for j in columns], size)
+        category_scores[name] = [weight * (number_of_passes / len(columns))
+                                 for number_of_passes in passes]
+    total_weight = sum(weight for name, weight, columns in categories
+                       if columns)
+    return add_columns(list(category_scores.values()), size), \
+        total_weight, category_scores
+
+
+def score_matrix(matrix, policy):
+    """
+    Applies the scoring policy to every student at once,
+    mirroring run_tests.calculate_grade.
+    """
+    size = len(matrix.rows)
+    if NEEDED_FILES_COLUMN in matrix.tests:
+        needed = matrix.columns[matrix.tests.index(NEEDED_FILES_COLUMN)]
+    else:
+        needed = [0.0] * size
+    needed_scores = scale_column(needed, policy.needed_files_points)
+
+    test_scores, total_weight, category_scores = score_categories(
+        matrix, policy.categories)
+    passing_all = [policy.points_for_passing_all
+                   if score == total_weight else 0
+                   for score in test_scores]
+    grades = add_columns([needed_scores, test_scores, passing_all], size)
+
+    extra_credit, _, _ = score_categories(matrix, policy.extra_categories)
+    return ClassScores(grades, extra_credit, category_scores)
+
+
+def write_scores(matrix, scores, output_csv):
+    """
+    Writes the grades csv back out with the recomputed grades.
+    """
+    rows = [list(row) for row in matrix.rows]
+    for column, values in (("grade", scores.grades),
+                           ("extra_credit", scores.extra_credit)):
+        if column not in matrix.header:
+            continue
+        index = matrix.header.index(column)
+        for row, value in zip(rows, values):
+            row[index] = value
+    with open(output_csv, 'w') as csv_handle:
+        writer = csv.writer(csv_handle)
+        writer.writerow(matrix.header)
+        writer.writerows(rows)
+
+
+def get_analytics(matrix, policy, scores):
+    """
+    Returns report lines with per-test pass rates and
+    per-category score distributions.
+    """
+    size = len(matrix.rows)
+    lines = ["Students: {}".format(size), "", "Per-test pass rates:"]
+    pass_rates = [sum(column) / size if size else 0.0
+                  for column in matrix.columns]
+    for test, rate in sorted(zip(matrix.tests, pass_rates),
+                             key=lambda pair: pair[1]):
+        lines.append("{:>6.1%}  {}".format(rate, test))
+
+    lines += ["", "Per-category score distributions:"]
+    weights = {name: weight for name, weight, _ in policy.categories}
+    distributions = list(scores.category_scores.items())
+    distributions.append(("grade", scores.grades))
+    for name, values in distributions:
+        if not values:
+            continue
+        lines.append("{}: mean {:.2f}, median {:.2f}, stdev {:.2f}, "
+                     "min {:.2f}, max {:.2f}".format(
+                         name, statistics.mean(values),
+                         statistics.median(values),
+                         statistics.pstdev(values),
+                         min(values), max(values)))
+        weight = weights.get(name)
+        if weight:
+            lines.append("  histogram (fraction of {} points): {}".format(
+                weight, " ".join(map(str, get_histogram(values, weight)))))
+    return lines
+
+
+def get_histogram(values, weight):
+    """
+    Counts the values falling in each of HISTOGRAM_BUCKETS equal
+    slices of [0, weight].
+    """
+    counts = [0] * HISTOGRAM_BUCKETS
+    for value in values:
+        bucket = int(value / weight * HISTOGRAM_BUCKETS)
+        counts[min(max(bucket, 0), HISTOGRAM_BUCKETS - 1)] += 1
+    return counts
+
+
+def rescore(grades_csv, test_suite_folder, weights=None,
+            needed_files_points=run_tests.NEEDED_FILES_POINTS,
+            points_for_passing_all=run_tests.POINTS_FOR_PASSING_ALL):
+    """
+    Rescores a grades csv and writes "rescored_<csv>" and
+    "analytics_for_<csv>.txt" next to it.
+    """
+    matrix = load_score_matrix(grades_csv)
+    policy = get_scoring_policy(matrix, test_suite_folder, weights,
+                                needed_files_points, points_for_passing_all)
+    scores = score_matrix(matrix, policy)
+
+    directory, filename = os.path.split(grades_csv)
+    write_scores(matrix, scores, os.path.join(directory,
+                                              "rescored_" + filename))
+    stem = os.path.splitext(filename)[0]
+    analytics_file = os.path.join(directory,
+                                  "analytics_for_{}.txt".format(stem))
+    with open(analytics_file, 'w') as file_handle:
+        file_handle.write("\n".join(get_analytics(matrix, policy, scores)))
+        file_handle.write("\n")
+    return scores
@@ -1,11 +1,31 @@
 #!/usr/bin/env python3
 import sys
 from zipfile import ZipFile
-from glob import glob
+import concurrent.futures
+import csv
 import os.path
-import subprocess
-import shutil
+import smtplib
+import threading
 import argparse
+from email.message import EmailMessage
+
+import roster
+
+FROM_ADDRESS = "do-not-reply@cse.msu.edu"
+SUBJECT_LINE = "Your HackerRank Report"
+BODY = "Attached is a pdf of your HackerRank report"
+
+SMTP_HOST = "localhost"
+SMTP_PORT = 25
+NUM_WORKERS = 4
+
+# Each recipient's status is appended to this file (next to the zip) as
+# soon as it is known, so a rerun only sends the reports that didn't go out
+STATUS_FILENAME_SUFFIX = "_status.csv"
+STATUS_FIELDS = ["email", "report", "status", "error"]
+SENT = "sent"
+FAILED = "failed"
+
 
 def get_email(hr_filepath):
     hr_filename = os.path.split(hr_filepath)[-1]
@@ -15,36 +35,173 @@ def get_email(hr_filepath):
     before_at, after_at = break_apart_underscores[-2:]
     return before_at + "@" + after_at
 
-def send_single_email(address, subject_line, body, attachment=None):
-    command = ['mutt', '-e', '""set from=do-not-reply@cse.msu.edu""', '-s', subject_line]
+
+def make_message(address, subject_line, body, attachment=None,
+                 attachment_name=None):
+    message = EmailMessage()
+    message["From"] = FROM_ADDRESS
+    message["To"] = address
+    message["Subject"] = subject_line
+    message.set_content(body)
     if attachment is not None:
-        command += ["-a", attachment]
-    command += [ "--", address]
-    with subprocess.Popen(command, stdin=subprocess.PIPE, universal_newlines=True) as proc:
-        proc.communicate(body)
+        message.add_attachment(attachment, maintype="application",
+                               subtype="pdf", filename=attachment_name)
+    return message
+
+
+class Mailer:
+    """
+    Sends messages over one SMTP connection per thread.
+    """
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT):
+        self.host = host
+        self.port = port
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        """
+        Opens a new connection for this thread (in place of its old one).
+        """
+        connection = smtplib.SMTP(self.host, self.port)
+        old_connection = getattr(self.local, "connection", None)
+        self.local.connection = connection
+        with self.lock:
+            if old_connection is not None:
+                self.connections.remove(old_connection)
+            self.connections.append(connection)
+        return connection
+
+    def send(self, message):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.connect()
+        try:
+            connection.send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            # The server may close idle connections, so reconnect (and
+            # greet the server again) once
+            self.connect().send_message(message)
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.quit()
+            except smtplib.SMTPException:
+                pass
+
+
+def get_reports(hr_zipfile):
+    """
+    Returns the zip members that are PDF reports.
+    """
+    return [member for member in hr_zipfile.infolist()
+            if not member.is_dir() and
+            member.filename.lower().endswith(".pdf")]
+
+
+def read_sent(status_filename):
+    """
+    Returns the set of reports already sent according to the status file.
+    """
+    if not os.path.exists(status_filename):
+        return set()
+    with open(status_filename, 'r') as status_handle:
+        return {row["report"] for row in csv.DictReader(status_handle)
+                if row["status"] == SENT}
+
+
+def send_reports(hr_zipfilename, mailer, num_workers=NUM_WORKERS,
+                 class_roster=None):
+    """
+    Emails every report in the zip straight from memory, recording each
+    recipient's status. Returns the number of reports sent and failed.
+    If a roster is given, reports for addresses that don't match a student
+    are reported (and not sent).
+    """
+    status_filename = hr_zipfilename + STATUS_FILENAME_SUFFIX
+    already_sent = read_sent(status_filename)
+    new_status_file = not os.path.exists(status_filename)
+    counts = {SENT: 0, FAILED: 0}
+    with ZipFile(hr_zipfilename) as hr_zipfile, \
+            open(status_filename, 'a') as status_handle:
+        status_writer = csv.DictWriter(status_handle, STATUS_FIELDS)
+        if new_status_file:
+            status_writer.writeheader()
+        reports = [member for member in get_reports(hr_zipfile)
+                   if member.filename not in already_sent]
+        if class_roster is not None:
+            def find_student(filename):
+                try:
+                    return class_roster.find_by_email(get_email(filename))
+                except ValueError:
+                    return None
+
+            matched, unmatched = class_roster.resolve(
+                [member.filename for member in reports], find_student)
+            roster.report_unmatched(hr_zipfilename, unmatched)
+            reports = [member for member in reports
+                       if member.filename in matched]
+
+        def send_report(email, member):
+            message = make_message(email, SUBJECT_LINE, BODY,
+                                   hr_zipfile.read(member),
+                                   os.path.basename(member.filename))
+            mailer.send(message)
+
+        with concurrent.futures.ThreadPoolExecutor(num_workers) as pool:
+            future_to_report = {}
+            for member in reports:
+                email = get_email(member.filename)
+                future = pool.submit(send_report, email, member)
+                future_to_report[future] = (email, member)
+            for future in concurrent.futures.as_completed(future_to_report):
+                email, member = future_to_report[future]
+                try:
+                    future.result()
+                    status, error = SENT, ""
+                except (smtplib.SMTPException, OSError) as exc:
+                    status, error = FAILED, str(exc)
+                    print("Problem sending {} to {}: {}".format(
+                        member.filename, email, exc))
+                counts[status] += 1
+                status_writer.writerow({"email": email,
+                                        "report": member.filename,
+                                        "status": status, "error": error})
+                status_handle.flush()
+    if already_sent:
+        print("Skipped {} reports already sent".format(len(already_sent)))
+    return counts[SENT], counts[FAILED]
+
 
 def main():
     parser = argparse.ArgumentParser(description="""
     This is a short script to email out the pdfs generated by HackerRank.
-    Requires mutt (email program) to be installed.
+    Requires an SMTP server (localhost by default).
     """)
     parser.add_argument('HackerRank_Report_zip_file')
+    parser.add_argument('--smtp-host', default=SMTP_HOST)
+    parser.add_argument('--smtp-port', type=int, default=SMTP_PORT)
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS,
+                        help="Number of messages sent at once")
+    roster.add_roster_arguments(parser)
     args = parser.parse_args()
-    hr_zipfilename = args.HackerRank_Report_zip_file
 
-    hr_zipfile = ZipFile(hr_zipfilename)
-    dir = hr_zipfilename + "_unziped"
-    hr_zipfile.extractall(path=dir)
-    pdfs = glob(dir + "/*/*.pdf")
-    for pdf in pdfs:
-        email = get_email(pdf)
-        send_single_email(email, "Your HackerRank Report", "Attached is a pdf of your HackerRank report", pdf)
-    shutil.rmtree(dir)
+    mailer = Mailer(args.smtp_host, args.smtp_port)
+    try:
+        sent, failed = send_reports(args.HackerRank_Report_zip_file, mailer,
+                                    args.workers,
+                                    roster.roster_from_args(args))
+    finally:
+        mailer.close()
+    print("Sent {} reports, {} failed (see {})".format(
+        sent, failed,
+        args.HackerRank_Report_zip_file + STATUS_FILENAME_SUFFIX))
+    if failed:
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     main()
-
-#pdf_zipinfos  = hr_zipfile.infolist()
-#for pdf in pdf_zipinfos:
-#    print(pdf.filename)
-#    hr_zipfile.extract(pdf, "other_dir")
@@ -0,0 +1,183 @@
+"""
+The purpose of this module is to find clusters of similar student repos
+without comparing every pair of repos.
+Each repo is sketched with MinHash over normalized source shingles
+(leaving out code inherited from the base repo) and the sketches are
+banded (locality sensitive hashing) so only repos sharing a band are
+ever compared.
+"""
+import collections
+import fnmatch
+import random
+import subprocess
+
+import plagiarism_index
+
+# Files (at the graded tag) that are sketched
+SOURCE_PATTERNS = ["*.py"]
+
+# Number of tokens in each shingle
+SHINGLE_SIZE = 8
+
+# The signature has BANDS * ROWS_PER_BAND hashes. Pairs with similarity
+# around (1 / BANDS) ** (1 / ROWS_PER_BAND) (about 0.42) or more are
+# likely to share a band and be compared.
+BANDS = 32
+ROWS_PER_BAND = 4
+NUM_PERMUTATIONS = BANDS * ROWS_PER_BAND
+
+# Default estimated similarity for a pair to be reported
+DEFAULT_THRESHOLD = 0.5
+
+# Shingle hashes are 63 bits; permutations are (a * x + b) mod PRIME
+PRIME = (1 << 61) - 1
+PERMUTATION_SEED = 480
+
+
+def make_permutations(seed):
+    """
+    Returns NUM_PERMUTATIONS (a, b) pairs, the same every run.
+    """
+    generator = random.Random(seed)
+    return [(generator.randrange(1, PRIME), generator.randrange(0, PRIME))
+            for _ in range(NUM_PERMUTATIONS)]
+
+
+PERMUTATIONS = make_permutations(PERMUTATION_SEED)
+
+# Struc that holds a pair of similar repos
+SimilarPair = collections.namedtuple('SimilarPair',
+                                     ['similarity', 'first', 'second'])
+
+
+def read_sources_at(repo_path, ref, patterns=SOURCE_PATTERNS):
+    """
+    Returns the contents of the files matching the patterns at the ref,
+    read straight from git (without checking anything out).
+    """
+    names = subprocess.check_output(
+        ["git", "ls-tree", "-r", "-z", "--name-only", ref],
+        cwd=repo_path).decode('utf-8', 'ignore').split("\0")
+    names = [name for name in names if name and
+             any(fnmatch.fnmatch(name, pattern) for pattern in patterns)]
+    if not names:
+        return []
+    requests = "".join("{}:{}\n".format(ref, name) for name in names)
+    output = subprocess.check_output(["git", "cat-file", "--batch"],
+                                     cwd=repo_path, input=requests.encode())
+    sources = []
+    offset = 0
+    for _ in names:
+        header_end = output.index(b"\n", offset)
+        header = output[offset:header_end].split()
+        offset = header_end + 1
+        if header[-1] == b"missing":
+            continue
+        size = int(header[2])
+        sources.append(output[offset:offset + size].decode('utf-8',
+                                                           'ignore'))
+        offset += size + 1
+    return sources
+
+
+def get_shingles(sources):
+    """
+    Returns the set of hashed token shingles of the sources.
+    """
+    shingles = set()
+    for source in sources:
+        tokens = [token for token, _ in plagiarism_index.tokenize(source)]
+        for i in range(len(tokens) - SHINGLE_SIZE + 1):
+            shingles.add(plagiarism_index.hash_k_gram(
+                tokens[i:i + SHINGLE_SIZE]))
+    return shingles
+
+
+def minhash_signature(shingles):
+    """
+    Returns the MinHash signature of the set of shingles
+    (None if the set is empty).
+    """
+    if not shingles:
+        return None
+    return tuple(min((a * shingle + b) % PRIME for shingle in shingles)
+                 for a, b in PERMUTATIONS)
+
+
+def estimate_similarity(first, second):
+    """
+    Estimates the Jaccard similarity of two sets from their signatures.
+    """
+    same = sum(1 for x, y in zip(first, second) if x == y)
+    return same / NUM_PERMUTATIONS
+
+
+def get_candidate_pairs(name_to_signature):
+    """
+    Returns the pairs of names whose signatures agree on every row of
+    at least one band.
+    """
+    candidates = set()
+    for band in range(BANDS):
+        start = band * ROWS_PER_BAND
+        buckets = collections.defaultdict(list)
+        for name, signature in name_to_signature.items():
+            buckets[signature[start:start + ROWS_PER_BAND]].append(name)
+        for names in buckets.values():
+            names.sort()
+            for i, first in enumerate(names):
+                for second in names[i + 1:]:
+                    candidates.add((first, second))
+    return candidates
+
+
+def find_similar_pairs(name_to_signature, threshold=DEFAULT_THRESHOLD):
+    """
+    Returns SimilarPairs with estimated similarity of at least threshold,
+    most similar first.
+    """
+    pairs = []
+    for first, second in get_candidate_pairs(name_to_signature):
+        similarity = estimate_similarity(name_to_signature[first],
+                                         name_to_signature[second])
+        if similarity >= threshold:
+            pairs.append(SimilarPair(similarity, first, second))
+    pairs.sort(reverse=True)
+    return pairs
+
+
+def get_clusters(pairs):
+    """
+    Groups the names in the pairs into connected clusters
+    (largest first).
+    """
+    parent = {}
+
+    def find(name):
+        parent.setdefault(name, name)
+        while parent[name] != name:
+            parent[name] = parent[parent[name]]
+            name = parent[name]
+        return name
+
+    for pair in pairs:
+        parent[find(pair.first)] = find(pair.second)
+    clusters = collections.defaultdict(list)
+    for name in parent:
+        clusters[find(name)].append(name)
+    return sorted((sorted(cluster) for cluster in clusters.values()),
+                  key=len, reverse=True)
+
+
+def sketch_repo(arg):
+    """
+    Takes (name, repo path, ref, base shingles) and returns the name and
+    the MinHash signature of the repo's shingles that aren't in the base.
+    """
+    name, repo_path, ref, base_shingles = arg
+    try:
+        sources = read_sources_at(repo_path, ref)
+    except subprocess.CalledProcessError:
+        print("Problem reading {} at {}".format(repo_path, ref))
+        return name, None
+    return name, minhash_signature(get_shingles(sources) - base_shingles)
@@ -1,46 +1,77 @@
 #!/usr/bin/env python3
 import sys
-from zipfile import ZipFile
+from zipfile import ZipFile, BadZipFile
 from glob import glob
+import fnmatch
+import io
+import multiprocessing
 import os.path
-import subprocess
-import shutil
 import argparse
 
+import moss_client
 
-def unzip_directories(zipfilename):
-    zipfile = ZipFile(zipfilename)
-    working_dir = zipfilename + "_extracted"
-    filenames = zipfile.namelist()
-    final_filenames = [name for name in filenames if "FINAL.zip" in name]
-
-    for name in final_filenames:
-        zipfile.extract(name, path=working_dir)
-    final_zipped_code = [os.path.join(working_dir, name)
-                         for name in final_filenames]
-
-    student_submissions = []
-    for zipped_code in final_zipped_code:
-        final_code = ZipFile(zipped_code)
-        working_subdir = zipped_code + "_extracted"
-        final_code.extractall(path=working_subdir)
-        student_submissions.append(working_subdir)
-    return student_submissions, working_dir
-
-
-def submit_to_moss(student_submissions,
-                   path_to_file_to_check,
-                   unzipped_folder,
-                   language):
-    files = [os.path.join(submission, path_to_file_to_check)
-             for submission in student_submissions]
-    files_that_exist = [file_ for file_ in files if os.path.exists(file_)]
-    if not files_that_exist:
+NUM_POOL_WORKERS = 8
+
+# The export is opened once in each pool worker
+_export = None
+
+
+def open_export(zipfilename):
+    global _export
+    _export = ZipFile(zipfilename)
+
+
+def read_final_files(arg):
+    """
+    Takes (FINAL.zip member, path or glob) and returns
+    (submission, filename, contents) triples for the matching files
+    in that submission, reading the nested zip in memory.
+    """
+    final_name, path_to_file_to_check = arg
+    submission = os.path.dirname(final_name) or final_name
+    try:
+        final_code = ZipFile(io.BytesIO(_export.read(final_name)))
+    except BadZipFile:
+        print("Couldn't read", final_name)
+        return []
+    names = [name for name in final_code.namelist()
+             if fnmatch.fnmatchcase(name, path_to_file_to_check)]
+    return [(submission, name, final_code.read(name)) for name in names]
+
+
+def read_submissions(zipfilename, path_to_file_to_check):
+    """
+    Returns (submission, filename, contents) triples for the files being
+    checked (a path or glob inside FINAL.zip) in every submission, without
+    extracting anything to disk.
+    """
+    with ZipFile(zipfilename) as zipfile:
+        final_filenames = [name for name in zipfile.namelist()
+                           if "FINAL.zip" in name]
+    args = [(name, path_to_file_to_check) for name in final_filenames]
+    with multiprocessing.Pool(NUM_POOL_WORKERS, initializer=open_export,
+                              initargs=(zipfilename,)) as pool:
+        return [source for sources in pool.map(read_final_files, args)
+                for source in sources]
+
+
+def submit_to_moss(submissions, path_to_file_to_check, language,
+                   base_files=(), max_matches=moss_client.DEFAULT_MAX_MATCHES,
+                   comment="", directory=False):
+    if not submissions:
         print("Couldn't find any files at that path: ", path_to_file_to_check)
         exit(1)
-    call_args = ["./moss", "-l", language] + files_that_exist
-    subprocess.call(call_args)
-    shutil.rmtree(unzipped_folder)
+    files = [moss_client.MossFile(os.path.join(submission, name), contents)
+             for submission, name, contents in submissions]
+    try:
+        url, duplicates = moss_client.submit(
+            files, language, moss_client.read_files(base_files),
+            directory=directory, max_matches=max_matches, comment=comment)
+    except (moss_client.MossError, OSError) as error:
+        print("Request not sent: {}".format(error))
+        sys.exit(1)
+    moss_client.print_duplicates(duplicates)
+    print(url)
 
 
 def main():
@@ -49,14 +80,25 @@ def main():
     submitted by a student from Mimir.
     """)
     parser.add_argument('zip_file')
-    parser.add_argument('path_to_file_to_check')
-    parser.add_argument('language')
+    parser.add_argument('path_to_file_to_check',
+                        help="Path (or glob) of the file inside FINAL.zip")
+    parser.add_argument('language', choices=moss_client.LANGUAGES)
+    parser.add_argument('-b', dest='base_files', action='append', default=[],
+                        help="Base file given to every student")
+    parser.add_argument('-m', dest='max_matches', type=int,
+                        default=moss_client.DEFAULT_MAX_MATCHES)
+    parser.add_argument('-c', dest='comment', default="")
+    parser.add_argument('-d', dest='directory', action='store_true',
+                        help="Treats each student's files as one submission")
     args = parser.parse_args()
-    student_submissions, unzipped_folder = unzip_directories(args.zip_file)
-    submit_to_moss(student_submissions,
+    submissions = read_submissions(args.zip_file, args.path_to_file_to_check)
+    submit_to_moss(submissions,
                    args.path_to_file_to_check,
-                   unzipped_folder,
-                   args.language)
+                   args.language,
+                   args.base_files,
+                   args.max_matches,
+                   args.comment,
+                   args.directory)
 
 
 if __name__ == "__main__":